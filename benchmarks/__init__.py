@@ -0,0 +1 @@
+"""Benchmarks of muninn, run with `python -m benchmarks --help`"""
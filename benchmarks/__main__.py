@@ -0,0 +1,446 @@
+"""
+Throughput and latency of muninn hot paths against local stand-ins of OpenAI, Chroma, Neo4j and SQL.
+
+    python -m benchmarks --output results.json
+    python -m benchmarks --sizes 10000 --only vector_query --baseline results.json
+
+Results are written as JSON, one entry per case and parameters. With `--baseline`, throughput is compared with
+earlier results and the process exits with status 1 if any case got slower than `--tolerance`.
+"""
+import argparse
+import datetime as dt
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field, asdict
+from typing import Callable, Iterator, Optional
+
+import numpy as np
+
+from benchmarks.standins import DEFAULT_DIM, HashEmbedder, MemoryGraph, random_vectors
+
+DEFAULT_SIZES = (10_000, 100_000, 1_000_000)
+# in-process chroma inserts slowly, larger collections are measured only with local backend
+DEFAULT_CHROMA_LIMIT = 100_000
+DEFAULT_TOLERANCE = 0.2
+INSERT_CHUNK = 10_000
+START = dt.datetime(2023, 5, 1)
+
+
+@dataclass(slots=True)
+class Result:
+    name: str  # measured case
+    params: dict  # parameters of case
+    operations: int  # number of measured operations, e.g. texts or queries
+    seconds: float  # wall time of all operations
+    latency_ms: dict = field(default_factory=dict)  # percentiles of single call latency
+    metrics: dict = field(default_factory=dict)  # other measured values, e.g. recall or memory
+
+    @property
+    def key(self) -> str:
+        return json.dumps([self.name, self.params], sort_keys=True)
+
+    @property
+    def ops_per_second(self) -> float:
+        return self.operations / self.seconds if self.seconds else float("inf")
+
+    def to_dict(self) -> dict:
+        return {**asdict(self), "ops_per_second": self.ops_per_second}
+
+
+def percentiles(latencies: list[float]) -> dict:
+    """
+    Summary of latencies
+
+    :param latencies: seconds of single calls
+    :return: milliseconds of p50, p95, p99 and max
+    """
+    if not latencies:
+        return {}
+    values = np.percentile(np.asarray(latencies) * 1000, [50, 95, 99, 100])
+    return {name: round(float(value), 4) for name, value in zip(("p50", "p95", "p99", "max"), values)}
+
+
+def measure(name: str, params: dict, calls: Iterator[Callable[[], int]]) -> Result:
+    """
+    Time every call separately
+
+    :param name: measured case
+    :param params: parameters of case
+    :param calls: callables returning number of operations they did
+    :return: measured result
+    """
+    latencies = []
+    operations = 0
+    for call in calls:
+        started = time.perf_counter()
+        operations += call()
+        latencies.append(time.perf_counter() - started)
+    return Result(name, params, operations, sum(latencies), percentiles(latencies))
+
+
+def create_storage(backend: str, collection_name: str):
+    from muninn.database.similarity import LocalClient, Settings, VectorStorage
+    if backend == "chroma":
+        return VectorStorage(Settings(anonymized_telemetry=False), collection_name)
+    return VectorStorage(client=LocalClient(), collection_name=collection_name)
+
+
+def bench_episodic(options: argparse.Namespace) -> Iterator[Result]:
+    from muninn.episodic import Episodic, WriteBehindEpisodic
+    texts = [f"message {number}" for number in range(options.texts)]
+    params = {"texts": options.texts, "dim": options.dim}
+
+    def add(text: str) -> int:
+        episodic.add(text)
+        return 1
+
+    def submit(text: str) -> int:
+        episodic.submit(text)
+        return 1
+
+    episodic = Episodic(HashEmbedder(options.dim), create_storage("local", "episodic_add"))
+    yield measure("episodic_add", params, ((lambda text=text: add(text)) for text in texts))
+
+    episodic = Episodic(HashEmbedder(options.dim), create_storage("local", "episodic_add_many"))
+    batches = [texts[start:start + options.batch_size] for start in range(0, len(texts), options.batch_size)]
+    yield measure(
+        "episodic_add_many", {**params, "batch_size": options.batch_size},
+        ((lambda batch=batch: len(episodic.add_many(batch))) for batch in batches),
+    )
+
+    episodic = WriteBehindEpisodic(
+        HashEmbedder(options.dim), create_storage("local", "episodic_write_behind"), flush_size=options.batch_size,
+    )
+    started = time.perf_counter()
+    result = measure(
+        "episodic_write_behind", {**params, "batch_size": options.batch_size},
+        ((lambda text=text: submit(text)) for text in texts),
+    )
+    # latency is of add call, throughput includes flush of everything
+    episodic.close()
+    result.seconds = time.perf_counter() - started
+    yield result
+
+
+def bench_vector_query(options: argparse.Namespace) -> Iterator[Result]:
+    queries = random_vectors(options.queries, options.dim, seed=1).tolist()
+    for backend in options.backends:
+        for size in options.sizes:
+            if backend == "chroma" and size > options.chroma_limit:
+                continue
+            params = {"backend": backend, "size": size, "dim": options.dim}
+            storage = create_storage(backend, "vector_query")
+            chunks = [
+                (start, random_vectors(min(INSERT_CHUNK, size - start), options.dim, seed=start + 2))
+                for start in range(0, size, INSERT_CHUNK)
+            ]
+
+            def insert(start: int, vectors: np.ndarray) -> int:
+                documents = [f"document {start + number}" for number in range(len(vectors))]
+                return len(storage.add_many(vectors.tolist(), documents))
+
+            def query(vector: list[float]) -> int:
+                storage.query(vector, n_results=10)
+                return 1
+
+            yield measure("vector_insert", params, ((lambda chunk=chunk: insert(*chunk)) for chunk in chunks))
+            # first query may build index, it is not part of query latency
+            yield measure("vector_index", params, iter([lambda: query(queries[0])]))
+            yield measure(
+                "vector_query", {**params, "n_results": 10},
+                ((lambda vector=vector: query(vector)) for vector in queries),
+            )
+
+
+def bench_vector_precision(options: argparse.Namespace) -> Iterator[Result]:
+    from muninn.database.local import LocalCollection
+    from muninn.database.vectors import recall_at_k
+    size = options.sizes[0]
+    vectors = random_vectors(size, options.dim, seed=2)
+    queries = random_vectors(options.queries, options.dim, seed=1)
+    ids = [str(row) for row in range(size)]
+    exact = None
+    for precision in ("float32", "float16", "int8"):
+        # exact search only, recall measures quantization alone
+        collection = LocalCollection("vector_precision", precision=precision, annoy_threshold=size + 1)
+        collection.add(ids, vectors)
+        found = []
+
+        def query(vector: np.ndarray) -> int:
+            found.append(collection.query(vector, n_results=10, include=[])["ids"][0])
+            return 1
+
+        result = measure(
+            "vector_precision", {"precision": precision, "size": size, "dim": options.dim, "n_results": 10},
+            ((lambda vector=vector: query(vector)) for vector in queries),
+        )
+        exact = exact or found
+        result.metrics = {"recall_at_10": recall_at_k(exact, found), "bytes_per_vector": collection.nbytes / size}
+        yield result
+
+
+def bench_graph(options: argparse.Namespace) -> Iterator[Result]:
+    from muninn.database.graph import Fact, GraphDB
+    if options.neo4j:
+        graph = GraphDB(options.neo4j, os.getenv("NEO4J_USER", "neo4j"), os.getenv("NEO4J_PASSWORD", ""))
+        backend = "neo4j"
+    else:
+        graph = MemoryGraph()
+        backend = "memory"
+    records = []
+    for number in range(options.records):
+        records.append([
+            Fact(
+                text=f"person {number % 97} met person {(number + index) % 89}",
+                embedding_id=f"fact {number} {index}",
+                entities=[(f"person {number % 97}", "subject"), (f"person {(number + index) % 89}", "object")],
+                predicates=["met"],
+            )
+            for index in range(options.facts_per_record)
+        ])
+
+    def insert(number: int, facts: list[Fact]) -> int:
+        with graph.batch():
+            return len(graph.insert_facts(facts, timestamp=START + dt.timedelta(seconds=number), author="bench"))
+
+    try:
+        yield measure(
+            "graph_insert_facts",
+            {"backend": backend, "records": options.records, "facts_per_record": options.facts_per_record},
+            ((lambda item=item: insert(*item)) for item in enumerate(records)),
+        )
+    finally:
+        graph.close()
+
+
+def bench_hybrid_recall(options: argparse.Namespace) -> Iterator[Result]:
+    from muninn.language.facts import Triple
+    from muninn.recall import HybridRecall
+    from muninn.weave.fact import Chronicle
+    embedder = HashEmbedder(options.dim)
+    storage = create_storage("local", "hybrid_recall")
+    fact_storage = create_storage("local", "hybrid_recall_facts")
+    graph = MemoryGraph()
+    contents = [
+        f"person {number % 97} met person {number % 89} at place {number % 13}" for number in range(options.texts)
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        chronicle = Chronicle(f"sqlite:///{os.path.join(directory, 'chronicle.db')}")
+        time_stamps = [START + dt.timedelta(minutes=number) for number in range(options.texts)]
+        ids = chronicle.insert_many(contents, time_stamps)
+        storage.add_many(
+            embedder.get_many(contents), contents, [{"chronicle_ids": json.dumps([id_])} for id_ in ids]
+        )
+        for id_, time_stamp, number in zip(ids, time_stamps, range(options.texts)):
+            triples = [Triple(f"person {number % 97}", "met", f"person {number % 89}")]
+            texts = [triple.text for triple in triples]
+            embedding_ids = fact_storage.add_many(embedder.get_many(texts), texts)
+            graph.insert_facts(
+                [triple.to_fact(embedding_id) for triple, embedding_id in zip(triples, embedding_ids)],
+                timestamp=time_stamp, chronicle_id=id_,
+            )
+        queries = [f"person {number % 97} met person {number % 89}" for number in range(options.queries)]
+        window = START, START + dt.timedelta(minutes=options.window)
+        recall = HybridRecall(embedder, storage, graph, fact_storage, chronicle, budget=10.0)
+        try:
+            params = {"texts": options.texts, "dim": options.dim, "n_results": 10}
+            yield measure(
+                "hybrid_recall", params,
+                ((lambda query=query: len(recall.recall_many([query], n_results=10))) for query in queries),
+            )
+            yield measure(
+                "hybrid_recall_window", {**params, "window": options.window},
+                ((lambda query=query: len(recall.recall_many([query], n_results=10, window=window)))
+                 for query in queries),
+            )
+        finally:
+            recall.close()
+            chronicle.close()
+
+
+def bench_chronicle(options: argparse.Namespace) -> Iterator[Result]:
+    from muninn.weave.fact import Chronicle
+    with tempfile.TemporaryDirectory() as directory:
+        chronicle = Chronicle(f"sqlite:///{os.path.join(directory, 'chronicle.db')}")
+        try:
+            contents = [f"message {number}" for number in range(options.records)]
+            time_stamps = [START + dt.timedelta(seconds=number) for number in range(options.records)]
+            chunks = [
+                (contents[start:start + INSERT_CHUNK], time_stamps[start:start + INSERT_CHUNK])
+                for start in range(0, options.records, INSERT_CHUNK)
+            ]
+            params = {"backend": "sqlite", "records": options.records}
+            yield measure(
+                "chronicle_insert_many", params,
+                ((lambda chunk=chunk: len(chronicle.insert_many(*chunk))) for chunk in chunks),
+            )
+            rng = np.random.default_rng(0)
+            window = dt.timedelta(seconds=options.window)
+            lowers = [
+                START + dt.timedelta(seconds=int(offset))
+                for offset in rng.integers(0, max(1, options.records - options.window), options.queries)
+            ]
+            params = {**params, "window": options.window}
+            yield measure(
+                "chronicle_range", params,
+                ((lambda lower=lower: len(chronicle.range(lower, lower + window))) for lower in lowers),
+            )
+            yield measure(
+                "chronicle_iter_range", params,
+                ((lambda lower=lower: sum(1 for _ in chronicle.iter_range(lower, lower + window))) for lower in lowers),
+            )
+        finally:
+            chronicle.close()
+
+
+def bench_snapshot(options: argparse.Namespace) -> Iterator[Result]:
+    from muninn.database.local import LocalClient
+    from muninn.database.similarity import VectorStorage
+    from muninn.snapshot import export_snapshot, import_snapshot
+    from muninn.weave.fact import Chronicle
+    size = options.sizes[0]
+    with tempfile.TemporaryDirectory() as directory:
+        storage = VectorStorage(client=LocalClient())
+        for start in range(0, size, INSERT_CHUNK):
+            count = min(INSERT_CHUNK, size - start)
+            storage.upsert_many(
+                [str(row) for row in range(start, start + count)],
+                random_vectors(count, options.dim, seed=start),
+                [f"message {row}" for row in range(start, start + count)],
+            )
+        chronicle = Chronicle(f"sqlite:///{os.path.join(directory, 'source.db')}")
+        target = Chronicle(f"sqlite:///{os.path.join(directory, 'target.db')}")
+        try:
+            chronicle.insert_many(
+                [f"message {number}" for number in range(options.records)],
+                [START + dt.timedelta(seconds=number) for number in range(options.records)],
+            )
+            path = os.path.join(directory, "snapshot")
+            restored = VectorStorage(client=LocalClient())
+
+            def export() -> int:
+                export_snapshot(path, storage, chronicle)
+                return size + options.records
+
+            def restore() -> int:
+                return sum(import_snapshot(path, restored, target).values())
+
+            params = {"size": size, "dim": options.dim, "records": options.records}
+            result = measure("snapshot_export", params, iter([export]))
+            vectors = os.path.join(path, "vectors")
+            result.metrics = {"vector_bytes": sum(entry.stat().st_size for entry in os.scandir(vectors))}
+            yield result
+            yield measure("snapshot_import", params, iter([restore]))
+        finally:
+            chronicle.close()
+            target.close()
+
+
+BENCHMARKS: dict[str, Callable[[argparse.Namespace], Iterator[Result]]] = {
+    "episodic": bench_episodic,
+    "vector_query": bench_vector_query,
+    "vector_precision": bench_vector_precision,
+    "graph": bench_graph,
+    "hybrid_recall": bench_hybrid_recall,
+    "chronicle": bench_chronicle,
+    "snapshot": bench_snapshot,
+}
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list[Result], baseline: dict, tolerance: float) -> list[str]:
+    """
+    Cases slower than baseline
+
+    :param results: current results
+    :param baseline: earlier report
+    :param tolerance: allowed relative drop of throughput
+    :return: descriptions of regressions
+    """
+    previous = {
+        json.dumps([item["name"], item["params"]], sort_keys=True): item["ops_per_second"]
+        for item in baseline.get("results", [])
+    }
+    regressions = []
+    for result in results:
+        before = previous.get(result.key)
+        if before and result.ops_per_second < before * (1 - tolerance):
+            regressions.append(
+                f"{result.name} {result.params}: {result.ops_per_second:.1f} ops/s, was {before:.1f} ops/s"
+            )
+    return regressions
+
+
+def parse_arguments(arguments: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), default=sorted(BENCHMARKS))
+    parser.add_argument("--sizes", type=lambda value: [int(size) for size in value.split(",")],
+                        default=list(DEFAULT_SIZES), help="comma separated vector collection sizes")
+    parser.add_argument("--backends", nargs="+", choices=("local", "chroma"), default=["local", "chroma"])
+    parser.add_argument("--chroma-limit", type=int, default=DEFAULT_CHROMA_LIMIT,
+                        help="largest collection measured with in-process chroma")
+    parser.add_argument("--dim", type=int, default=DEFAULT_DIM, help="dimension of embeddings")
+    parser.add_argument("--texts", type=int, default=2_000, help="texts added to episodic memory")
+    parser.add_argument("--batch-size", type=int, default=64, help="texts per add_many and write-behind flush")
+    parser.add_argument("--queries", type=int, default=200, help="queries per vector and chronicle case")
+    parser.add_argument("--records", type=int, default=10_000, help="chronicle records and graph records")
+    parser.add_argument("--facts-per-record", type=int, default=4)
+    parser.add_argument("--window", type=int, default=600, help="seconds of chronicle range scan")
+    parser.add_argument("--neo4j", default=os.getenv("NEO4J_URI"),
+                        help="bolt uri of real server instead of in-memory graph, NEO4J_USER and NEO4J_PASSWORD")
+    parser.add_argument("--output", help="write JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="JSON report to compare throughput with")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed relative drop of throughput against baseline")
+    return parser.parse_args(arguments)
+
+
+def main(arguments: Optional[list[str]] = None) -> int:
+    options = parse_arguments(arguments)
+    results = []
+    for name in options.only:
+        for result in BENCHMARKS[name](options):
+            print(
+                f"{result.name:<24} {json.dumps(result.params, sort_keys=True):<64} "
+                f"{result.ops_per_second:>12.1f} ops/s  p50 {result.latency_ms.get('p50', 0):.3f} ms",
+                file=sys.stderr,
+            )
+            results.append(result)
+    report = {
+        "created": dt.datetime.utcnow().isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": {key: value for key, value in vars(options).items() if key not in ("output", "baseline")},
+        "results": [result.to_dict() for result in results],
+    }
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+    if options.baseline:
+        with open(options.baseline, encoding="utf-8") as file:
+            regressions = compare(results, json.load(file), options.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,203 @@
+"""
+Deterministic in-process stand-ins of external services, so benchmarks run offline and repeatably.
+"""
+import collections
+import contextlib
+import datetime as dt
+import hashlib
+import itertools
+from typing import Iterator, Optional, Sequence
+
+import numpy as np
+
+from muninn.database.graph import DEFAULT_FANOUT, Fact
+
+DEFAULT_DIM = 128
+
+
+def random_vectors(count: int, dim: int = DEFAULT_DIM, seed: int = 0) -> np.ndarray:
+    """
+    Unit vectors of given seed, the same on every machine.
+
+    :param count: number of vectors
+    :param dim: dimension of vectors
+    :param seed: seed of generator
+    :return: float32 matrix of shape (count, dim)
+    """
+    vectors = np.random.default_rng(seed).standard_normal((count, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+class HashEmbedder:
+    """
+    Embedding stand-in, text is seed of its unit vector.
+
+    The same text has always the same embedding, there is no network and no rate limit.
+    """
+
+    def __init__(self, dim: int = DEFAULT_DIM, model: str = "hash") -> None:
+        self.dim = dim
+        self.model = model
+        self.requests = 0
+
+    def _vector(self, text: str) -> list[float]:
+        seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+        return random_vectors(1, self.dim, seed)[0].tolist()
+
+    def get(self, text: str) -> list[float]:
+        return self.get_many([text])[0]
+
+    def get_many(self, texts: Sequence[str], batch_size: Optional[int] = None) -> list[list[float]]:
+        self.requests += 1
+        return [self._vector(text) for text in texts]
+
+
+class MemoryGraph:
+    """
+    In-memory stand-in of `GraphDB` with the same fact insertion and traversal interface.
+
+    Entities and predicates are merged by text like MERGE of neo4j, facts are chained into records.
+    """
+
+    def __init__(self) -> None:
+        self._ids = itertools.count()
+        self.entities: dict[str, int] = {}
+        self.predicates: dict[str, int] = {}
+        self.facts: dict[str, int] = {}
+        self.nodes: dict[int, dict] = {}
+        self.edges: list[tuple[int, str, int]] = []
+        self._adjacent: dict[int, set[int]] = collections.defaultdict(set)
+        self._by_embedding_id: dict[str, int] = {}
+
+    def close(self) -> None:
+        pass
+
+    @contextlib.contextmanager
+    def batch(self) -> Iterator["MemoryGraph"]:
+        yield self
+
+    def _merge(self, nodes: dict[str, int], label: str, text: str, **properties) -> int:
+        node_id = nodes.get(text)
+        if node_id is None:
+            node_id = nodes[text] = next(self._ids)
+            self.nodes[node_id] = {"label": label, "text": text, **properties}
+        return node_id
+
+    def _link(self, source: int, relation: str, target: int) -> None:
+        self.edges.append((source, relation, target))
+        self._adjacent[source].add(target)
+        self._adjacent[target].add(source)
+
+    def insert_facts(
+            self,
+            facts: Sequence[Fact],
+            timestamp: Optional[dt.datetime] = None,
+            author: Optional[str] = None,
+            chronicle_id: Optional[int] = None,
+    ) -> list[int]:
+        fact_ids = []
+        for fact in facts:
+            fact_id = self._merge(self.facts, "Fact", fact.text, embedding_id=fact.embedding_id)
+            if fact.embedding_id is not None:
+                self._by_embedding_id[fact.embedding_id] = fact_id
+            for text, _ in fact.entities:
+                self._link(self._merge(self.entities, "Entity", text), "PART_OF", fact_id)
+            for text in fact.predicates:
+                self._link(self._merge(self.predicates, "Predicate", text), "PART_OF", fact_id)
+            fact_ids.append(fact_id)
+        if timestamp is not None:
+            record_id = next(self._ids)
+            self.nodes[record_id] = {"label": "Record", "text": None, "chronicle_id": chronicle_id}
+            # repeated fact is bound once and chained at its first position, like in GraphDB
+            distinct = list(dict.fromkeys(fact_ids))
+            for fact_id in distinct:
+                self._link(record_id, "CONTAINS", fact_id)
+            for current, following in zip(distinct, distinct[1:]):
+                self._link(current, "NEXT", following)
+            if author:
+                self.edges.append((record_id, "AUTHOR", self._merge(self.entities, "Entity", author)))
+        return fact_ids
+
+    def iter_nodes(self, chunk_size: int = 10_000) -> Iterator[list[dict]]:
+        rows = [
+            {"id": node_id, "label": node["label"],
+             "properties": {key: value for key, value in node.items() if key != "label" and value is not None}}
+            for node_id, node in sorted(self.nodes.items())
+        ]
+        for start in range(0, len(rows), chunk_size):
+            yield rows[start:start + chunk_size]
+
+    def iter_edges(self, chunk_size: int = 10_000) -> Iterator[list[dict]]:
+        rows = [
+            {"id": edge_id, "source": source, "type": relation, "target": target, "properties": {}}
+            for edge_id, (source, relation, target) in enumerate(self.edges)
+        ]
+        for start in range(0, len(rows), chunk_size):
+            yield rows[start:start + chunk_size]
+
+    def create_nodes(self, label: Optional[str], properties: Sequence[dict]) -> list[int]:
+        lookups = {"Entity": self.entities, "Predicate": self.predicates, "Fact": self.facts}
+        node_ids = []
+        for node in properties:
+            node_id = next(self._ids)
+            self.nodes[node_id] = {"label": label, "text": None, **node}
+            if label in lookups:
+                lookups[label][node["text"]] = node_id
+            if node.get("embedding_id") is not None:
+                self._by_embedding_id[node["embedding_id"]] = node_id
+            node_ids.append(node_id)
+        return node_ids
+
+    def create_edges(self, type_: str, edges: Sequence[tuple[int, int, dict]]) -> int:
+        for source, target, _ in edges:
+            if type_ == "AUTHOR":
+                self.edges.append((source, type_, target))
+            else:
+                self._link(source, type_, target)
+        return len(edges)
+
+    def neighbors(
+            self,
+            embedding_ids: Sequence[str],
+            hops: int = 2,
+            limit: int = 100,
+            fanout: int = DEFAULT_FANOUT,
+            timeout: Optional[float] = None,
+    ) -> list[dict]:
+        # timeout is for database server, traversal in memory never waits
+        found = []
+        for embedding_id in embedding_ids:
+            seed = self._by_embedding_id.get(embedding_id)
+            if seed is None:
+                continue
+            distances = {seed: 0}
+            frontier = [seed]
+            for hop in range(1, hops + 1):
+                reached = dict.fromkeys(
+                    node for current in frontier for node in sorted(self._adjacent[current])[:fanout]
+                )
+                frontier = [node for node in reached if node not in distances]
+                for node in frontier:
+                    distances[node] = hop
+            found.extend(
+                (distance, embedding_id, node_id) for node_id, distance in distances.items()
+                if self.nodes[node_id]["label"] in ("Fact", "Record")
+            )
+        found.sort(key=lambda item: item[0])
+        rows = []
+        for distance, embedding_id, node_id in found[:limit]:
+            node = self.nodes[node_id]
+            fact = node["label"] == "Fact"
+            rows.append({
+                "embedding_id": embedding_id,
+                "label": node["label"],
+                "text": node["text"] if fact else None,
+                "chronicle_id": None if fact else node.get("chronicle_id"),
+                "hops": distance,
+                "chronicle_ids": [
+                    self.nodes[other].get("chronicle_id") for other in self._adjacent[node_id]
+                    if self.nodes[other]["label"] == "Record"
+                ] if fact else [],
+            })
+        return rows
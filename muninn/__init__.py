@@ -1,4 +1,26 @@
-from . import (
-    language,
-    episodic,
-)
+from typing import TYPE_CHECKING
+
+from .utils import lazy_attributes
+
+if TYPE_CHECKING:
+    from . import (
+        consolidation,
+        database,
+        language,
+        episodic,
+        ingestion,
+        instrumentation,
+        recall,
+        snapshot,
+    )
+
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    "consolidation": "consolidation",
+    "database": "database",
+    "language": "language",
+    "episodic": "episodic",
+    "ingestion": "ingestion",
+    "instrumentation": "instrumentation",
+    "recall": "recall",
+    "snapshot": "snapshot",
+})
@@ -0,0 +1,544 @@
+import datetime as dt
+import json
+import math
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator, Optional, Sequence
+
+from chromadb.api.types import Embedding, ID, Where
+
+from . import database
+from .database.similarity import MatchedResult, document_id
+from .ingestion import Checkpoint
+from .instrumentation import Span
+from .weave.fact import Chronicle, Record
+
+__all__ = (
+    "AccessLog",
+    "Consolidated",
+    "ConsolidationState",
+    "Consolidator",
+    "Decay",
+    "Memory",
+    "TrackedVectorStorage",
+)
+
+DEFAULT_BATCH_SIZE = 256
+DEFAULT_NEIGHBORS = 8
+# squared l2 distance of near-duplicates, cosine similarity ~0.99 for unit vectors
+DEFAULT_MAX_DISTANCE = 0.02
+DEFAULT_HALF_LIFE = 30 * 24 * 3600.0
+DEFAULT_MIN_STRENGTH = 0.05
+DEFAULT_INTERVAL = 60.0
+
+
+def unix_time(time_stamp: dt.datetime) -> float:
+    """Seconds since epoch, naive time stamps of Chronicle are UTC"""
+    if time_stamp.tzinfo is None:
+        time_stamp = time_stamp.replace(tzinfo=dt.timezone.utc)
+    return time_stamp.timestamp()
+
+
+@dataclass(slots=True)
+class Decay:
+    half_life: float = DEFAULT_HALF_LIFE  # seconds in which strength of not recalled memory halves
+    access_weight: float = 1.0  # strength added by each recall
+    min_strength: float = DEFAULT_MIN_STRENGTH  # weaker memories leave hot index, below 1.0
+
+    def strength(self, last_seen: float, accesses: int, now: float) -> float:
+        """
+        Strength of memory, 1.0 for just written memory which was never recalled
+
+        :param last_seen: unix time of the last write or recall
+        :param accesses: number of recalls
+        :param now: unix time
+        :return: decayed strength
+        """
+        return (1.0 + self.access_weight * accesses) * 0.5 ** (max(0.0, now - last_seen) / self.half_life)
+
+    def expires(self, last_seen: float, accesses: int) -> float:
+        """
+        Unix time when strength drops to `min_strength`, unless memory is recalled meanwhile
+
+        :param last_seen: unix time of the last write or recall
+        :param accesses: number of recalls
+        :return: unix time of archiving
+        """
+        return last_seen + self.half_life * math.log2((1.0 + self.access_weight * accesses) / self.min_strength)
+
+
+@dataclass(slots=True)
+class Memory:
+    doc_id: ID  # id in vector storage
+    chronicle_ids: list[int] = field(default_factory=list)  # provenance, records merged into this memory
+    accesses: int = 0  # number of recalls
+    last_seen: float = 0.0  # unix time of the last write or recall
+    expires: float = 0.0  # unix time of archiving
+    archived: bool = False  # moved out of hot index
+
+
+@dataclass(slots=True)
+class Consolidated:
+    records: int = 0  # chronicle records visited
+    missing: int = 0  # documents of records not found in hot index
+    merged: int = 0  # near-duplicates merged into representative
+    archived: int = 0  # cold memories moved out of hot index
+    seconds: float = 0.0  # wall time of pass
+
+
+class AccessLog:
+    """Recalled document ids with count and time of the last recall, drained by each consolidation pass"""
+
+    def __init__(self) -> None:
+        self._accessed: dict[ID, tuple[int, float]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._accessed)
+
+    def record(self, doc_ids: Iterable[ID], now: Optional[float] = None) -> None:
+        """
+        Count recall of documents
+
+        :param doc_ids: recalled document ids
+        :param now: unix time of recall, now if not set
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            for doc_id in doc_ids:
+                accesses, _ = self._accessed.get(doc_id, (0, now))
+                self._accessed[doc_id] = accesses + 1, now
+
+    def drain(self) -> dict[ID, tuple[int, float]]:
+        """
+        Take recorded recalls and start over
+
+        :return: document id to number of recalls and unix time of the last one
+        """
+        with self._lock:
+            accessed, self._accessed = self._accessed, {}
+        return accessed
+
+
+class TrackedVectorStorage:
+    """
+    `VectorStorage` recording ids of recalled documents into `AccessLog`, so recalled memories decay slower.
+
+    Other methods are passed to wrapped storage.
+    """
+
+    def __init__(self, storage: database.VectorStorage, access_log: AccessLog) -> None:
+        self.storage = storage
+        self.access_log = access_log
+
+    def __getattr__(self, name: str):
+        return getattr(self.storage, name)
+
+    def query(self, embedding: Embedding, n_results: int = 17) -> list[str]:
+        return self.nearest(embedding, n_results).documents
+
+    def nearest(self, embedding: Embedding, n_results: int = 17) -> MatchedResult:
+        return self.query_many([embedding], n_results)[0]
+
+    def query_many(
+            self,
+            embeddings: Sequence[Embedding],
+            n_results: int = 17,
+            where: Optional[Where] = None,
+    ) -> list[MatchedResult]:
+        results = self.storage.query_many(embeddings, n_results, where)
+        self.access_log.record(doc_id for result in results for doc_id in result.ids or ())
+        return results
+
+
+class ConsolidationState:
+    """
+    Provenance, recall counts and archive schedule of memories with consolidation watermark, in SQLite.
+
+    Watermark is the highest Chronicle id consolidated, `Checkpoint` of consolidation.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        """
+        Open state
+
+        :param path: sqlite file, memory only if not set
+        """
+        self._db = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        self._lock = threading.Lock()
+        if path:
+            self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS memory (
+                doc_id TEXT PRIMARY KEY,
+                chronicle_ids TEXT NOT NULL,
+                accesses INTEGER NOT NULL,
+                last_seen REAL NOT NULL,
+                expires REAL NOT NULL,
+                archived INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS memory_schedule ON memory (archived, expires);
+            CREATE TABLE IF NOT EXISTS watermark (id INTEGER NOT NULL);
+            """
+        )
+        self._db.commit()
+
+    def close(self) -> None:
+        self._db.close()
+
+    @staticmethod
+    def _memory(row: tuple) -> Memory:
+        doc_id, chronicle_ids, accesses, last_seen, expires, archived = row
+        return Memory(doc_id, json.loads(chronicle_ids), accesses, last_seen, expires, bool(archived))
+
+    def load(self) -> int:
+        with self._lock:
+            row = self._db.execute("SELECT id FROM watermark").fetchone()
+        return row[0] if row else 0
+
+    def save(self, id_: int) -> None:
+        self.apply(watermark=id_)
+
+    def get_many(self, doc_ids: Iterable[ID]) -> dict[ID, Memory]:
+        """
+        Find memories by document ids
+
+        :param doc_ids: ids in vector storage
+        :return: document id to memory, unknown ids are left out
+        """
+        doc_ids = list(doc_ids)
+        found = {}
+        with self._lock:
+            # stays under default limit of sqlite variables
+            for start in range(0, len(doc_ids), 500):
+                chunk = doc_ids[start:start + 500]
+                rows = self._db.execute(
+                    f"SELECT * FROM memory WHERE doc_id IN ({', '.join('?' * len(chunk))})", chunk
+                )
+                found.update((row[0], self._memory(row)) for row in rows)
+        return found
+
+    def due(self, now: float, limit: int) -> list[Memory]:
+        """
+        Memories in hot index which should be archived
+
+        :param now: unix time
+        :param limit: max number of memories
+        :return: memories which expire first
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM memory WHERE archived = 0 AND expires <= ? ORDER BY expires LIMIT ?", (now, limit)
+            ).fetchall()
+        return [self._memory(row) for row in rows]
+
+    def provenance(self, doc_id: ID) -> list[int]:
+        """
+        Chronicle ids merged into memory
+
+        :param doc_id: id in vector storage
+        :return: chronicle ids, empty if memory is unknown
+        """
+        memory = self.get_many([doc_id]).get(doc_id)
+        return memory.chronicle_ids if memory is not None else []
+
+    def apply(
+            self,
+            memories: Iterable[Memory] = (),
+            removed: Iterable[ID] = (),
+            watermark: Optional[int] = None,
+    ) -> None:
+        """
+        Write memories, remove merged ones and move watermark in single transaction
+
+        :param memories: inserted or replaced memories
+        :param removed: ids of memories merged into others
+        :param watermark: new watermark, unchanged if not set
+        """
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO memory VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (memory.doc_id, json.dumps(memory.chronicle_ids), memory.accesses, memory.last_seen,
+                     memory.expires, int(memory.archived))
+                    for memory in memories
+                ],
+            )
+            self._db.executemany("DELETE FROM memory WHERE doc_id = ?", [(doc_id,) for doc_id in removed])
+            if watermark is not None:
+                self._db.execute("DELETE FROM watermark")
+                self._db.execute("INSERT INTO watermark VALUES (?)", (watermark,))
+
+
+class Consolidator:
+    """
+    Background consolidation of episodic memory.
+
+    Each pass visits only Chronicle records written since the previous pass. Their documents are looked up in hot
+    vector index, near-duplicates of the oldest member are clustered and merged into it, which keeps Chronicle ids
+    of all of them as provenance. Then memories whose strength decayed below threshold are moved to archive storage.
+    Archive schedule is kept ordered by expiry, so decay touches only memories due now, never the whole index.
+
+    access_log = AccessLog()
+    memory = Episodic(embedder, TrackedVectorStorage(storage, access_log))
+    with Consolidator(storage, chronicle, ConsolidationState("consolidation.sqlite"), archive, access_log,
+                      until=pipeline.checkpoint) as consolidator:
+        consolidator.start()
+    """
+
+    def __init__(
+            self,
+            storage: database.VectorStorage,
+            chronicle: Chronicle,
+            state: Optional[ConsolidationState] = None,
+            archive: Optional[database.VectorStorage] = None,
+            access_log: Optional[AccessLog] = None,
+            decay: Optional[Decay] = None,
+            until: Optional[Checkpoint] = None,
+            max_distance: float = DEFAULT_MAX_DISTANCE,
+            neighbors: int = DEFAULT_NEIGHBORS,
+            batch_size: int = DEFAULT_BATCH_SIZE,
+    ) -> None:
+        """
+        Set up consolidation, call `run` for single pass or `start` for periodic passes
+
+        :param storage: hot vector database of remembered texts
+        :param chronicle: permanent storage of raw texts, source of changes and provenance
+        :param state: provenance and schedule, in memory only if not set
+        :param archive: cold vector database, archived memories are only dropped from hot index if not set
+        :param access_log: recalls recorded by `TrackedVectorStorage`, memories decay by age only if not set
+        :param decay: strength of memories over time, `Decay()` if not set
+        :param until: ingestion checkpoint, records not ingested yet wait for next pass
+        :param max_distance: max vector distance of near-duplicates, in distance function of storage
+        :param neighbors: nearest documents compared with each changed document
+        :param batch_size: records merged and memories archived at once
+        """
+        self.storage = storage
+        self.chronicle = chronicle
+        self.state = state if state is not None else ConsolidationState()
+        self.archive = archive
+        self.access_log = access_log
+        self.decay = decay or Decay()
+        self.until = until
+        self.max_distance = max_distance
+        self.neighbors = neighbors
+        self.batch_size = batch_size
+        self.error: Optional[BaseException] = None
+        self._running = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self) -> "Consolidator":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def start(self, interval: float = DEFAULT_INTERVAL) -> None:
+        """
+        Run pass every interval in background thread
+
+        :param interval: seconds between passes
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._work, args=(interval,), name="consolidation", daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        """Stop background passes and raise error of failed pass"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.error is not None:
+            raise self.error
+
+    def _work(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            try:
+                self.run()
+            except BaseException as error:
+                self.error = error
+                return
+
+    def run(self, now: Optional[float] = None) -> Consolidated:
+        """
+        Single consolidation pass
+
+        :param now: unix time deciding decay, now if not set
+        :return: counts of pass
+        """
+        started = time.monotonic()
+        now = time.time() if now is None else now
+        report = Consolidated()
+        with self._running, Span("consolidation.run"):
+            self._touch()
+            for records in self._changed():
+                with Span("consolidation.merge", len(records)):
+                    self._merge(records, now, report)
+            self._archive(now, report)
+        report.seconds = time.monotonic() - started
+        return report
+
+    def _touch(self) -> None:
+        if self.access_log is None:
+            return
+        accessed = self.access_log.drain()
+        memories = self.state.get_many(accessed)
+        for doc_id, memory in memories.items():
+            accesses, last_access = accessed[doc_id]
+            memory.accesses += accesses
+            memory.last_seen = max(memory.last_seen, last_access)
+            memory.expires = self.decay.expires(memory.last_seen, memory.accesses)
+        self.state.apply(memories.values())
+
+    def _changed(self) -> Iterator[list[Record]]:
+        limit = self.until.load() if self.until is not None else None
+        batch: list[Record] = []
+        for record in self.chronicle.iter_after(self.state.load(), self.batch_size):
+            if limit is not None and record["id"] > limit:
+                break
+            batch.append(record)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _merge(self, records: list[Record], now: float, report: Consolidated) -> None:
+        report.records += len(records)
+        provenance: dict[ID, set[int]] = {}
+        written: dict[ID, float] = {}
+        for record in records:
+            doc_id = document_id(record["content"])
+            provenance.setdefault(doc_id, set()).add(record["id"])
+            written[doc_id] = max(written.get(doc_id, 0.0), unix_time(record["time_stamp"]))
+        stored = self.storage.get_many(list(provenance), include=["embeddings"])
+        embeddings = dict(zip(stored.ids, stored.embeddings))
+        report.missing += len(provenance) - len(embeddings)
+        changed = list(embeddings)
+        hits = self.storage.query_many([embeddings[doc_id] for doc_id in changed], n_results=self.neighbors + 1)
+        near = {
+            other
+            for hit in hits
+            for other, distance in zip(hit.ids or [], hit.distances or [])
+            if other not in embeddings and distance <= self.max_distance
+        }
+        memories = self.state.get_many([*changed, *near])
+        for doc_id in changed:
+            memory = memories.setdefault(doc_id, Memory(doc_id, last_seen=now))
+            memory.chronicle_ids = sorted(set(memory.chronicle_ids) | provenance[doc_id])
+            memory.last_seen = max(memory.last_seen, written[doc_id])
+        if near:
+            neighbors = self.storage.get_many(list(near), include=["embeddings", "metadatas"])
+            for doc_id, embedding, metadata in zip(neighbors.ids, neighbors.embeddings, neighbors.metadatas):
+                if doc_id not in memories:
+                    # unknown to state, e.g. state was lost, provenance is taken from label of earlier pass;
+                    # unlabeled memory is left alone, pass of its own record merges it without losing provenance
+                    chronicle_ids = (metadata or {}).get("chronicle_ids")
+                    if chronicle_ids is None:
+                        continue
+                    memories[doc_id] = Memory(doc_id, json.loads(chronicle_ids), last_seen=now)
+                embeddings[doc_id] = embedding
+        parents: dict[ID, ID] = {doc_id: doc_id for doc_id in memories if doc_id in embeddings}
+
+        def root(doc_id: ID) -> ID:
+            while parents[doc_id] != doc_id:
+                parents[doc_id] = parents[parents[doc_id]]
+                doc_id = parents[doc_id]
+            return doc_id
+
+        for doc_id, hit in zip(changed, hits):
+            for other, distance in zip(hit.ids or [], hit.distances or []):
+                if other != doc_id and other in parents and distance <= self.max_distance:
+                    parents[root(other)] = root(doc_id)
+        components: dict[ID, list[Memory]] = {}
+        for doc_id in parents:
+            components.setdefault(root(doc_id), []).append(memories[doc_id])
+        space = database.CachedVectorStorage.space_of(self.storage)
+        clusters = [
+            cluster for members in components.values() for cluster in self._split(members, embeddings, space)
+        ]
+        merged: list[ID] = []
+        for members in clusters:
+            # the oldest memory survives, merged ones add provenance, recalls and recency
+            kept = members[0]
+            for member in members[1:]:
+                kept.chronicle_ids = sorted(set(kept.chronicle_ids) | set(member.chronicle_ids))
+                kept.accesses += member.accesses
+                kept.last_seen = max(kept.last_seen, member.last_seen)
+                merged.append(member.doc_id)
+        survivors = [members[0] for members in clusters]
+        for memory in survivors:
+            # text written again after it was archived is hot again
+            memory.archived = False
+            memory.expires = self.decay.expires(memory.last_seen, memory.accesses)
+        # provenance is saved before duplicates are deleted and watermark moves last,
+        # so interrupted pass repeats the batch without losing any chronicle id
+        self.state.apply(survivors, merged)
+        self.storage.delete_many(merged)
+        self._label([memory for memory in survivors if len(memory.chronicle_ids) > 1])
+        self.state.save(records[-1]["id"])
+        report.merged += len(merged)
+
+    def _split(self, members: list[Memory], embeddings: dict[ID, Embedding], space: str) -> list[list[Memory]]:
+        # near-duplicates are linked pairwise, a chain of them may drift far, so every member of cluster has to be
+        # near its representative, the oldest memory, instead of near any other member
+        members.sort(key=lambda memory: (min(memory.chronicle_ids, default=math.inf), memory.doc_id))
+        if len(members) == 1:
+            return [members]
+        vectors = database.vectors.as_matrix([embeddings[memory.doc_id] for memory in members])
+        distances = database.cache.space_distances(space, vectors, vectors)
+        clusters = []
+        remaining = list(range(len(members)))
+        while remaining:
+            representative = remaining[0]
+            cluster = [
+                index for index in remaining
+                if index == representative or distances[representative, index] <= self.max_distance
+            ]
+            clusters.append([members[index] for index in cluster])
+            taken = set(cluster)
+            remaining = [index for index in remaining if index not in taken]
+        return clusters
+
+    def _label(self, memories: Sequence[Memory]) -> None:
+        if not memories:
+            return
+        stored = self.storage.get_many([memory.doc_id for memory in memories], include=["metadatas"])
+        chronicle_ids = {memory.doc_id: memory.chronicle_ids for memory in memories}
+        self.storage.update_metadatas(
+            stored.ids,
+            [
+                {**(metadata or {}), "chronicle_ids": json.dumps(chronicle_ids[doc_id])}
+                for doc_id, metadata in zip(stored.ids, stored.metadatas)
+            ],
+        )
+
+    def _archive(self, now: float, report: Consolidated) -> None:
+        while due := self.state.due(now, self.batch_size):
+            with Span("consolidation.archive", len(due)):
+                doc_ids = [memory.doc_id for memory in due]
+                if self.archive is not None:
+                    stored = self.storage.get_many(doc_ids)
+                    if stored.ids:
+                        chronicle_ids = {memory.doc_id: memory.chronicle_ids for memory in due}
+                        self.archive.add_many(
+                            stored.embeddings,
+                            stored.documents,
+                            [
+                                {**(metadata or {}), "chronicle_ids": json.dumps(chronicle_ids[doc_id])}
+                                for doc_id, metadata in zip(stored.ids, stored.metadatas)
+                            ],
+                        )
+                # archive is written first and hot index second, repeated pass finds nothing to move
+                self.storage.delete_many(doc_ids)
+                for memory in due:
+                    memory.archived = True
+                self.state.apply(due)
+            report.archived += len(due)
@@ -1,7 +1,36 @@
-from . import (
-    graph,
-    similarity,
-)
+from typing import TYPE_CHECKING
 
-from .graph import GraphDB
-from .similarity import VectorStorage
\ No newline at end of file
+from ..utils import lazy_attributes
+
+if TYPE_CHECKING:
+    from . import (
+        cache,
+        graph,
+        local,
+        sharding,
+        similarity,
+        vectors,
+    )
+    from .cache import CachedVectorStorage, RecallCache
+    from .graph import Fact, GraphDB
+    from .local import LocalClient
+    from .sharding import ShardedVectorStorage
+    from .similarity import VectorStorage
+    from .vectors import QuantizedVectors
+
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    "cache": "cache",
+    "graph": "graph",
+    "local": "local",
+    "sharding": "sharding",
+    "similarity": "similarity",
+    "vectors": "vectors",
+    "CachedVectorStorage": "cache",
+    "RecallCache": "cache",
+    "Fact": "graph",
+    "GraphDB": "graph",
+    "LocalClient": "local",
+    "ShardedVectorStorage": "sharding",
+    "VectorStorage": "similarity",
+    "QuantizedVectors": "vectors",
+})
@@ -0,0 +1,448 @@
+"""
+Semantic cache of vector queries, nearly the same query reuses top k of the previous one.
+
+Queries are bucketed by sign of random projections (SimHash), so lookup compares query only with cached queries
+of its bucket and of buckets differing in one bit. Cached result is reused when cosine similarity of queries reaches
+threshold. Adding document drops exactly the cached results it could enter, i.e. those whose query is nearer
+to the new embedding than their k-th match.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Iterable, Iterator, Optional, Sequence
+
+import numpy as np
+from chromadb.api.types import Document, Embedding, ID, Include, Metadata, Where
+
+from .local import LocalCollection
+from .similarity import EVERYTHING, MatchedResult, VectorStorage
+from .vectors import as_matrix
+
+__all__ = (
+    "CachedVectorStorage",
+    "RecallCache",
+    "RecallCacheStats",
+    "space_distances",
+)
+
+DEFAULT_THRESHOLD = 0.98
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_BITS = 16
+# distance slack of invalidation, covers rounding of quantized storage
+DEFAULT_MARGIN = 1e-3
+
+
+def space_distances(space: str, queries: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+    """
+    Distances as computed by vector storage of given space
+
+    :param space: "l2", "ip" or "cosine" same as chroma hnsw:space
+    :param queries: float32 matrix of queries
+    :param vectors: float32 matrix of vectors
+    :return: matrix of shape (len(queries), len(vectors))
+    """
+    dots = queries @ vectors.T
+    if space == "ip":
+        return 1.0 - dots
+    if space == "cosine":
+        norms = np.linalg.norm(queries, axis=1)[:, None] * np.linalg.norm(vectors, axis=1)[None, :]
+        return 1.0 - dots / np.maximum(norms, np.finfo(np.float32).tiny)
+    return np.maximum(
+        (queries * queries).sum(axis=1)[:, None] - 2.0 * dots + (vectors * vectors).sum(axis=1)[None, :], 0.0
+    )
+
+
+def unit(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), np.finfo(np.float32).tiny)
+
+
+@dataclass(slots=True)
+class RecallCacheStats:
+    hits: int = 0  # query answered from cache
+    misses: int = 0  # query sent to storage
+    evictions: int = 0  # dropped as least recently used
+    expirations: int = 0  # dropped after time to live
+    invalidations: int = 0  # dropped because added or removed document could change them
+
+    @property
+    def lookups(self) -> int:
+        return self.hits + self.misses
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.lookups if self.lookups else 0.0
+
+
+@dataclass(slots=True)
+class _Entry:
+    key: int  # locality-sensitive hash of query
+    query: np.ndarray  # float32 query embedding
+    direction: np.ndarray  # query scaled to unit length
+    n_results: int  # number of matches asked for
+    where: Optional[str]  # canonical metadata filter
+    result: MatchedResult  # ids, documents and distances
+    created: float  # monotonic time of caching
+
+    @property
+    def complete(self) -> bool:
+        """Storage had fewer matches than asked, result holds all of them"""
+        return len(self.result.ids or []) < self.n_results
+
+
+@dataclass(slots=True)
+class _Lookup:
+    query: np.ndarray
+    direction: np.ndarray
+    key: int
+    where: Optional[str]
+    generation: int  # invalidation counter when lookup started
+    result: Optional[MatchedResult] = None
+
+
+class RecallCache:
+    """
+    Bounded LRU of query results with time to live and precise invalidation on writes.
+
+    Thread safe. Results computed while a write was invalidating are not cached, so they cannot outlive it.
+    """
+
+    def __init__(
+            self,
+            threshold: float = DEFAULT_THRESHOLD,
+            max_entries: int = DEFAULT_MAX_ENTRIES,
+            ttl: Optional[float] = None,
+            bits: int = DEFAULT_BITS,
+            space: Optional[str] = None,
+            margin: float = DEFAULT_MARGIN,
+            seed: int = 0,
+    ) -> None:
+        """
+        Set up empty cache
+
+        :param threshold: min cosine similarity of queries to share result, 1.0 reuses only the same query
+        :param max_entries: max number of cached results
+        :param ttl: seconds cached result is valid, forever if not set
+        :param bits: number of random hyperplanes hashing queries, more makes smaller buckets
+        :param space: distance function of storage "l2", "ip" or "cosine", taken from wrapped storage if not set
+        :param margin: extra distance within which added document invalidates cached result
+        :param seed: seed of random hyperplanes
+        """
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.bits = bits
+        self.space = space
+        self.margin = margin
+        self.seed = seed
+        self.stats = RecallCacheStats()
+        self._planes: Optional[np.ndarray] = None
+        self._entries: OrderedDict[int, _Entry] = OrderedDict()
+        self._buckets: dict[int, set[int]] = {}
+        self._next_id = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+            self._generation += 1
+
+    def _keys(self, directions: np.ndarray) -> list[int]:
+        if self._planes is None or self._planes.shape[1] != directions.shape[1]:
+            self._planes = np.random.default_rng(self.seed).standard_normal(
+                (self.bits, directions.shape[1])
+            ).astype(np.float32)
+        signs = (directions @ self._planes.T) > 0
+        weights = 1 << np.arange(self.bits, dtype=np.int64)
+        return (signs.astype(np.int64) @ weights).tolist()
+
+    def _drop(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id)
+        bucket = self._buckets[entry.key]
+        bucket.discard(entry_id)
+        if not bucket:
+            del self._buckets[entry.key]
+
+    def _find(self, lookup: _Lookup, n_results: int, now: float) -> Optional[MatchedResult]:
+        best, best_similarity = None, self.threshold
+        # buckets one bit apart catch similar queries split by a hyperplane
+        for key in (lookup.key, *(lookup.key ^ (1 << bit) for bit in range(self.bits))):
+            for entry_id in list(self._buckets.get(key, ())):
+                entry = self._entries[entry_id]
+                if self.ttl is not None and now - entry.created > self.ttl:
+                    self._drop(entry_id)
+                    self.stats.expirations += 1
+                    continue
+                if entry.where != lookup.where or (entry.n_results < n_results and not entry.complete):
+                    continue
+                similarity = float(entry.direction @ lookup.direction)
+                if similarity >= best_similarity:
+                    best, best_similarity = entry_id, similarity
+        if best is None:
+            return None
+        self._entries.move_to_end(best)
+        result = self._entries[best].result
+        return replace(
+            result,
+            **{
+                name: getattr(result, name)[:n_results]
+                for name in ("ids", "embeddings", "documents", "metadatas", "distances")
+                if getattr(result, name) is not None
+            },
+        )
+
+    def lookup(self, embeddings: Sequence[Embedding], n_results: int, where: Optional[Where] = None) -> list[_Lookup]:
+        """
+        Find cached results of queries
+
+        :param embeddings: query embeddings
+        :param n_results: number of matches asked for
+        :param where: metadata filter of query
+        :return: lookup of each query, with result if it was cached
+        """
+        queries = as_matrix(embeddings)
+        directions = unit(queries)
+        canonical = json.dumps(where, sort_keys=True) if where else None
+        with self._lock:
+            keys = self._keys(directions)
+            now = time.monotonic()
+            lookups = []
+            for query, direction, key in zip(queries, directions, keys):
+                lookup = _Lookup(query, direction, key, canonical, self._generation)
+                lookup.result = self._find(lookup, n_results, now)
+                if lookup.result is None:
+                    self.stats.misses += 1
+                else:
+                    self.stats.hits += 1
+                lookups.append(lookup)
+            return lookups
+
+    def put(self, lookups: Iterable[_Lookup], n_results: int, results: Iterable[MatchedResult]) -> None:
+        """
+        Cache results of missed lookups
+
+        :param lookups: missed lookups
+        :param n_results: number of matches asked for
+        :param results: storage result of each lookup
+        """
+        with self._lock:
+            now = time.monotonic()
+            for lookup, result in zip(lookups, results):
+                if lookup.generation != self._generation:
+                    # write happened meanwhile, result may miss the new document
+                    continue
+                entry_id = self._next_id
+                self._next_id += 1
+                self._entries[entry_id] = _Entry(
+                    lookup.key, lookup.query, lookup.direction, n_results, lookup.where, result, now,
+                )
+                self._buckets.setdefault(lookup.key, set()).add(entry_id)
+                while len(self._entries) > self.max_entries:
+                    self._drop(next(iter(self._entries)))
+                    self.stats.evictions += 1
+
+    def invalidate(self, embeddings: Sequence[Embedding]) -> int:
+        """
+        Drop cached results which added documents could enter
+
+        :param embeddings: embeddings of added documents
+        :return: number of dropped results
+        """
+        vectors = as_matrix(embeddings)
+        with self._lock:
+            self._generation += 1
+            if not self._entries or not len(vectors):
+                return 0
+            entry_ids = list(self._entries)
+            entries = [self._entries[entry_id] for entry_id in entry_ids]
+            queries = np.stack([entry.query for entry in entries])
+            nearest = space_distances(self.space or "l2", queries, vectors).min(axis=1)
+            dropped = 0
+            for entry_id, entry, distance in zip(entry_ids, entries, nearest):
+                if entry.complete or distance <= entry.result.distances[-1] + self.margin:
+                    self._drop(entry_id)
+                    dropped += 1
+            self.stats.invalidations += dropped
+            return dropped
+
+    def discard(self, doc_ids: Iterable[ID]) -> int:
+        """
+        Drop cached results holding removed documents
+
+        :param doc_ids: ids of removed documents
+        :return: number of dropped results
+        """
+        removed = set(doc_ids)
+        with self._lock:
+            self._generation += 1
+            doomed = [
+                entry_id for entry_id, entry in self._entries.items()
+                if not removed.isdisjoint(entry.result.ids or ())
+            ]
+            for entry_id in doomed:
+                self._drop(entry_id)
+            self.stats.invalidations += len(doomed)
+            return len(doomed)
+
+
+class CachedVectorStorage:
+    """
+    `VectorStorage` with semantic cache of queries, drop-in for `Episodic` and recall.
+
+    storage = CachedVectorStorage(VectorStorage(client=LocalClient()), RecallCache(threshold=0.97, ttl=600))
+    memory = Episodic(embedder, storage)
+    storage.cache.stats.hit_rate
+    """
+
+    def __init__(self, storage: VectorStorage, cache: Optional[RecallCache] = None) -> None:
+        """
+        Wrap storage
+
+        :param storage: vector database
+        :param cache: cache of queries, default cache if not set
+        """
+        self.storage = storage
+        self.cache = cache if cache is not None else RecallCache()
+        if self.cache.space is None:
+            self.cache.space = self.space_of(storage)
+
+    @staticmethod
+    def space_of(storage: VectorStorage) -> str:
+        """Distance function of storage collection"""
+        if isinstance(storage.collection, LocalCollection):
+            return storage.collection.space
+        return (storage.collection.metadata or {}).get("hnsw:space", "l2")
+
+    @property
+    def client(self):
+        return self.storage.client
+
+    @property
+    def collection(self):
+        return self.storage.collection
+
+    def get(self, doc_id: ID) -> MatchedResult:
+        return self.storage.get(doc_id)
+
+    def get_many(self, doc_ids: Sequence[ID], include: Include = EVERYTHING) -> MatchedResult:
+        return self.storage.get_many(doc_ids, include)
+
+    def iter_all(self, batch_size: int = 10_000, include: Include = EVERYTHING) -> Iterator[MatchedResult]:
+        # export reads storage as it is, cache is neither used nor filled
+        return self.storage.iter_all(batch_size, include)
+
+    def upsert_many(
+            self,
+            doc_ids: Sequence[ID],
+            embeddings: Sequence[Embedding],
+            documents: Sequence[Optional[Document]],
+            metadatas: Optional[Sequence[Optional[Metadata]]] = None,
+    ) -> None:
+        """
+        Write documents under given ids and drop cached results they could enter or which hold replaced documents.
+
+        :param doc_ids: ids of documents
+        :param embeddings: embeddings of documents
+        :param documents: texts of documents
+        :param metadatas: metadata of each document, none if not set
+        """
+        try:
+            self.storage.upsert_many(doc_ids, embeddings, documents, metadatas)
+        finally:
+            self.cache.invalidate(embeddings)
+            self.cache.discard(doc_ids)
+
+    def update_metadatas(self, doc_ids: Sequence[ID], metadatas: Sequence[Metadata]) -> None:
+        # cached results hold documents and distances only
+        self.storage.update_metadatas(doc_ids, metadatas)
+
+    def delete_many(self, doc_ids: Sequence[ID]) -> None:
+        """
+        Remove documents and drop cached results holding them.
+
+        :param doc_ids: ids of removed documents
+        """
+        try:
+            self.storage.delete_many(doc_ids)
+        finally:
+            self.cache.discard(doc_ids)
+
+    def query(self, embedding: Embedding, n_results: int = 17) -> list[Document]:
+        """
+        Find similar document.
+
+        :param embedding: search docs near this vector
+        :param n_results: max limit returned doc number
+        :return: documents
+        """
+        return self.nearest(embedding, n_results).documents
+
+    def nearest(self, embedding: Embedding, n_results: int = 17) -> MatchedResult:
+        """
+        Find similar documents with their ids and distances.
+
+        :param embedding: search docs near this vector
+        :param n_results: max limit returned doc number
+        :return: matched documents ordered by distance
+        """
+        return self.query_many([embedding], n_results)[0]
+
+    def query_many(
+            self,
+            embeddings: Sequence[Embedding],
+            n_results: int = 17,
+            where: Optional[Where] = None,
+    ) -> list[MatchedResult]:
+        """
+        Find similar documents of many embeddings, only queries missing in cache go to storage in single request.
+
+        :param embeddings: search docs near each of these vectors
+        :param n_results: max limit returned doc number per embedding
+        :param where: metadata filter, e.g. {"author": "Valji"}
+        :return: matched ids, documents and distances of each embedding, in the same order as embeddings
+        """
+        if len(embeddings) == 0:
+            return []
+        lookups = self.cache.lookup(embeddings, n_results, where)
+        missed = [index for index, lookup in enumerate(lookups) if lookup.result is None]
+        if missed:
+            found = self.storage.query_many([embeddings[index] for index in missed], n_results, where)
+            self.cache.put([lookups[index] for index in missed], n_results, found)
+            for index, result in zip(missed, found):
+                lookups[index].result = result
+        return [lookup.result for lookup in lookups]
+
+    def add(self, embedding: Embedding, document: Document) -> ID:
+        """
+        Insert embedded document and drop cached results it could enter.
+
+        :param embedding: embedding of given document
+        :param document: insert this text
+        :return: document id
+        """
+        return self.add_many([embedding], [document])[0]
+
+    def add_many(
+            self,
+            embeddings: Sequence[Embedding],
+            documents: Sequence[Document],
+            metadatas: Optional[Sequence[Metadata]] = None,
+    ) -> list[ID]:
+        """
+        Insert many embedded documents and drop cached results they could enter.
+
+        :param embeddings: embeddings of given documents
+        :param documents: insert these texts
+        :param metadatas: metadata of each document, none if not set
+        :return: document ids in the same order as documents
+        """
+        try:
+            return self.storage.add_many(embeddings, documents, metadatas)
+        finally:
+            self.cache.invalidate(embeddings)
@@ -1,4 +1,107 @@
-from neo4j import GraphDatabase
+import contextlib
+import datetime as dt
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional, Sequence, Iterator
+
+from neo4j import GraphDatabase, Session, Transaction, unit_of_work
+
+from ..instrumentation import instrumented, single, text_bytes
+
+DEFAULT_CACHE_SIZE = 4096
+DEFAULT_PAGE_SIZE = 10_000
+DEFAULT_FANOUT = 32
+# timeout 0 lets transaction run forever, spent budget is rounded up to this
+MIN_TIMEOUT = 0.001
+_IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+@dataclass(slots=True)
+class Fact:
+    text: str  # textual content of fact
+    embedding_id: Optional[str] = None  # id of fact vector in vector storage, vectors are not copied to graph
+    entities: list[tuple[str, Optional[str]]] = field(default_factory=list)  # (entity text, role in fact)
+    predicates: list[str] = field(default_factory=list)  # texts of predicates
+
+
+def _consume(tx: Transaction, query: str, parameters: Optional[dict]) -> list:
+    # result has to be consumed before transaction closes
+    return list(tx.run(query, parameters))
+
+
+def identifier(name: Optional[str]) -> str:
+    """
+    Label or relationship type checked before it is put into query, they cannot be query parameters
+
+    :param name: label or type
+    :return: ":name" or empty string for no label
+    """
+    if not name:
+        return ""
+    if not _IDENTIFIER.fullmatch(name):
+        raise ValueError(f"invalid label or relationship type {name!r}")
+    return f":{name}"
+
+
+class NodeCache:
+    """
+    Bounded LRU mapping of (label, text) to (id, element id) of node.
+
+    Entries are dropped by element id when their nodes are deleted, id of deleted node can be reused by new one.
+    """
+
+    def __init__(self, max_items: int = DEFAULT_CACHE_SIZE) -> None:
+        self.max_items = max_items
+        self._items: OrderedDict[tuple[str, str], tuple[int, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: tuple[str, str]) -> Optional[tuple[int, str]]:
+        with self._lock:
+            node = self._items.get(key)
+            if node is not None:
+                self._items.move_to_end(key)
+            return node
+
+    def update(self, items: dict[tuple[str, str], tuple[int, str]]) -> None:
+        with self._lock:
+            for key, node in items.items():
+                self._items[key] = node
+                self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def discard(self, element_ids: set[str]) -> None:
+        with self._lock:
+            for key in [key for key, node in self._items.items() if node[1] in element_ids]:
+                del self._items[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+
+class UnitOfWork:
+    """
+    Many statements in one session and one write transaction.
+
+    Nodes found inside unit are published to shared cache only after commit, rolled back nodes never leak.
+    """
+    session: Session
+    tx: Transaction
+    created: dict[tuple[str, str], tuple[int, str]]
+
+    def __init__(self, session: Session) -> None:
+        self.session = session
+        self.tx = session.begin_transaction()
+        self.created = {}
+
+    def run(self, query: str, parameters: Optional[dict] = None) -> list:
+        return _consume(self.tx, query, parameters)
 
 
 class GraphDB:
@@ -10,7 +113,7 @@ class GraphDB:
     Predicate: Represents the predicate of a sentence. This node can have properties like text (the textual content
         of the predicate).
     Fact: Represents a fact from the original text. This node can have properties like text (the
-        textual content of the fact) and embedding (the corresponding embedding).
+        textual content of the fact) and embedding_id (id of the corresponding embedding in vector storage).
     Record: Represents a series of facts that belong to a single message or context. This node can have properties like
         text (the textual content of the record).
 
@@ -37,8 +140,8 @@ class GraphDB:
         Entity5: {text: "Mary"},
         Predicate1: {text: "bought"},
         Predicate2: {text: "gave"},
-        Fact1: {text: "John bought a book", embedding: [...]},
-        Fact2: {text: "He gave it to Mary", embedding: [...]},
+        Fact1: {text: "John bought a book", embedding_id: "3f1d..."},
+        Fact2: {text: "He gave it to Mary", embedding_id: "a07c..."},
         Record1: {text: "John bought a book. He gave it to Mary."},
     Relationships:
         Fact1 -[NEXT]-> Fact2,
@@ -56,36 +159,92 @@ class GraphDB:
     such as the fact that all the facts are part record.
     """
 
-    def __init__(self, uri, user, password):
+    def __init__(self, uri, user, password, cache_size: int = DEFAULT_CACHE_SIZE):
+        """
+        Connect to database.
+
+        Ids of hot entities and predicates are cached client side, `find_or_create_entity` of cached text makes
+        no round trip. Cache knows only deletes made through `delete_by_text` of this instance.
+
+        :param cache_size: max number of entity and predicate nodes remembered client side
+        """
         self._driver = GraphDatabase.driver(uri, auth=(user, password))
-        self._insert_fact_query = '''
-            CREATE (f:Fact {text: $fact_text, embedding: $embedding})
-            WITH f
-            UNWIND $entities as entity
-            MATCH (e:Entity) WHERE id(e) = entity.id
-            CREATE (e)-[:PART_OF {role: entity.role}]->(f)
-            WITH f
-            UNWIND $predicates as predicate_id
-            MATCH (p:Predicate) WHERE id(p) = predicate_id
-            CREATE (p)-[:PART_OF]->(f)
-        '''
+        self.node_cache = NodeCache(cache_size)
+        self._local = threading.local()
 
     def close(self):
         self._driver.close()
 
-    def _execute_query(self, query, parameters=None, write=False):
+    @property
+    def _unit(self) -> Optional[UnitOfWork]:
+        return getattr(self._local, "unit", None)
+
+    @contextlib.contextmanager
+    def batch(self) -> Iterator[UnitOfWork]:
+        """
+        Run all queries of this thread inside the block in single session and transaction.
+
+        with graph.batch() as tx:
+            graph.insert_fact(...)
+            graph.bind_facts_to_record(...)
+
+        Transaction is committed at the end of block, or rolled back if block raises. Nested blocks join outer one.
+        """
+        unit = self._unit
+        if unit is not None:
+            yield unit
+            return
         with self._driver.session() as session:
-            if write:
-                result = session.write_transaction(lambda tx: tx.run(query, parameters))
+            unit = UnitOfWork(session)
+            self._local.unit = unit
+            try:
+                yield unit
+            except BaseException:
+                unit.tx.rollback()
+                raise
             else:
-                result = session.read_transaction(lambda tx: tx.run(query, parameters))
-            return list(result)
+                unit.tx.commit()
+                self.node_cache.update(unit.created)
+            finally:
+                self._local.unit = None
+                unit.tx.close()
+
+    @instrumented("graph.execute_query", "query", single, text_bytes)
+    def _execute_query(self, query, parameters=None, write=False, timeout=None):
+        unit = self._unit
+        if unit is not None:
+            # transaction of unit is already open, its timeout cannot change
+            return unit.run(query, parameters)
+        work = _consume if timeout is None else unit_of_work(timeout=max(timeout, MIN_TIMEOUT))(_consume)
+        with self._driver.session() as session:
+            if write:
+                return session.execute_write(work, query, parameters)
+            return session.execute_read(work, query, parameters)
+
+    def _cached_node(self, label: str, text: str, query: str) -> int:
+        key = (label, text)
+        unit = self._unit
+        node = unit.created.get(key) if unit is not None else None
+        if node is None:
+            node = self.node_cache.get(key)
+        if node is not None:
+            return node[0]
+        row = self._execute_query(query, {'text': text}, write=True)[0]
+        node = (row['node_id'], row['element_id'])
+        if unit is None:
+            self.node_cache.update({key: node})
+        else:
+            # node may disappear with rollback, publish it on commit
+            unit.created[key] = node
+        return node[0]
 
     def create_uniqueness_constraints(self):
         constraints = [
             {"name": "unique_entity_text", "label": "Entity", "property": "text"},
             {"name": "unique_predicate_text", "label": "Predicate", "property": "text"},
             {"name": "unique_fact_text", "label": "Fact", "property": "text"},
+            # recall starts graph traversal from facts found in vector storage
+            {"name": "unique_fact_embedding_id", "label": "Fact", "property": "embedding_id"},
             {"name": "unique_record_text", "label": "Record", "property": "text"},
         ]
 
@@ -103,29 +262,26 @@ class GraphDB:
 
     def find_or_create_entity(self, entity_text):
         query = '''
-            MERGE (e:Entity {text: $entity_text})
-            RETURN id(e) as entity_id
+            MERGE (e:Entity {text: $text})
+            RETURN id(e) as node_id, elementId(e) as element_id
         '''
-        parameters = {'entity_text': entity_text}
-        result = self._execute_query(query, parameters)
-        return result[0]['entity_id']
+        return self._cached_node('Entity', entity_text, query)
 
     def find_or_create_predicate(self, predicate_text: str) -> int:
         query = '''
-            MERGE (p:Predicate {text: $predicate_text})
-            RETURN id(p) as predicate_id
+            MERGE (p:Predicate {text: $text})
+            RETURN id(p) as node_id, elementId(p) as element_id
         '''
-        parameters = {'predicate_text': predicate_text}
-        result = self._execute_query(query, parameters)
-        return result[0]['predicate_id']
+        return self._cached_node('Predicate', predicate_text, query)
 
-    def find_or_create_fact(self, fact_text: str, embedding: list[float]) -> int:
+    def find_or_create_fact(self, fact_text: str, embedding_id: Optional[str] = None) -> int:
         query = '''
-            MERGE (f:Fact {text: $fact_text, embedding: $embedding})
+            MERGE (f:Fact {text: $fact_text})
+            ON CREATE SET f.embedding_id = $embedding_id
             RETURN id(f) as fact_id
         '''
-        parameters = {'fact_text': fact_text, 'embedding': embedding}
-        result = self._execute_query(query, parameters)
+        parameters = {'fact_text': fact_text, 'embedding_id': embedding_id}
+        result = self._execute_query(query, parameters, write=True)
         return result[0]['fact_id']
 
     def find_or_create_record(self, record_text: str) -> int:
@@ -134,36 +290,288 @@ class GraphDB:
             RETURN id(r) as record_id
         '''
         parameters = {'record_text': record_text}
-        result = self._execute_query(query, parameters)
+        result = self._execute_query(query, parameters, write=True)
         return result[0]['record_id']
 
-    def insert_fact(self, fact_text: str, embedding: list[float], entities: list[str], predicates: list[str]):
+    def insert_fact(
+            self,
+            fact_text: str,
+            embedding_id: Optional[str],
+            entities: list[str],
+            predicates: list[str],
+    ) -> int:
+        """
+        Insert one fact, its entities have no role. Use `insert_facts` for more facts.
+
+        :param embedding_id: id of fact vector in vector storage
+        :return: fact id
+        """
+        fact = Fact(
+            text=fact_text,
+            embedding_id=embedding_id,
+            entities=[(entity, None) for entity in entities],
+            predicates=list(predicates),
+        )
+        return self.insert_facts([fact])[0]
+
+    @instrumented("graph.insert_facts", "facts")
+    def insert_facts(
+            self,
+            facts: Sequence[Fact],
+            timestamp: Optional[dt.datetime] = None,
+            author: Optional[str] = None,
+            chronicle_id: Optional[int] = None,
+    ) -> list[int]:
+        """
+        Insert many facts with their entities and predicates in single transaction.
+
+        Entities and predicates are merged, existing nodes are reused. If timestamp is given, facts are bound
+        to new Record with CONTAINS and chained with NEXT in given order within the same transaction. Fact repeated
+        in facts is one node, bound to record once and chained at its first position.
+
+        :param facts: facts to insert
+        :param timestamp: create record of facts with this timestamp
+        :param author: text of entity authoring the record, used only with timestamp
+        :param chronicle_id: id of source text in Chronicle stored on the record, used only with timestamp
+        :return: fact ids in the same order as facts
+        """
+        if not facts and timestamp is None:
+            return []
+        # MERGE of the same text twice in one query yields the node twice, record would contain it twice
+        # and NEXT chain would loop, so repeated facts are sent once with entities and predicates of all copies
+        unique: dict[str, dict] = {}
+        for fact in facts:
+            entry = unique.setdefault(fact.text, {
+                'index': len(unique),
+                'text': fact.text,
+                'embedding_id': fact.embedding_id,
+                'entities': [],
+                'predicates': [],
+            })
+            if entry['embedding_id'] is None:
+                entry['embedding_id'] = fact.embedding_id
+            for text, role in fact.entities:
+                if {'text': text, 'role': role} not in entry['entities']:
+                    entry['entities'].append({'text': text, 'role': role})
+            for predicate in fact.predicates:
+                if predicate not in entry['predicates']:
+                    entry['predicates'].append(predicate)
         query = '''
-            CREATE (f:Fact {text: $fact_text, embedding: $embedding})
-            WITH f
-            UNWIND $entities as entity_id
-            MATCH (e:Entity) WHERE id(e) = entity_id
-            CREATE (e)-[:PART_OF {role: entity.role}]->(f)
-            WITH f
-            UNWIND $predicates as predicate_id
-            MATCH (p:Predicate) WHERE id(p) = predicate_id
-            CREATE (p)-[:PART_OF]->(f)
-            RETURN id(f) as fact_id
+            UNWIND $facts AS fact
+            MERGE (f:Fact {text: fact.text})
+            ON CREATE SET f.embedding_id = fact.embedding_id
+            WITH f, fact
+            CALL {
+                WITH f, fact
+                UNWIND fact.entities AS entity
+                MERGE (e:Entity {text: entity.text})
+                WITH e, f, entity
+                // role is part of pattern, entity filling two roles of one fact keeps both relationships,
+                // merge cannot match null property, so entity without role has its own branch
+                FOREACH (_ IN CASE WHEN entity.role IS NULL THEN [1] ELSE [] END |
+                    MERGE (e)-[:PART_OF]->(f)
+                )
+                FOREACH (role IN CASE WHEN entity.role IS NULL THEN [] ELSE [entity.role] END |
+                    MERGE (e)-[:PART_OF {role: role}]->(f)
+                )
+            }
+            CALL {
+                WITH f, fact
+                UNWIND fact.predicates AS predicate
+                MERGE (p:Predicate {text: predicate})
+                MERGE (p)-[:PART_OF]->(f)
+            }
+            WITH f, fact
+            ORDER BY fact.index
+            WITH collect(f) AS facts, collect(id(f)) AS fact_ids
+        '''
+        parameters = {'facts': list(unique.values())}
+        if timestamp is not None:
+            query += '''
+                CREATE (r:Record {timestamp: $timestamp, chronicle_id: $chronicle_id})
+                WITH r, facts, fact_ids
+                CALL {
+                    WITH r, facts
+                    UNWIND facts AS f
+                    CREATE (r)-[:CONTAINS]->(f)
+                }
+                CALL {
+                    WITH facts
+                    UNWIND range(0, size(facts) - 2) AS i
+                    WITH facts[i] AS current, facts[i + 1] AS following
+                    MERGE (current)-[:NEXT]->(following)
+                }
+            '''
+            parameters['timestamp'] = timestamp
+            parameters['chronicle_id'] = chronicle_id
+            if author:
+                query += '''
+                    CALL {
+                        WITH r
+                        MERGE (e:Entity {text: $author})
+                        CREATE (r)-[:AUTHOR]->(e)
+                    }
+                '''
+                parameters['author'] = author
+        query += '''
+            RETURN fact_ids
+        '''
+        result = self._execute_query(query, parameters, write=True)
+        fact_ids = result[0]['fact_ids']
+        return [fact_ids[unique[fact.text]['index']] for fact in facts]
+
+    @instrumented("graph.neighbors", "embedding_ids")
+    def neighbors(
+            self,
+            embedding_ids: Sequence[str],
+            hops: int = 2,
+            limit: int = 100,
+            fanout: int = DEFAULT_FANOUT,
+            timeout: Optional[float] = None,
+    ) -> list[dict]:
+        """
+        Facts and records reachable from facts of given vectors through PART_OF, NEXT and CONTAINS.
+
+        Facts sharing entity or predicate are two hops apart, record containing fact is one hop from it. Nodes are
+        expanded level by level and each node visited once per seed, at most `fanout` relationships of every node are
+        followed, so entity shared by thousands of facts does not blow up traversal like enumeration of all paths.
+
+        :param embedding_ids: ids of seed facts in vector storage
+        :param hops: max length of path, 1 or 2 keeps traversal cheap enough for every turn
+        :param limit: max number of returned nodes, the closest first
+        :param fanout: max number of neighbors followed from each node
+        :param timeout: seconds the database may spend on query, server default if not set
+        :return: rows with seed embedding_id, label "Fact" or "Record", text, chronicle_id, hops and
+            chronicle_ids of records containing the node
+        """
+        if not embedding_ids:
+            return []
+        # number of levels cannot be query parameter, one subquery per hop
+        levels = "".join(f'''
+            CALL {{
+                WITH frontier
+                UNWIND frontier AS current
+                CALL {{
+                    WITH current
+                    MATCH (current)-[:PART_OF|NEXT|CONTAINS]-(next)
+                    RETURN DISTINCT next
+                    LIMIT $fanout
+                }}
+                RETURN collect(DISTINCT next) AS reached
+            }}
+            WITH embedding_id, seen, found, [node IN reached WHERE NOT node IN seen] AS frontier
+            WITH embedding_id, seen + frontier AS seen, frontier,
+                found + [node IN frontier | {{node: node, hops: {hop}}}] AS found
+        ''' for hop in range(1, int(hops) + 1))
+        query = f'''
+            UNWIND $embedding_ids AS embedding_id
+            MATCH (seed:Fact {{embedding_id: embedding_id}})
+            WITH embedding_id, [seed] AS frontier, [seed] AS seen, [{{node: seed, hops: 0}}] AS found
+            {levels}
+            UNWIND found AS hit
+            WITH embedding_id, hit.node AS node, hit.hops AS hops
+            WHERE node:Fact OR node:Record
+            RETURN
+                embedding_id,
+                CASE WHEN node:Fact THEN 'Fact' ELSE 'Record' END AS label,
+                node.text AS text,
+                node.chronicle_id AS chronicle_id,
+                hops,
+                [(record:Record)-[:CONTAINS]->(node) | record.chronicle_id] AS chronicle_ids
+            ORDER BY hops
+            LIMIT $limit
+        '''
+        parameters = {'embedding_ids': list(embedding_ids), 'limit': limit, 'fanout': fanout}
+        return [dict(row) for row in self._execute_query(query, parameters, timeout=timeout)]
+
+    def _stream(self, query: str, chunk_size: int) -> Iterator[list[dict]]:
+        # single scan read lazily in pages, paging by id would scan and sort the whole graph for every page
+        unit = self._unit
+        if unit is not None:
+            result = unit.tx.run(query)
+            while page := [dict(row) for row in result.fetch(chunk_size)]:
+                yield page
+            return
+        with self._driver.session() as session:
+            with session.begin_transaction() as tx:
+                result = tx.run(query)
+                while page := [dict(row) for row in result.fetch(chunk_size)]:
+                    yield page
+
+    def iter_nodes(self, chunk_size: int = DEFAULT_PAGE_SIZE) -> Iterator[list[dict]]:
+        """
+        Page through all nodes in storage order, e.g. to export graph.
+
+        :param chunk_size: nodes per page
+        :return: generator of pages, rows with id, label and properties
+        """
+        query = '''
+            MATCH (n)
+            RETURN id(n) AS id, head(labels(n)) AS label, properties(n) AS properties
+        '''
+        return self._stream(query, chunk_size)
+
+    def iter_edges(self, chunk_size: int = DEFAULT_PAGE_SIZE) -> Iterator[list[dict]]:
+        """
+        Page through all relationships in storage order, e.g. to export graph.
+
+        :param chunk_size: relationships per page
+        :return: generator of pages, rows with id, source, type, target and properties
+        """
+        query = '''
+            MATCH (source)-[r]->(target)
+            RETURN id(r) AS id, id(source) AS source, type(r) AS type, id(target) AS target,
+                properties(r) AS properties
+        '''
+        return self._stream(query, chunk_size)
+
+    @instrumented("graph.create_nodes", "properties")
+    def create_nodes(self, label: Optional[str], properties: Sequence[dict]) -> list[int]:
+        """
+        Create nodes of one label as they are, without merge, e.g. to restore snapshot.
+
+        :param label: label of all nodes, no label if empty
+        :param properties: properties of each node
+        :return: ids of created nodes in the same order as properties
+        """
+        if not properties:
+            return []
+        query = f'''
+            UNWIND range(0, size($properties) - 1) AS index
+            CREATE (n{identifier(label)})
+            SET n = $properties[index]
+            WITH index, id(n) AS node_id
+            ORDER BY index
+            RETURN collect(node_id) AS node_ids
+        '''
+        return self._execute_query(query, {'properties': list(properties)}, write=True)[0]['node_ids']
+
+    @instrumented("graph.create_edges", "edges")
+    def create_edges(self, type_: str, edges: Sequence[tuple[int, int, dict]]) -> int:
+        """
+        Create relationships of one type between existing nodes, e.g. to restore snapshot.
+
+        :param type_: relationship type
+        :param edges: (source node id, target node id, properties) of each relationship
+        :return: number of created relationships
+        """
+        if not edges:
+            return 0
+        query = f'''
+            UNWIND $edges AS edge
+            MATCH (source) WHERE id(source) = edge.source
+            MATCH (target) WHERE id(target) = edge.target
+            CREATE (source)-[r{identifier(type_)}]->(target)
+            SET r = edge.properties
+            RETURN count(r) AS created
         '''
-        entity_ids = [
-            self.find_or_create_entity(entity) for entity in entities
-        ]
-        predicate_ids = [
-            self.find_or_create_predicate(predicate) for predicate in predicates
-        ]
         parameters = {
-            'fact_text': fact_text,
-            'embedding': embedding,
-            'entities': entity_ids,
-            'predicates': predicate_ids
+            'edges': [
+                {'source': source, 'target': target, 'properties': properties}
+                for source, target, properties in edges
+            ],
         }
-        result = self._execute_query(query, parameters, write=True)
-        return result[0]['fact_id']
+        return self._execute_query(query, parameters, write=True)[0]['created']
 
     def bind_facts_to_record(self, timestamp, fact_ids: int, author=None) -> int:
         query = '''
@@ -178,8 +586,8 @@ class GraphDB:
         if author:
             query += '''
                 WITH r
-                MATCH (e:Entity {text: author})
-                CREATE (e)-[:AUTHOR]->(r)
+                MERGE (e:Entity {text: $author})
+                CREATE (r)-[:AUTHOR]->(e)
             '''
             parameters['author'] = author
 
@@ -188,3 +596,26 @@ class GraphDB:
         '''
         result = self._execute_query(query, parameters, write=True)
         return result[0]['record_id']
+
+    def delete_by_text(self, label: str, texts: Sequence[str]) -> int:
+        """
+        Delete nodes with given texts together with their relationships and drop them from node cache.
+
+        :param label: label of nodes, e.g. Entity
+        :param texts: texts of nodes to delete
+        :return: number of deleted nodes
+        """
+        query = f'''
+            MATCH (n{identifier(label)}) WHERE n.text IN $texts
+            WITH n, elementId(n) AS element_id
+            DETACH DELETE n
+            RETURN element_id
+        '''
+        result = self._execute_query(query, {'texts': list(texts)}, write=True)
+        element_ids = {row['element_id'] for row in result}
+        # dropped at once, if unit is rolled back later the nodes are only looked up again
+        self.node_cache.discard(element_ids)
+        unit = self._unit
+        if unit is not None:
+            unit.created = {key: node for key, node in unit.created.items() if node[1] not in element_ids}
+        return len(element_ids)
@@ -0,0 +1,535 @@
+import functools
+import json
+import os
+import threading
+from typing import Callable, Optional, Sequence, Any, TypeVar
+
+import numpy as np
+from annoy import AnnoyIndex
+from chromadb.api.types import GetResult, Include, ID, Embedding, Document, Metadata, QueryResult, Where
+
+from .vectors import PRECISIONS, Precision, as_matrix, dequantize, quantize
+
+__all__ = (
+    "LocalClient",
+    "LocalCollection",
+)
+
+DEFAULT_INCLUDE: Include = ["metadatas", "documents", "distances"]
+DEFAULT_SPACE = "l2"
+# below this size exact search over whole matrix is faster than any index
+ANNOY_THRESHOLD = 100_000
+ANNOY_TREES = 32
+# rebuild annoy index once rows added after last build exceed this fraction of indexed rows
+ANNOY_REBUILD_RATIO = 0.1
+ANNOY_METRICS = {"l2": "euclidean", "ip": "dot", "cosine": "angular"}
+DEFAULT_PRECISION = "float32"
+# quantized rows are decoded to float32 in blocks of this many rows
+DECODE_ROWS = 16_384
+
+
+_F = TypeVar("_F", bound=Callable)
+
+
+def synchronized(method: _F) -> _F:
+    """Run method of collection under its lock, writers reallocate matrix and rewrite row lists"""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def as_list(value: Any) -> Optional[list]:
+    """Accept single item same way as chroma does"""
+    if value is None:
+        return None
+    if isinstance(value, (str, dict)):
+        return [value]
+    if isinstance(value, np.ndarray):
+        return [value] if value.ndim == 1 else list(value)
+    value = list(value)
+    if value and isinstance(value[0], (int, float)):
+        # one embedding
+        return [value]
+    return value
+
+
+def matches(metadata: Optional[Metadata], where: Optional[Where]) -> bool:
+    """
+    Evaluate chroma metadata filter on one metadata.
+
+    :param metadata: metadata of document
+    :param where: chroma style where filter
+    :return: True if metadata satisfy filter
+    """
+    if not where:
+        return True
+    metadata = metadata or {}
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(matches(metadata, clause) for clause in condition):
+                return False
+        elif key == "$or":
+            if not any(matches(metadata, clause) for clause in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            for operator, operand in condition.items():
+                if value is None and operator not in ("$ne", "$nin"):
+                    return False
+                if operator == "$eq" and value != operand:
+                    return False
+                if operator == "$ne" and value == operand:
+                    return False
+                if operator == "$gt" and not value > operand:
+                    return False
+                if operator == "$gte" and not value >= operand:
+                    return False
+                if operator == "$lt" and not value < operand:
+                    return False
+                if operator == "$lte" and not value <= operand:
+                    return False
+                if operator == "$in" and value not in operand:
+                    return False
+                if operator == "$nin" and value in operand:
+                    return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+
+class LocalCollection:
+    """
+    In-process vector collection with chroma collection interface.
+
+    Embeddings are kept in one contiguous matrix and searched exactly with vectorized dot products. Matrix is float32,
+    or float16 or int8 with per row scale to take 2 or 4 times less memory and disk, quantized rows are decoded
+    to float32 in blocks while searching. Once collection grows over `annoy_threshold` rows, queries go through
+    annoy index stored next to collection and memory mapped, rows added after last index build are still searched
+    exactly.
+    """
+    name: str
+    space: str
+
+    def __init__(
+            self,
+            name: str,
+            space: str = DEFAULT_SPACE,
+            path: Optional[str] = None,
+            annoy_threshold: int = ANNOY_THRESHOLD,
+            annoy_trees: int = ANNOY_TREES,
+            precision: Precision = DEFAULT_PRECISION,
+    ) -> None:
+        """
+        Set up empty collection or load persisted one.
+
+        :param name: collection name
+        :param space: distance function "l2", "ip" or "cosine" same as chroma hnsw:space
+        :param path: directory for persisted files, in memory only if not set
+        :param annoy_threshold: min collection size to query through annoy index
+        :param annoy_trees: number of annoy trees, more is precise and slower to build
+        :param precision: stored precision of embeddings "float32", "float16" or "int8"
+        """
+        if space not in ANNOY_METRICS:
+            raise ValueError(f"unsupported space {space!r}, use one of {', '.join(ANNOY_METRICS)}")
+        if precision not in PRECISIONS:
+            raise ValueError(f"unsupported precision {precision!r}, use one of {', '.join(PRECISIONS)}")
+        self.name = name
+        self.space = space
+        self.path = path
+        self.annoy_threshold = annoy_threshold
+        self.annoy_trees = annoy_trees
+        self.precision = precision
+        self._ids: list[ID] = []
+        self._rows: dict[ID, int] = {}
+        self._documents: list[Optional[Document]] = []
+        self._metadatas: list[Optional[Metadata]] = []
+        self._matrix = np.empty((0, 0), dtype=PRECISIONS[precision])
+        # dequantization scale of each int8 row
+        self._scales = np.empty(0, dtype=np.float32)
+        self._sq_norms = np.empty(0, dtype=np.float32)
+        self._annoy: Optional[AnnoyIndex] = None
+        self._annoy_rows = 0
+        # reentrant, add and update write through upsert
+        self._lock = threading.RLock()
+        if path and os.path.exists(self._file("json")):
+            self._load()
+
+    def _file(self, extension: str) -> str:
+        return os.path.join(self.path, f"{self.name}.{extension}")
+
+    @synchronized
+    def count(self) -> int:
+        return len(self._ids)
+
+    @property
+    @synchronized
+    def embeddings(self) -> np.ndarray:
+        """Copy of stored embeddings as float32, row i belongs to i-th id"""
+        vectors = self._decode(slice(0, len(self._ids)))
+        # float32 rows are view of matrix, writers change them once lock is released
+        return vectors.copy() if self.precision == DEFAULT_PRECISION else vectors
+
+    @property
+    @synchronized
+    def nbytes(self) -> int:
+        """Memory taken by stored embeddings"""
+        size = len(self._ids)
+        return self._matrix[:size].nbytes + (self._scales[:size].nbytes if self.precision == "int8" else 0)
+
+    def _decode(self, rows: slice | np.ndarray) -> np.ndarray:
+        return dequantize(self._matrix[rows], self._scales[rows] if self.precision == "int8" else None)
+
+    def _blocks(self, rows: slice | np.ndarray) -> list[slice | np.ndarray]:
+        if self.precision == DEFAULT_PRECISION:
+            return [rows]
+        if isinstance(rows, slice):
+            return [
+                slice(start, min(start + DECODE_ROWS, rows.stop)) for start in range(rows.start, rows.stop, DECODE_ROWS)
+            ]
+        return [rows[start:start + DECODE_ROWS] for start in range(0, len(rows), DECODE_ROWS)]
+
+    def _reserve(self, rows: int, dim: int) -> None:
+        if self._matrix.shape[1] not in (0, dim):
+            raise ValueError(f"embedding dimension {dim} does not match collection dimension {self._matrix.shape[1]}")
+        if rows <= self._matrix.shape[0]:
+            return
+        capacity = max(rows, 2 * self._matrix.shape[0], 1024)
+        matrix = np.empty((capacity, dim), dtype=self._matrix.dtype)
+        scales = np.empty(capacity if self.precision == "int8" else 0, dtype=np.float32)
+        sq_norms = np.empty(capacity, dtype=np.float32)
+        size = len(self._ids)
+        if size:
+            matrix[:size] = self._matrix[:size]
+            if self.precision == "int8":
+                scales[:size] = self._scales[:size]
+            sq_norms[:size] = self._sq_norms[:size]
+        self._matrix = matrix
+        self._scales = scales
+        self._sq_norms = sq_norms
+
+    @synchronized
+    def add(
+            self,
+            ids: ID | Sequence[ID],
+            embeddings: Embedding | Sequence[Embedding],
+            metadatas: Optional[Metadata | Sequence[Metadata]] = None,
+            documents: Optional[Document | Sequence[Document]] = None,
+    ) -> None:
+        ids = as_list(ids)
+        duplicates = [id_ for id_ in ids if id_ in self._rows]
+        if duplicates or len(set(ids)) != len(ids):
+            raise ValueError(f"ids already exist: {duplicates or ids}")
+        self.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=documents)
+
+    @synchronized
+    def upsert(
+            self,
+            ids: ID | Sequence[ID],
+            embeddings: Embedding | Sequence[Embedding],
+            metadatas: Optional[Metadata | Sequence[Metadata]] = None,
+            documents: Optional[Document | Sequence[Document]] = None,
+    ) -> None:
+        ids = as_list(ids)
+        if not isinstance(embeddings, np.ndarray):
+            embeddings = as_list(embeddings)
+        data, scales = quantize(as_matrix(embeddings).reshape(len(ids), -1), self.precision)
+        # norms of stored values, distances stay consistent with quantized rows
+        vectors = dequantize(data, scales)
+        metadatas = as_list(metadatas) or [None] * len(ids)
+        documents = as_list(documents) or [None] * len(ids)
+        if not len(ids) == len(metadatas) == len(documents):
+            raise ValueError("ids, embeddings, metadatas and documents must have the same length")
+        self._reserve(len(self._ids) + len(ids), vectors.shape[1])
+        for index, (id_, vector, metadata, document) in enumerate(zip(ids, vectors, metadatas, documents)):
+            row = self._rows.get(id_)
+            if row is None:
+                row = self._rows[id_] = len(self._ids)
+                self._ids.append(id_)
+                self._documents.append(document)
+                self._metadatas.append(metadata)
+            else:
+                self._documents[row] = document
+                self._metadatas[row] = metadata
+                if row < self._annoy_rows:
+                    # indexed vector changed, index is no longer valid
+                    self._annoy = None
+                    self._annoy_rows = 0
+            self._matrix[row] = data[index]
+            if scales is not None:
+                self._scales[row] = scales[index]
+            self._sq_norms[row] = vector @ vector
+
+    @synchronized
+    def update(
+            self,
+            ids: ID | Sequence[ID],
+            embeddings: Optional[Embedding | Sequence[Embedding]] = None,
+            metadatas: Optional[Metadata | Sequence[Metadata]] = None,
+            documents: Optional[Document | Sequence[Document]] = None,
+    ) -> None:
+        ids = as_list(ids)
+        missing = [id_ for id_ in ids if id_ not in self._rows]
+        if missing:
+            raise ValueError(f"ids do not exist: {missing}")
+        rows = [self._rows[id_] for id_ in ids]
+        if embeddings is not None:
+            self.upsert(
+                ids=ids,
+                embeddings=embeddings,
+                metadatas=[self._metadatas[row] for row in rows],
+                documents=[self._documents[row] for row in rows],
+            )
+        for row, metadata in zip(rows, as_list(metadatas) or []):
+            self._metadatas[row] = metadata
+        for row, document in zip(rows, as_list(documents) or []):
+            self._documents[row] = document
+
+    @synchronized
+    def delete(self, ids: Optional[Sequence[ID]] = None, where: Optional[Where] = None) -> None:
+        if ids is None and where is None:
+            return
+        candidates = as_list(ids) if ids is not None else list(self._ids)
+        doomed = {
+            id_ for id_ in candidates
+            if id_ in self._rows and matches(self._metadatas[self._rows[id_]], where)
+        }
+        if not doomed:
+            return
+        keep = [row for row, id_ in enumerate(self._ids) if id_ not in doomed]
+        size = len(keep)
+        self._matrix[:size] = self._matrix[keep]
+        if self.precision == "int8":
+            self._scales[:size] = self._scales[keep]
+        self._sq_norms[:size] = self._sq_norms[keep]
+        self._ids = [self._ids[row] for row in keep]
+        self._documents = [self._documents[row] for row in keep]
+        self._metadatas = [self._metadatas[row] for row in keep]
+        self._rows = {id_: row for row, id_ in enumerate(self._ids)}
+        # rows moved, annoy item numbers do not match anymore
+        self._annoy = None
+        self._annoy_rows = 0
+
+    def _select(self, rows: Sequence[int], include: Include) -> dict:
+        result = {"ids": [self._ids[row] for row in rows]}
+        for key in ("embeddings", "documents", "metadatas"):
+            result[key] = None
+        if "embeddings" in include:
+            result["embeddings"] = self._decode(np.asarray(rows, dtype=np.int64)).tolist()
+        if "documents" in include:
+            result["documents"] = [self._documents[row] for row in rows]
+        if "metadatas" in include:
+            result["metadatas"] = [self._metadatas[row] for row in rows]
+        return result
+
+    @synchronized
+    def get(
+            self,
+            ids: Optional[ID | Sequence[ID]] = None,
+            where: Optional[Where] = None,
+            limit: Optional[int] = None,
+            offset: Optional[int] = None,
+            include: Include = ("metadatas", "documents"),
+    ) -> GetResult:
+        if ids is None:
+            rows = range(len(self._ids))
+        else:
+            rows = [self._rows[id_] for id_ in as_list(ids) if id_ in self._rows]
+        if where:
+            rows = [row for row in rows if matches(self._metadatas[row], where)]
+        # range is sliced lazily, paging through whole collection stays linear
+        rows = rows[offset or 0:]
+        if limit is not None:
+            rows = rows[:limit]
+        return self._select(list(rows), include)
+
+    def _distances(self, queries: np.ndarray, rows: slice | np.ndarray) -> np.ndarray:
+        """Exact distances, shape (len(queries), len(rows))"""
+        if self.precision == DEFAULT_PRECISION:
+            dots = queries @ self._matrix[rows].T
+        else:
+            dots = np.concatenate([queries @ self._decode(block).T for block in self._blocks(rows)], axis=1)
+        if self.space == "ip":
+            return 1.0 - dots
+        if self.space == "cosine":
+            norms = np.sqrt(self._sq_norms[rows])[None, :] * np.linalg.norm(queries, axis=1)[:, None]
+            return 1.0 - dots / np.maximum(norms, np.finfo(np.float32).tiny)
+        return np.maximum(self._sq_norms[rows][None, :] - 2.0 * dots + (queries * queries).sum(axis=1)[:, None], 0.0)
+
+    def _annoy_distance(self, distance: float) -> float:
+        """Convert annoy distance to chroma distance of the same space"""
+        if self.space == "ip":
+            return 1.0 - distance
+        if self.space == "cosine":
+            return distance * distance / 2.0
+        return distance * distance
+
+    def _build_annoy(self) -> None:
+        size = len(self._ids)
+        index = AnnoyIndex(self._matrix.shape[1], ANNOY_METRICS[self.space])
+        for block in self._blocks(slice(0, size)):
+            for row, vector in zip(range(block.start, block.stop), self._decode(block)):
+                index.add_item(row, vector)
+        index.build(self.annoy_trees)
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+            index.save(self._file("ann.tmp"))
+            index.unload()
+            os.replace(self._file("ann.tmp"), self._file("ann"))
+            index = AnnoyIndex(self._matrix.shape[1], ANNOY_METRICS[self.space])
+            # memory mapped, pages are shared between processes of the same agent
+            index.load(self._file("ann"))
+        self._annoy = index
+        self._annoy_rows = size
+
+    def _use_annoy(self) -> bool:
+        size = len(self._ids)
+        if size < self.annoy_threshold:
+            return False
+        if self._annoy is None or size - self._annoy_rows > self._annoy_rows * ANNOY_REBUILD_RATIO:
+            self._build_annoy()
+        return True
+
+    def _top_k(self, queries: np.ndarray, n_results: int, where: Optional[Where]) -> list[list[tuple[float, int]]]:
+        size = len(self._ids)
+        if where:
+            # annoy cannot filter, search exactly only rows passing filter
+            candidates = np.fromiter(
+                (row for row in range(size) if matches(self._metadatas[row], where)), dtype=np.int64
+            )
+        elif self._use_annoy():
+            return [self._top_k_annoy(query, n_results) for query in queries]
+        else:
+            candidates = None
+        if candidates is not None and not len(candidates):
+            return [[] for _ in queries]
+        distances = self._distances(queries, slice(0, size) if candidates is None else candidates)
+        k = min(n_results, distances.shape[1])
+        top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        results = []
+        for query_distances, query_top in zip(distances, top):
+            ordered = query_top[np.argsort(query_distances[query_top], kind="stable")]
+            rows = ordered if candidates is None else candidates[ordered]
+            results.append([(float(query_distances[i]), int(row)) for i, row in zip(ordered, rows)])
+        return results
+
+    def _top_k_annoy(self, query: np.ndarray, n_results: int) -> list[tuple[float, int]]:
+        rows, distances = self._annoy.get_nns_by_vector(query, n_results, include_distances=True)
+        found = [(self._annoy_distance(distance), row) for distance, row in zip(distances, rows)]
+        size = len(self._ids)
+        if size > self._annoy_rows:
+            tail = self._distances(query[None, :], slice(self._annoy_rows, size))[0]
+            found.extend((float(distance), self._annoy_rows + i) for i, distance in enumerate(tail))
+        found.sort()
+        return found[:n_results]
+
+    @synchronized
+    def query(
+            self,
+            query_embeddings: Embedding | Sequence[Embedding],
+            n_results: int = 10,
+            where: Optional[Where] = None,
+            include: Include = DEFAULT_INCLUDE,
+    ) -> QueryResult:
+        queries = np.asarray(as_list(query_embeddings), dtype=np.float32)
+        if not self._ids:
+            hits = [[] for _ in queries]
+        else:
+            hits = self._top_k(queries.reshape(len(queries), -1), n_results, where)
+        result = {key: [] for key in ("ids", "embeddings", "documents", "metadatas", "distances")}
+        for query_hits in hits:
+            selected = self._select([row for _, row in query_hits], include)
+            for key, value in selected.items():
+                result[key].append(value)
+            result["distances"].append([distance for distance, _ in query_hits])
+        for key in ("embeddings", "documents", "metadatas", "distances"):
+            if key not in include:
+                result[key] = None
+        return result
+
+    @synchronized
+    def persist(self) -> None:
+        """Write collection to its directory"""
+        if not self.path:
+            raise ValueError("collection has no path to persist into")
+        os.makedirs(self.path, exist_ok=True)
+        size = len(self._ids)
+        # stored precision, quantized collection is also smaller on disk
+        np.save(self._file("npy"), self._matrix[:size])
+        if self.precision == "int8":
+            np.save(self._file("scales.npy"), self._scales[:size])
+        with open(self._file("json.tmp"), "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "space": self.space,
+                    "precision": self.precision,
+                    "ids": self._ids,
+                    "documents": self._documents,
+                    "metadatas": self._metadatas,
+                },
+                file,
+            )
+        os.replace(self._file("json.tmp"), self._file("json"))
+
+    def _load(self) -> None:
+        with open(self._file("json"), encoding="utf-8") as file:
+            stored = json.load(file)
+        data = np.load(self._file("npy"))
+        precision = stored.get("precision", DEFAULT_PRECISION)
+        scales = np.load(self._file("scales.npy")) if precision == "int8" else None
+        if precision != self.precision:
+            # stored in other precision, encode again
+            data, scales = quantize(dequantize(data, scales), self.precision)
+        if len(data):
+            vectors = dequantize(data, scales)
+            self._reserve(len(data), data.shape[1])
+            self._matrix[:len(data)] = data
+            if scales is not None:
+                self._scales[:len(data)] = scales
+            self._sq_norms[:len(data)] = (vectors * vectors).sum(axis=1)
+        self.space = stored["space"]
+        self._ids = stored["ids"]
+        self._rows = {id_: row for row, id_ in enumerate(self._ids)}
+        self._documents = stored["documents"]
+        self._metadatas = stored["metadatas"]
+
+
+class LocalClient:
+    """
+    In-process replacement of chroma client, no server to run.
+
+    storage = VectorStorage(client=LocalClient("./memory"))
+    """
+
+    def __init__(self, path: Optional[str] = None, **collection_options) -> None:
+        """
+        Set up client.
+
+        :param path: directory of persisted collections, in memory only if not set
+        :param collection_options: passed to each created `LocalCollection`
+        """
+        self.path = path
+        self.collection_options = collection_options
+        self._collections: dict[str, LocalCollection] = {}
+
+    def get_or_create_collection(self, name: str, metadata: Optional[Metadata] = None, **_) -> LocalCollection:
+        collection = self._collections.get(name)
+        if collection is None:
+            options = dict(self.collection_options)
+            if metadata and "hnsw:space" in metadata:
+                options["space"] = metadata["hnsw:space"]
+            collection = self._collections[name] = LocalCollection(name, path=self.path, **options)
+        return collection
+
+    def get_collection(self, name: str, **_) -> LocalCollection:
+        return self._collections[name]
+
+    def list_collections(self) -> list[LocalCollection]:
+        return list(self._collections.values())
+
+    def persist(self) -> None:
+        for collection in self._collections.values():
+            collection.persist()
@@ -0,0 +1,361 @@
+import hashlib
+import heapq
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Optional, Sequence
+
+import chromadb.api
+from chromadb.api.types import Document, Embedding, ID, Metadata, Where
+
+from ..instrumentation import LATENCY_BOUNDS, Histogram, Span, vector_bytes
+from .local import LocalClient
+from .similarity import DEFAULT_COLLECTION, EVERYTHING, IDS_ONLY, MatchedResult, VectorStorage, document_id
+
+__all__ = (
+    "ShardStats",
+    "ShardedVectorStorage",
+    "tenant_document_id",
+)
+
+TENANT_KEY = "tenant"
+DEFAULT_WORKERS = 8
+
+
+def tenant_document_id(tenant: str, document: Document) -> ID:
+    """
+    Content address of document within tenant, two tenants remembering the same text in one shard do not collide.
+
+    :param tenant: tenant or author key
+    :param document: text of document
+    :return: hex SHA-256 digest of tenant and normalized text
+    """
+    return hashlib.sha256(f"{tenant}\0{document_id(document)}".encode("utf-8")).hexdigest()
+
+
+@dataclass(slots=True)
+class ShardStats:
+    index: int  # position of shard in storage
+    collection: str  # name of shard collection
+    size: int  # number of stored documents
+    tenants: int  # number of tenants routed to shard which stored something since start
+    queries: int  # number of queries answered by shard
+    latency: dict[str, float]  # p50, p95, p99 and max seconds of shard queries
+
+
+class _Shard:
+    __slots__ = ("index", "storage", "latency", "tenants", "lock")
+
+    def __init__(self, index: int, storage: VectorStorage) -> None:
+        self.index = index
+        self.storage = storage
+        self.latency = Histogram(LATENCY_BOUNDS)
+        self.tenants: set[str] = set()
+        self.lock = threading.Lock()
+
+    def query_many(self, embeddings: Any, n_results: int, where: Optional[Where]) -> list[MatchedResult]:
+        start = time.perf_counter()
+        try:
+            return self.storage.query_many(embeddings, n_results, where)
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.latency.observe(seconds)
+
+
+def _query_shards(
+        group: Sequence[tuple[_Shard, Optional[Where]]],
+        embeddings: Any,
+        n_results: int,
+) -> list[list[MatchedResult]]:
+    return [shard.query_many(embeddings, n_results, where) for shard, where in group]
+
+
+def _by_tenant(tenant: str) -> Where:
+    return {TENANT_KEY: tenant}
+
+
+def _by_tenants(tenants: Sequence[str]) -> Where:
+    # chroma 0.3 filters have no $in, $or takes two clauses at least
+    if len(tenants) == 1:
+        return _by_tenant(tenants[0])
+    return {"$or": [_by_tenant(tenant) for tenant in tenants]}
+
+
+def _merge(partials: Sequence[MatchedResult], n_results: int) -> MatchedResult:
+    # every partial is ordered by distance already, heap merge reads only n_results of them
+    hits = heapq.merge(
+        *(zip(partial.distances, partial.ids, partial.documents) for partial in partials),
+        key=lambda hit: hit[0],
+    )
+    top = [hit for _, hit in zip(range(n_results), hits)]
+    return MatchedResult(
+        ids=[id_ for _, id_, _ in top],
+        embeddings=None,
+        documents=[document for _, _, document in top],
+        metadatas=None,
+        distances=[distance for distance, _, _ in top],
+    )
+
+
+class ShardedVectorStorage:
+    """
+    Memories of many tenants split over shards, query of one tenant scans only its own shard.
+
+    Tenant or author key is routed to shard by stable hash, unless it is placed explicitly. Shard is a collection of
+    client from pool, so shards are separate backend instances when there are as many clients as shards and
+    collections of one backend with single client. Documents carry their tenant in metadata, so tenants sharing
+    shard never see each other's memories. Cross-shard query asks separate clients in parallel and shards of one
+    client one after another, chroma client is not safe for concurrent queries.
+
+    storage = ShardedVectorStorage([LocalClient("./memory-a"), LocalClient("./memory-b")], shards=16)
+    storage.add_many("valji", embeddings, texts)
+    storage.nearest("valji", embedding)
+    storage.query_many(embeddings)  # recall across every shard
+    """
+
+    def __init__(
+            self,
+            clients: Sequence[chromadb.api.API | LocalClient],
+            shards: Optional[int] = None,
+            collection_name: Optional[str] = None,
+            placement: Optional[dict[str, int]] = None,
+            max_workers: int = DEFAULT_WORKERS,
+    ) -> None:
+        """
+        Set up shards, threads are shared by all cross-shard queries.
+
+        :param clients: pool of storage backends with chroma client interface, shards are spread round-robin
+        :param shards: number of shards, one per client if not set; must not change while data are stored
+        :param collection_name: prefix of shard collections, shard index is appended
+        :param placement: tenants pinned to shard index, e.g. loaded after rebalancing
+        :param max_workers: threads querying clients in parallel
+        """
+        if not clients:
+            raise ValueError("at least one client is required")
+        count = shards if shards is not None else len(clients)
+        if count < 1:
+            raise ValueError("at least one shard is required")
+        prefix = collection_name or DEFAULT_COLLECTION
+        self.shards = [
+            _Shard(index, VectorStorage(client=clients[index % len(clients)], collection_name=f"{prefix}-{index}"))
+            for index in range(count)
+        ]
+        self.placement: dict[str, int] = {}
+        for tenant, index in (placement or {}).items():
+            self._check(index)
+            self.placement[tenant] = index
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="shard")
+
+    def __enter__(self) -> "ShardedVectorStorage":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _check(self, index: int) -> None:
+        if not 0 <= index < len(self.shards):
+            raise ValueError(f"shard index {index} out of range 0..{len(self.shards) - 1}")
+
+    def shard_of(self, tenant: str) -> int:
+        """
+        Index of shard holding tenant, the same in every process and restart.
+
+        :param tenant: tenant or author key
+        :return: shard index
+        """
+        index = self.placement.get(tenant)
+        if index is not None:
+            return index
+        digest = hashlib.blake2b(tenant.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little") % len(self.shards)
+
+    def storage(self, tenant: str) -> VectorStorage:
+        """
+        Storage of shard holding tenant, shared with other tenants of the shard.
+
+        :param tenant: tenant or author key
+        :return: vector storage of shard
+        """
+        return self.shards[self.shard_of(tenant)].storage
+
+    def add_many(
+            self,
+            tenant: str,
+            embeddings: Sequence[Embedding],
+            documents: Sequence[Document],
+            metadatas: Optional[Sequence[Optional[Metadata]]] = None,
+    ) -> list[ID]:
+        """
+        Insert memories of tenant. Skip duplicates of the tenant, other tenants may remember the same text.
+
+        :param tenant: tenant or author key
+        :param embeddings: embeddings of given documents
+        :param documents: insert these texts
+        :param metadatas: metadata of each document, tenant key is added
+        :return: document ids in the same order as documents
+        """
+        if len(embeddings) != len(documents):
+            raise ValueError("embeddings and documents must have the same length")
+        if metadatas is not None and len(metadatas) != len(documents):
+            raise ValueError("metadatas and documents must have the same length")
+        doc_ids = [tenant_document_id(tenant, document) for document in documents]
+        if not doc_ids:
+            return doc_ids
+        shard = self.shards[self.shard_of(tenant)]
+        stored = set(shard.storage.get_many(doc_ids, include=IDS_ONLY).ids)
+        batch: dict[ID, int] = {}
+        for position, doc_id in enumerate(doc_ids):
+            if doc_id not in stored:
+                batch.setdefault(doc_id, position)
+        if batch:
+            shard.storage.upsert_many(
+                list(batch),
+                [embeddings[position] for position in batch.values()],
+                [documents[position] for position in batch.values()],
+                [
+                    {**((metadatas[position] or {}) if metadatas is not None else {}), TENANT_KEY: tenant}
+                    for position in batch.values()
+                ],
+            )
+            with shard.lock:
+                shard.tenants.add(tenant)
+        return doc_ids
+
+    def get_many(self, tenant: str, doc_ids: Sequence[ID]) -> MatchedResult:
+        """
+        Find memories of tenant by ids, missing ids and ids of other tenants are left out.
+
+        :param tenant: tenant or author key
+        :param doc_ids: document ids
+        :return: matched documents
+        """
+        if not doc_ids:
+            return MatchedResult([], [], [], [], None)
+        collection = self.storage(tenant).collection
+        result = collection.get(ids=list(doc_ids), where=_by_tenant(tenant), include=EVERYTHING)
+        return MatchedResult(*(result.get(key) for key in ("ids", "embeddings", "documents", "metadatas")), None)
+
+    def delete_many(self, tenant: str, doc_ids: Sequence[ID]) -> None:
+        """
+        Remove memories of tenant, unknown ids and ids of other tenants are ignored.
+
+        :param tenant: tenant or author key
+        :param doc_ids: ids of removed documents
+        """
+        if doc_ids:
+            self.storage(tenant).collection.delete(ids=list(doc_ids), where=_by_tenant(tenant))
+
+    def nearest(self, tenant: str, embedding: Embedding, n_results: int = 17) -> MatchedResult:
+        """
+        Find memories of tenant similar to embedding, only shard of tenant is queried.
+
+        :param tenant: tenant or author key
+        :param embedding: search docs near this vector
+        :param n_results: max limit returned doc number
+        :return: matched ids, documents and distances ordered by distance
+        """
+        return self.shards[self.shard_of(tenant)].query_many([embedding], n_results, _by_tenant(tenant))[0]
+
+    def query_many(
+            self,
+            embeddings: Sequence[Embedding],
+            n_results: int = 17,
+            tenants: Optional[Sequence[str]] = None,
+    ) -> list[MatchedResult]:
+        """
+        Cross-shard recall, shards of separate clients are queried in parallel and their partial top-k merged.
+
+        :param embeddings: search docs near each of these vectors
+        :param n_results: max limit returned doc number per embedding
+        :param tenants: search memories of these tenants only, every shard and tenant if not set
+        :return: matched ids, documents and distances of each embedding ordered by distance
+        """
+        if len(embeddings) == 0:
+            return []
+        if tenants is None:
+            targets: dict[int, Optional[Where]] = {shard.index: None for shard in self.shards}
+        else:
+            grouped: dict[int, list[str]] = {}
+            for tenant in dict.fromkeys(tenants):
+                grouped.setdefault(self.shard_of(tenant), []).append(tenant)
+            targets = {index: _by_tenants(group) for index, group in grouped.items()}
+        if not targets:
+            return [MatchedResult([], None, [], None, []) for _ in embeddings]
+        by_client: dict[int, list[tuple[_Shard, Optional[Where]]]] = {}
+        for index, where in targets.items():
+            shard = self.shards[index]
+            by_client.setdefault(id(shard.storage.client), []).append((shard, where))
+        with Span("vector.sharded_query_many", len(embeddings), vector_bytes(embeddings)):
+            futures = [
+                self._executor.submit(_query_shards, group, embeddings, n_results) for group in by_client.values()
+            ]
+            partials = [partial for future in futures for partial in future.result()]
+        return [_merge(per_query, n_results) for per_query in zip(*partials)]
+
+    def move(self, tenant: str, index: int, batch_size: int = 10_000) -> int:
+        """
+        Move memories of tenant to other shard and pin tenant there, e.g. to rebalance hot shard.
+
+        Tenant is pinned before copying, so memories it writes meanwhile go to target shard and none is left behind,
+        recall of tenant sees only copied memories until move ends. Memories of tenant are collected from every other
+        shard, calling move again finishes interrupted one. Tenant is pinned only in `placement`, persist it and pass
+        it back on start.
+
+        :param tenant: tenant or author key
+        :param index: index of target shard
+        :param batch_size: documents copied at once
+        :return: number of moved documents
+        """
+        self._check(index)
+        target = self.shards[index]
+        self.placement[tenant] = index
+        moved = 0
+        for source in self.shards:
+            if source is target:
+                continue
+            while True:
+                page = source.storage.collection.get(where=_by_tenant(tenant), limit=batch_size, include=EVERYTHING)
+                if not page["ids"]:
+                    break
+                target.storage.upsert_many(page["ids"], page["embeddings"], page["documents"], page["metadatas"])
+                source.storage.delete_many(page["ids"])
+                moved += len(page["ids"])
+            with source.lock:
+                source.tenants.discard(tenant)
+        with target.lock:
+            target.tenants.add(tenant)
+        return moved
+
+    def stats(self) -> list[ShardStats]:
+        """
+        Size and query latency of each shard, to find shards worth rebalancing.
+
+        :return: stats ordered by shard index
+        """
+        result = []
+        for shard in self.shards:
+            with shard.lock:
+                latency = {
+                    "p50": shard.latency.quantile(0.5),
+                    "p95": shard.latency.quantile(0.95),
+                    "p99": shard.latency.quantile(0.99),
+                    "max": shard.latency.max,
+                }
+                queries = shard.latency.count
+                tenants = len(shard.tenants)
+            result.append(
+                ShardStats(
+                    index=shard.index,
+                    collection=shard.storage.collection.name,
+                    size=shard.storage.collection.count(),
+                    tenants=tenants,
+                    queries=queries,
+                    latency=latency,
+                )
+            )
+        return result
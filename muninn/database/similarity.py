@@ -1,14 +1,20 @@
-import uuid
+import hashlib
+import re
+import unicodedata
 from dataclasses import dataclass
-from typing import Optional, Iterable, List, TypeVar
+from typing import Any, Optional, Iterable, Iterator, List, Sequence, TypeVar
 
 import chromadb
 import chromadb.api
 import chromadb.utils.embedding_functions
-from chromadb.api.types import GetResult, Include, ID, Embedding, Document, Metadata, QueryResult
+from chromadb.api.types import GetResult, Include, ID, Embedding, Document, Metadata, QueryResult, Where
 from chromadb.config import Settings
 
+from ..instrumentation import Span, instrumented, single, vector_bytes
+from .local import LocalClient, LocalCollection
+
 __all__ = (
+    "LocalClient",
     "MatchedResult",
     "Settings",
     "VectorStorage",
@@ -19,6 +25,10 @@ _T = TypeVar("_T")
 QUERY_KEYS = ["ids", "embeddings", "documents", "metadatas", "distances"]
 DEFAULT_COLLECTION = "human_context"
 DOCS_ONLY: Include = ["documents", ]
+DOCS_AND_DISTANCES: Include = ["documents", "distances"]
+EVERYTHING: Include = ["embeddings", "documents", "metadatas"]
+IDS_ONLY: Include = []
+_WHITESPACE = re.compile(r"\s+")
 
 
 @dataclass
@@ -55,6 +65,52 @@ def first(query_result: QueryResult | GetResult) -> MatchedResult:
     )
 
 
+def flat(get_result: GetResult) -> MatchedResult:
+    """
+    Convert result of get, it is not multiset
+
+    :param get_result: original result of get
+    :return: matched documents without distances
+    """
+    return MatchedResult(*(get_result.get(key) for key in QUERY_KEYS))
+
+
+def every(query_result: QueryResult) -> list[MatchedResult]:
+    """
+    Split result of many queries into result of each query
+
+    :param query_result: original result of query with many sets
+    :return: one set per query embedding, in the same order
+    """
+    columns = [query_result.get(key) for key in QUERY_KEYS]
+    return [
+        MatchedResult(*(column[index] if column is not None else None for column in columns))
+        for index in range(len(query_result.get("ids") or []))
+    ]
+
+
+def plain(embedding: Any) -> Any:
+    """NumPy vector or matrix as python lists, chroma validates embeddings as lists"""
+    if hasattr(embedding, "tolist"):
+        return embedding.tolist()
+    if len(embedding) and hasattr(embedding[0], "tolist"):
+        return [vector.tolist() for vector in embedding]
+    return embedding
+
+
+def document_id(document: Document) -> ID:
+    """
+    Stable content address of document, the same for every process and restart.
+
+    Text is NFC normalized and its whitespace collapsed, so texts differing only in formatting share id.
+
+    :param document: text of document
+    :return: hex SHA-256 digest of normalized text
+    """
+    normalized = _WHITESPACE.sub(" ", unicodedata.normalize("NFC", document)).strip()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
 class VectorStorage:
     """
     Simplified chromadb client for embedded texts.
@@ -66,25 +122,42 @@ class VectorStorage:
             chroma_server_http_port="8000"
         )
     )
+
+    Any client with chroma interface can be plugged in instead, e.g. in-process storage without server:
+
+    similarity_storage = VectorStorage(client=LocalClient("./memory"))
+
+    Local collections can keep embeddings quantized to float16 or int8, 2 or 4 times smaller than float32:
+
+    similarity_storage = VectorStorage(client=LocalClient("./memory", precision="int8"))
     """
-    client: chromadb.Client
-    collection: chromadb.api.Collection
+    client: chromadb.api.API | LocalClient
+    collection: chromadb.api.Collection | LocalCollection
 
     def __init__(
             self,
-            setting: chromadb.config.Settings,
+            setting: Optional[chromadb.config.Settings] = None,
             collection_name: Optional[str] = None,
+            client: Optional[chromadb.api.API | LocalClient] = None,
     ) -> None:
         """
         Set up database client config.
 
-        :param setting: data container of storage settings server/local
+        :param setting: data container of storage settings server/local, used only if client is not set
         :param collection_name: name for this memory
+        :param client: storage backend with chroma client interface
         """
+        if client is None and setting is None:
+            raise ValueError("either setting or client is required")
         collection_name = collection_name or DEFAULT_COLLECTION
-        self.client = chromadb.Client(setting)
+        self.client = client if client is not None else chromadb.Client(setting)
         self.collection = self.client.get_or_create_collection(name=collection_name)
 
+    def _convert(self, embedding: Any) -> Any:
+        # local collection takes float32 arrays as they are, chroma needs lists
+        return embedding if isinstance(self.collection, LocalCollection) else plain(embedding)
+
+    @instrumented("vector.get", "doc_id")
     def get(self, doc_id: ID) -> MatchedResult:
         """
         Find document by id.
@@ -94,6 +167,7 @@ class VectorStorage:
         """
         return first(self.collection.get(ids=doc_id))
 
+    @instrumented("vector.query", "embedding", single, vector_bytes)
     def query(self, embedding: list[float], n_results: int = 17) -> Iterable[Document]:
         """
         Find similar document.
@@ -104,13 +178,133 @@ class VectorStorage:
         """
         result = first(
             self.collection.query(
-                query_embeddings=embedding,
+                query_embeddings=self._convert(embedding),
                 n_results=n_results,
                 include=DOCS_ONLY,
             )
         )
         return result.documents
 
+    @instrumented("vector.nearest", "embedding", single, vector_bytes)
+    def nearest(self, embedding: Embedding, n_results: int = 17) -> MatchedResult:
+        """
+        Find similar documents with their ids and distances.
+
+        :param embedding: search docs near this vector
+        :param n_results: max limit returned doc number
+        :return: matched documents ordered by distance
+        """
+        return first(
+            self.collection.query(
+                query_embeddings=self._convert(embedding),
+                n_results=n_results,
+                include=DOCS_AND_DISTANCES,
+            )
+        )
+
+    @instrumented("vector.query_many", "embeddings", payload=vector_bytes)
+    def query_many(
+            self,
+            embeddings: Sequence[Embedding],
+            n_results: int = 17,
+            where: Optional[Where] = None,
+    ) -> list[MatchedResult]:
+        """
+        Find similar documents of many embeddings in single request.
+
+        :param embeddings: search docs near each of these vectors
+        :param n_results: max limit returned doc number per embedding
+        :param where: metadata filter, e.g. {"author": "Valji"}
+        :return: matched ids, documents and distances of each embedding, in the same order as embeddings
+        """
+        if len(embeddings) == 0:
+            return []
+        return every(
+            self.collection.query(
+                query_embeddings=self._convert(embeddings),
+                n_results=n_results,
+                where=where or None,
+                include=DOCS_AND_DISTANCES,
+            )
+        )
+
+    @instrumented("vector.get_many", "doc_ids")
+    def get_many(self, doc_ids: Sequence[ID], include: Include = EVERYTHING) -> MatchedResult:
+        """
+        Find many documents by ids, missing ids are left out.
+
+        :param doc_ids: document ids
+        :param include: returned fields, embeddings, documents and metadatas by default
+        :return: matched documents in storage order
+        """
+        if not doc_ids:
+            return MatchedResult([], [], [], [], None)
+        return flat(self.collection.get(ids=list(doc_ids), include=include))
+
+    def iter_all(self, batch_size: int = 10_000, include: Include = EVERYTHING) -> Iterator[MatchedResult]:
+        """
+        Page through every stored document, e.g. to export collection.
+
+        Ids are listed once and pages are read by them, chroma 0.3 pages by limit and offset without stable order,
+        so they skip and repeat documents.
+
+        :param batch_size: documents per page
+        :param include: returned fields, embeddings, documents and metadatas by default
+        :return: generator of pages ordered by id
+        """
+        doc_ids = sorted(self.collection.get(include=[])["ids"])
+        for start in range(0, len(doc_ids), batch_size):
+            with Span("vector.iter_all", batch_size):
+                page = flat(self.collection.get(ids=doc_ids[start:start + batch_size], include=include))
+            if page.ids:
+                yield page
+
+    @instrumented("vector.upsert_many", "doc_ids")
+    def upsert_many(
+            self,
+            doc_ids: Sequence[ID],
+            embeddings: Sequence[Embedding],
+            documents: Sequence[Optional[Document]],
+            metadatas: Optional[Sequence[Optional[Metadata]]] = None,
+    ) -> None:
+        """
+        Write documents under given ids as they are, without duplicate check, e.g. to restore snapshot.
+
+        :param doc_ids: ids of documents
+        :param embeddings: embeddings of documents, float32 matrix is passed to local collection without copy
+        :param documents: texts of documents
+        :param metadatas: metadata of each document, none if not set
+        """
+        if len(doc_ids) == 0:
+            return
+        self.collection.upsert(
+            ids=list(doc_ids),
+            embeddings=self._convert(embeddings),
+            documents=list(documents),
+            metadatas=list(metadatas) if metadatas is not None else None,
+        )
+
+    @instrumented("vector.update_metadatas", "doc_ids")
+    def update_metadatas(self, doc_ids: Sequence[ID], metadatas: Sequence[Metadata]) -> None:
+        """
+        Replace metadata of stored documents.
+
+        :param doc_ids: ids of stored documents
+        :param metadatas: new metadata of each document
+        """
+        if doc_ids:
+            self.collection.update(ids=list(doc_ids), metadatas=list(metadatas))
+
+    @instrumented("vector.delete_many", "doc_ids")
+    def delete_many(self, doc_ids: Sequence[ID]) -> None:
+        """
+        Remove documents, unknown ids are ignored.
+
+        :param doc_ids: ids of removed documents
+        """
+        if doc_ids:
+            self.collection.delete(ids=list(doc_ids))
+
     def add(self, embedding: Embedding, document: Document) -> ID:
         """
         Insert embedded document. Skip if it is duplicate.
@@ -119,29 +313,46 @@ class VectorStorage:
         :param document: insert this text
         :return: document id
         """
-        doc_hash = hash(document)
-        # detect duplicate
-        # noinspection PyBroadException
-        try:
-            suspect_duplicates = first(
-                self.collection.query(
-                    query_embeddings=embedding,
-                    where={"doc_hash": doc_hash},
-                    include=["documents"],
-                )
+        return self.add_many(embeddings=[embedding], documents=[document])[0]
+
+    @instrumented("vector.add_many", "embeddings", payload=vector_bytes)
+    def add_many(
+            self,
+            embeddings: Sequence[Embedding],
+            documents: Sequence[Document],
+            metadatas: Optional[Sequence[Metadata]] = None,
+    ) -> list[ID]:
+        """
+        Insert many embedded documents at once. Skip duplicates in storage and in the batch itself.
+
+        Document id is derived from its content, so duplicate detection is single lookup of ids. New documents are
+        upserted, concurrent writer adding the same text in between lookup and write only rewrites the same row.
+
+        :param embeddings: embeddings of given documents
+        :param documents: insert these texts
+        :param metadatas: metadata of each document, none if not set
+        :return: document ids in the same order as documents
+        """
+        if len(embeddings) != len(documents):
+            raise ValueError("embeddings and documents must have the same length")
+        if metadatas is not None and len(metadatas) != len(documents):
+            raise ValueError("metadatas and documents must have the same length")
+        doc_ids = [document_id(document) for document in documents]
+        if not doc_ids:
+            return doc_ids
+        batch: dict[ID, tuple[Embedding, Document, Optional[Metadata]]] = {}
+        for doc_id, embedding, document, metadata in zip(
+                doc_ids, embeddings, documents, metadatas or [None] * len(documents)
+        ):
+            batch.setdefault(doc_id, (embedding, document, metadata))
+        stored = self.collection.get(ids=list(batch), include=IDS_ONLY)
+        for doc_id in stored["ids"]:
+            del batch[doc_id]
+        if batch:
+            self.collection.upsert(
+                ids=list(batch),
+                embeddings=[self._convert(embedding) for embedding, _, _ in batch.values()],
+                documents=[document for _, document, _ in batch.values()],
+                metadatas=[metadata for _, _, metadata in batch.values()] if metadatas is not None else None,
             )
-        except Exception:
-            # cannot be handled other way then exception because chroma does not use its own for rest api
-            suspect_duplicates = None
-        if suspect_duplicates and document in suspect_duplicates:
-            index = suspect_duplicates.documents.index(document)
-            return suspect_duplicates.ids[index]
-        # create new
-        new_doc_id = uuid.uuid4().hex
-        self.collection.add(
-            ids=new_doc_id,
-            embeddings=embedding,
-            metadatas={"doc_hash": doc_hash},
-            documents=document,
-        )
-        return new_doc_id
+        return doc_ids
@@ -0,0 +1,133 @@
+"""
+Compact embedding representation, float32 matrix with optional float16 or int8 scalar quantization.
+
+Python `list[float]` costs ~32 bytes per dimension, float32 row costs 4, float16 2 and int8 1 byte plus one
+float32 scale per row. Distances are computed on float32 blocks decoded on the fly.
+"""
+from dataclasses import dataclass
+from typing import Any, Literal, Optional, Sequence
+
+import numpy as np
+
+__all__ = (
+    "PRECISIONS",
+    "Precision",
+    "QuantizedVectors",
+    "as_matrix",
+    "dequantize",
+    "quantize",
+    "recall_at_k",
+)
+
+Precision = Literal["float32", "float16", "int8"]
+PRECISIONS: dict[str, type] = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+INT8_MAX = 127
+
+
+def as_matrix(embeddings: Any) -> np.ndarray:
+    """
+    Embeddings as 2D float32 array, single vector becomes one row
+
+    :param embeddings: vector, sequence of vectors, array or `QuantizedVectors`
+    :return: float32 matrix, not copied if it already is one
+    """
+    if isinstance(embeddings, QuantizedVectors):
+        return embeddings.decode()
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix[None, :] if len(matrix) else matrix.reshape(0, 0)
+    return matrix
+
+
+def quantize(vectors: np.ndarray, precision: Precision) -> tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Encode float32 rows into storage precision
+
+    int8 uses symmetric per row scale, the largest absolute value of row maps to 127.
+
+    :param vectors: float32 matrix
+    :param precision: "float32", "float16" or "int8"
+    :return: encoded matrix and float32 scale of each row, scales are None for float precisions
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"unsupported precision {precision!r}, use one of {', '.join(PRECISIONS)}")
+    if precision != "int8":
+        return vectors.astype(PRECISIONS[precision], copy=False), None
+    scales = np.abs(vectors).max(axis=1, initial=0.0).astype(np.float32) / INT8_MAX
+    # zero rows stay zero with any scale
+    safe = np.where(scales > 0, scales, 1.0).astype(np.float32)
+    data = np.clip(np.rint(vectors / safe[:, None]), -INT8_MAX, INT8_MAX).astype(np.int8)
+    return data, scales
+
+
+def dequantize(data: np.ndarray, scales: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Decode stored rows into float32
+
+    :param data: encoded matrix
+    :param scales: float32 scale of each row, only for int8
+    :return: new float32 matrix, or data itself if it is float32 already
+    """
+    vectors = data.astype(np.float32, copy=False)
+    if scales is not None:
+        vectors = vectors * scales[:, None]
+    return vectors
+
+
+@dataclass(slots=True)
+class QuantizedVectors:
+    data: np.ndarray  # encoded rows, dtype of precision
+    scales: Optional[np.ndarray] = None  # float32 scale of each row, only for int8
+
+    @classmethod
+    def encode(cls, embeddings: Any, precision: Precision = "float32") -> "QuantizedVectors":
+        """
+        Encode embeddings in given precision
+
+        :param embeddings: vector, sequence of vectors or array
+        :param precision: "float32", "float16" or "int8"
+        :return: encoded vectors
+        """
+        return cls(*quantize(as_matrix(embeddings), precision))
+
+    @property
+    def precision(self) -> Precision:
+        return np.dtype(self.data.dtype).name
+
+    @property
+    def dim(self) -> int:
+        return self.data.shape[1] if self.data.ndim == 2 else 0
+
+    @property
+    def nbytes(self) -> int:
+        """Memory taken by vectors and scales"""
+        return self.data.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __getitem__(self, rows: int | slice | Sequence[int] | np.ndarray) -> "QuantizedVectors":
+        if isinstance(rows, int):
+            rows = slice(rows, rows + 1)
+        return QuantizedVectors(self.data[rows], None if self.scales is None else self.scales[rows])
+
+    def decode(self) -> np.ndarray:
+        """All rows as float32 matrix"""
+        return dequantize(self.data, self.scales)
+
+    def tolist(self) -> list[list[float]]:
+        return self.decode().tolist()
+
+
+def recall_at_k(expected: Sequence[Sequence[Any]], found: Sequence[Sequence[Any]]) -> float:
+    """
+    Share of exact nearest neighbours found by approximate search, 1.0 is perfect
+
+    :param expected: ids of exact top k of each query
+    :param found: ids of approximate top k of each query
+    :return: recall averaged over queries
+    """
+    total = sum(len(exact) for exact in expected)
+    if not total:
+        return 1.0
+    return sum(len(set(exact) & set(approximate)) for exact, approximate in zip(expected, found)) / total
@@ -1,7 +1,21 @@
+import asyncio
+import json
+import threading
+from concurrent.futures import Future
 from dataclasses import dataclass
+from typing import Optional, Sequence, TYPE_CHECKING
 
 from . import database, language
 
+if TYPE_CHECKING:
+    from chromadb.api.types import Where
+
+    from .weave.fact import Chronicle
+
+DEFAULT_RECALL = 17
+DEFAULT_FLUSH_SIZE = 64
+DEFAULT_FLUSH_INTERVAL = 0.25
+
 
 @dataclass(slots=True)
 class AnalyzedText:
@@ -15,17 +29,20 @@ class Episodic:
 
     def __init__(
             self,
-            embedder: language.Embedding,
-            storage: database.VectorStorage,
+            embedder: "language.Embedding",
+            storage: "database.VectorStorage",
+            async_embedder: Optional["language.AsyncEmbedding"] = None,
     ) -> None:
         """
         Construct episodic memory
 
         :param embedder: categorize text to vector space
         :param storage: vector database
+        :param async_embedder: categorize text to vector space without blocking event loop
         """
         self.embedder = embedder
         self.storage = storage
+        self.async_embedder = async_embedder
 
     def analyze(self, text: str) -> list[float]:
         """
@@ -50,3 +67,310 @@ class Episodic:
             embedding=embedding,
             episodic_id=episodic_id
         )
+
+    def recall(self, text: str, n_results: int = DEFAULT_RECALL, where: Optional["Where"] = None) -> list[str]:
+        """
+        Find remembered texts of similar context.
+
+        :param text: context to search by
+        :param n_results: max number of returned texts
+        :param where: metadata filter of remembered texts
+        :return: remembered texts, most similar first
+        """
+        return self.recall_many([text], n_results=n_results, where=where)[0]
+
+    def recall_many(
+            self,
+            texts: Sequence[str],
+            n_results: int = DEFAULT_RECALL,
+            where: Optional["Where"] = None,
+    ) -> list[list[str]]:
+        """
+        Find remembered texts for many contexts with one embedding request and one storage query.
+
+        memory.recall_many([last_message, current_goal, scene])
+
+        :param texts: contexts to search by, e.g. fragments of current turn
+        :param n_results: max number of returned texts per context
+        :param where: metadata filter of remembered texts
+        :return: remembered texts of each context, most similar first
+        """
+        if not texts:
+            return []
+        matched = self.storage.query_many(self.embedder.get_many(texts), n_results=n_results, where=where)
+        return [result.documents or [] for result in matched]
+
+    def add_many(self, texts: Sequence[str]) -> list[AnalyzedText]:
+        """
+        Remember many texts at once with batched embedding and single storage write.
+
+        :param texts: texts to remember
+        :return: analyzed texts in the same order as texts
+        """
+        embeddings = self.embedder.get_many(texts)
+        episodic_ids = self.storage.add_many(embeddings=embeddings, documents=texts)
+        return [
+            AnalyzedText(
+                source=text,
+                embedding=embedding,
+                episodic_id=episodic_id
+            )
+            for text, embedding, episodic_id in zip(texts, embeddings, episodic_ids)
+        ]
+
+    async def aanalyze(self, text: str) -> list[float]:
+        """
+        Analyze text without blocking event loop, falls back to blocking embedder in worker thread.
+
+        :param text: text to categorize
+        :return: calculated embedding
+        """
+        if self.async_embedder is None:
+            return await asyncio.to_thread(self.embedder.get, text)
+        return await self.async_embedder.get(text)
+
+    async def aadd(self, text: str) -> AnalyzedText:
+        """
+        Remember this text without blocking event loop.
+
+        :param text: text to remember
+        :return: analyzed text
+        """
+        embedding = await self.aanalyze(text)
+        episodic_id = await asyncio.to_thread(self.storage.add, embedding=embedding, document=text)
+        return AnalyzedText(
+            source=text,
+            embedding=embedding,
+            episodic_id=episodic_id
+        )
+
+
+@dataclass(slots=True)
+class _Pending:
+    source: str
+    future: Future
+    embedding: Optional[list[float]] = None
+    chronicle_id: Optional[int] = None
+
+
+class WriteBehindEpisodic(Episodic):
+    """
+    Episodic memory which does not make caller wait for embedding and storage.
+
+    `submit` only enqueues text and returns future of analyzed text. Background flusher embeds and inserts pending
+    texts in batches once `flush_size` texts are waiting or `flush_interval` seconds passed. Texts waiting for
+    flush are still found by `recall`. With chronicle, text is written there before `submit` returns, so it
+    survives crash of process and can be replayed, e.g. by `IngestionPipeline`. `add` and `add_many` keep contract
+    of `Episodic`, they flush and return analyzed texts.
+
+    memory = WriteBehindEpisodic(embedder, storage)
+    memory.submit("I am Valji.")
+    memory.recall("Who am I?")
+    memory.close()
+    """
+
+    def __init__(
+            self,
+            embedder: "language.Embedding",
+            storage: "database.VectorStorage",
+            chronicle: Optional["Chronicle"] = None,
+            flush_size: int = DEFAULT_FLUSH_SIZE,
+            flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+            async_embedder: Optional["language.AsyncEmbedding"] = None,
+    ) -> None:
+        """
+        Construct episodic memory and start background flusher
+
+        :param embedder: categorize text to vector space
+        :param storage: vector database
+        :param chronicle: durable log written before add returns
+        :param flush_size: number of pending texts starting flush
+        :param flush_interval: max seconds text waits for flush
+        :param async_embedder: categorize text to vector space without blocking event loop
+        """
+        super().__init__(embedder, storage, async_embedder)
+        self.chronicle = chronicle
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._pending: list[_Pending] = []
+        self._state = threading.Condition()
+        # one batch is written at time, flush of caller and flusher thread do not race
+        self._writing = threading.Lock()
+        self._closed = False
+        self._flusher = threading.Thread(target=self._run, name="episodic-flusher", daemon=True)
+        self._flusher.start()
+
+    def __enter__(self) -> "WriteBehindEpisodic":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def add(self, text: str) -> AnalyzedText:
+        """
+        Remember this text now, together with every text pending at the time of call.
+
+        :param text: text to remember
+        :return: analyzed text
+        """
+        future = self.submit(text)
+        self.flush()
+        return future.result()
+
+    def add_many(self, texts: Sequence[str]) -> list[AnalyzedText]:
+        """
+        Remember many texts now, together with every text pending at the time of call.
+
+        :param texts: texts to remember
+        :return: analyzed texts in the same order as texts
+        """
+        futures = self.submit_many(texts)
+        self.flush()
+        return [future.result() for future in futures]
+
+    def submit(self, text: str) -> Future:
+        """
+        Remember this text later, return immediately.
+
+        :param text: text to remember
+        :return: future of analyzed text
+        """
+        if self._closed:
+            raise RuntimeError("episodic memory is closed")
+        pending = _Pending(source=text, future=Future())
+        if self.chronicle is not None:
+            pending.chronicle_id = self.chronicle.insert(text)["id"]
+        with self._state:
+            self._pending.append(pending)
+            if len(self._pending) >= self.flush_size:
+                self._state.notify()
+        return pending.future
+
+    def submit_many(self, texts: Sequence[str]) -> list[Future]:
+        """
+        Remember many texts later, return immediately.
+
+        :param texts: texts to remember
+        :return: futures of analyzed texts in the same order as texts
+        """
+        if self._closed:
+            raise RuntimeError("episodic memory is closed")
+        pending = [_Pending(source=text, future=Future()) for text in texts]
+        if self.chronicle is not None and pending:
+            for item, chronicle_id in zip(pending, self.chronicle.insert_many(list(texts))):
+                item.chronicle_id = chronicle_id
+        with self._state:
+            self._pending.extend(pending)
+            if len(self._pending) >= self.flush_size:
+                self._state.notify()
+        return [item.future for item in pending]
+
+    def flush(self) -> None:
+        """Write all texts pending at the time of call"""
+        with self._state:
+            target = list(self._pending)
+        while any(not item.future.done() for item in target):
+            self._write_batch()
+
+    def close(self) -> None:
+        """Stop flusher and write everything pending"""
+        with self._state:
+            if self._closed:
+                return
+            self._closed = True
+            self._state.notify()
+        self._flusher.join()
+        self.flush()
+
+    def _run(self) -> None:
+        while True:
+            with self._state:
+                self._state.wait_for(
+                    lambda: self._closed or len(self._pending) >= self.flush_size,
+                    timeout=self.flush_interval,
+                )
+                if self._closed:
+                    return
+                if not self._pending:
+                    continue
+            self._write_batch()
+
+    def _write_batch(self) -> None:
+        with self._writing:
+            with self._state:
+                batch = self._pending[:self.flush_size]
+            if not batch:
+                return
+            try:
+                missing = [item for item in batch if item.embedding is None]
+                if missing:
+                    for item, embedding in zip(missing, self.embedder.get_many([item.source for item in missing])):
+                        item.embedding = embedding
+                episodic_ids = self.storage.add_many(
+                    embeddings=[item.embedding for item in batch],
+                    documents=[item.source for item in batch],
+                    metadatas=[
+                        {"chronicle_ids": json.dumps([item.chronicle_id])} for item in batch
+                    ] if self.chronicle is not None else None,
+                )
+            except Exception as error:
+                # texts stay in chronicle, if there is any
+                results = [error] * len(batch)
+            else:
+                results = [
+                    AnalyzedText(source=item.source, embedding=item.embedding, episodic_id=episodic_id)
+                    for item, episodic_id in zip(batch, episodic_ids)
+                ]
+            with self._state:
+                # visible to recall until stored
+                del self._pending[:len(batch)]
+            for item, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    item.future.set_exception(result)
+                else:
+                    item.future.set_result(result)
+
+    def recall_many(
+            self,
+            texts: Sequence[str],
+            n_results: int = DEFAULT_RECALL,
+            where: Optional["Where"] = None,
+    ) -> list[list[str]]:
+        """
+        Find remembered texts for many contexts, including texts waiting for flush.
+
+        Contexts and pending texts are embedded in one request, embeddings are kept for flush. Pending texts are
+        ranked by distance of storage space, so they merge with stored texts consistently. Pending texts have
+        no metadata, so they are skipped with `where` filter.
+
+        :param texts: contexts to search by
+        :param n_results: max number of returned texts per context
+        :param where: metadata filter of remembered texts
+        :return: remembered texts of each context, most similar first
+        """
+        if not texts:
+            return []
+        with self._state:
+            pending = [] if where else list(self._pending)
+        missing = [item for item in pending if item.embedding is None]
+        embeddings = self.embedder.get_many(list(texts) + [item.source for item in missing])
+        for item, embedding in zip(missing, embeddings[len(texts):]):
+            item.embedding = embedding
+        queries = embeddings[:len(texts)]
+        if pending:
+            distances = database.cache.space_distances(
+                database.CachedVectorStorage.space_of(self.storage),
+                database.vectors.as_matrix(queries),
+                database.vectors.as_matrix([item.embedding for item in pending]),
+            ).tolist()
+        else:
+            distances = [[] for _ in queries]
+        recalled = []
+        for stored, pending_distances in zip(
+                self.storage.query_many(queries, n_results=n_results, where=where), distances
+        ):
+            candidates = dict(zip(stored.documents or [], stored.distances or []))
+            for item, distance in zip(pending, pending_distances):
+                candidates[item.source] = min(distance, candidates.get(item.source, distance))
+            recalled.append(sorted(candidates, key=candidates.get)[:n_results])
+        return recalled
@@ -0,0 +1,375 @@
+import datetime as dt
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional, Callable, Protocol
+
+import numpy as np
+
+from . import database, language
+from .database.vectors import as_matrix
+from .instrumentation import Span
+from .weave.fact import Chronicle, Record
+
+__all__ = (
+    "FileCheckpoint",
+    "IngestionPipeline",
+    "Ingested",
+    "MemoryCheckpoint",
+)
+
+DEFAULT_QUEUE_SIZE = 1024
+DEFAULT_MAX_WAIT = 0.05
+DEFAULT_WORKERS = {"extract": 2, "embed": 2, "store": 1}
+DEFAULT_BATCH_SIZES = {"chronicle": 256, "extract": 8, "embed": 128, "store": 256}
+# ends stream of items, passed from stage to stage
+_STOP = object()
+
+
+class Checkpoint(Protocol):
+    def load(self) -> int:
+        ...
+
+    def save(self, id_: int) -> None:
+        ...
+
+
+class MemoryCheckpoint:
+    """Checkpoint kept only for life of process"""
+
+    def __init__(self, id_: int = 0) -> None:
+        self.id = id_
+
+    def load(self) -> int:
+        return self.id
+
+    def save(self, id_: int) -> None:
+        self.id = id_
+
+
+class FileCheckpoint:
+    """Highest Chronicle id ingested by all stages, stored in file replaced atomically"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def load(self) -> int:
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, encoding="utf-8") as file:
+            return int(file.read().strip() or 0)
+
+    def save(self, id_: int) -> None:
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            file.write(str(id_))
+        os.replace(temporary, self.path)
+
+
+@dataclass(slots=True)
+class Ingested:
+    record: Record  # raw knowledge stored in chronicle
+    triples: list[language.Triple] = field(default_factory=list)  # facts extracted from record
+    embedding: Optional[np.ndarray] = None  # record content in vector space, float32
+    fact_embeddings: Optional[np.ndarray] = None  # each triple in vector space, float32 rows
+    episodic_id: Optional[str] = None  # id in vector storage
+    fact_embedding_ids: list[str] = field(default_factory=list)  # id of each triple in fact vector storage
+    fact_ids: list[int] = field(default_factory=list)  # ids of fact nodes in graph
+
+
+def take_batch(source: queue.Queue, batch_size: int, max_wait: float) -> list:
+    """
+    Block for first item, then gather more until batch is full or max_wait elapsed
+
+    :param source: queue to read
+    :param batch_size: max length of batch
+    :param max_wait: seconds to wait for more items after the first one
+    :return: batch, stop sentinel is always last item of batch
+    """
+    batch = [source.get()]
+    deadline = time.monotonic() + max_wait
+    while batch[-1] is not _STOP and len(batch) < batch_size:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(source.get(timeout=timeout))
+        except queue.Empty:
+            break
+    return batch
+
+
+@dataclass(slots=True)
+class _Stage:
+    name: str
+    process: Callable[[list], list]
+    source: queue.Queue
+    sink: Optional[queue.Queue]
+    workers: int
+    batch_size: int
+    running: int = 0
+
+
+class IngestionPipeline:
+    """
+    Chronicle -> facts -> embeddings -> vector storage and graph, each stage in own worker threads.
+
+    Stages are connected with bounded queues, full queue blocks producer (backpressure) and each stage takes
+    micro-batches of items, so network bound stages overlap and throughput is limited by the slowest stage.
+    Texts are written to chronicle first, the checkpoint is the highest chronicle id processed by all stages.
+    Records enter pipeline in order of chronicle ids, records other writers put into chronicle between ids of
+    pipeline are read back and ingested too, so checkpoint never skips them. Started pipeline replays chronicle
+    records after checkpoint, so it resumes after crash. Store stage has a single writer, vector backends and
+    their duplicate checks are not safe for concurrent writers.
+
+    with IngestionPipeline(chronicle, embedder, storage, graph, FactExtractor()) as pipeline:
+        for message in messages:
+            pipeline.submit(message)
+    """
+
+    def __init__(
+            self,
+            chronicle: Chronicle,
+            embedder: language.Embedding,
+            storage: database.VectorStorage,
+            graph: Optional[database.GraphDB] = None,
+            extractor: Optional[language.FactExtractor] = None,
+            checkpoint: Optional[Checkpoint] = None,
+            workers: Optional[dict[str, int]] = None,
+            batch_sizes: Optional[dict[str, int]] = None,
+            queue_size: int = DEFAULT_QUEUE_SIZE,
+            max_wait: float = DEFAULT_MAX_WAIT,
+            fact_storage: Optional[database.VectorStorage] = None,
+    ) -> None:
+        """
+        Set up pipeline, call `start` or use it as context manager.
+
+        :param chronicle: permanent storage of raw texts
+        :param embedder: categorize text to vector space, batched with `get_many`
+        :param storage: vector database of texts
+        :param graph: knowledge graph of facts, facts are not stored if not set
+        :param extractor: extracts facts from texts, no facts if not set
+        :param checkpoint: stores progress, in memory only if not set
+        :param workers: threads per stage "extract" and "embed"; chronicle and store stages have one thread
+        :param batch_sizes: max micro-batch per stage "chronicle", "extract", "embed" and "store"
+        :param queue_size: capacity of queue in front of each stage
+        :param max_wait: seconds stage waits to fill micro-batch
+        :param fact_storage: vector database of facts referenced by graph, facts are not embedded if not set
+        """
+        self.chronicle = chronicle
+        self.embedder = embedder
+        self.storage = storage
+        self.graph = graph
+        self.extractor = extractor
+        self.fact_storage = fact_storage
+        self.checkpoint = checkpoint or MemoryCheckpoint()
+        self.max_wait = max_wait
+        self.workers = {**DEFAULT_WORKERS, **(workers or {})}
+        if self.workers["store"] != 1:
+            raise ValueError("store stage has single writer")
+        self.batch_sizes = {**DEFAULT_BATCH_SIZES, **(batch_sizes or {})}
+        self.processed = 0
+        self.error: Optional[BaseException] = None
+        self._submitted: queue.Queue = queue.Queue(queue_size)
+        queues = [queue.Queue(queue_size) for _ in range(3)]
+        # ids entered into pipeline and not stored yet, they hold checkpoint back
+        self._pending: set[int] = set()
+        # every chronicle id up to this one entered pipeline
+        self._highest = 0
+        self._saved = 0
+        self._lock = threading.Lock()
+        self._threads: list[threading.Thread] = []
+        self._started = False
+        self._stages = [
+            _Stage("chronicle", self._record, self._submitted, queues[0], 1, self.batch_sizes["chronicle"]),
+            _Stage("extract", self._extract, queues[0], queues[1], self.workers["extract"],
+                   self.batch_sizes["extract"]),
+            _Stage("embed", self._embed, queues[1], queues[2], self.workers["embed"], self.batch_sizes["embed"]),
+            _Stage("store", self._store, queues[2], None, self.workers["store"], self.batch_sizes["store"]),
+        ]
+
+    def __enter__(self) -> "IngestionPipeline":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def start(self) -> None:
+        """Start worker threads, records after checkpoint are replayed first"""
+        if self._started:
+            return
+        self._started = True
+        self._saved = self._highest = self.checkpoint.load()
+        for stage in self._stages:
+            stage.running = stage.workers
+            for number in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._work_chronicle if stage.name == "chronicle" else self._work,
+                    args=(stage,), name=f"ingestion-{stage.name}-{number}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, content: str, time_stamp: Optional[dt.datetime] = None) -> None:
+        """
+        Enqueue text for ingestion, blocks while pipeline is full
+
+        :param content: text to remember
+        :param time_stamp: creation stamp, now if not set
+        """
+        if self.error is not None:
+            raise self.error
+        if not self._started:
+            self.start()
+        self._submitted.put((content, time_stamp or dt.datetime.utcnow()))
+
+    def close(self) -> None:
+        """Process everything submitted, stop workers and raise first error of any stage"""
+        if self._started:
+            self._submitted.put(_STOP)
+            for thread in self._threads:
+                thread.join()
+            self._threads.clear()
+            for stage in self._stages:
+                # stop sentinels left behind by sibling workers
+                while not stage.source.empty():
+                    stage.source.get_nowait()
+            self._started = False
+        if self.error is not None:
+            raise self.error
+
+    def _work(self, stage: _Stage) -> None:
+        while True:
+            batch = take_batch(stage.source, stage.batch_size, self.max_wait)
+            stop = batch[-1] is _STOP
+            if stop:
+                batch.pop()
+            if batch and self.error is None:
+                # after failure items are only drained, they stay unprocessed after checkpoint
+                try:
+                    with Span(f"ingestion.{stage.name}", len(batch)):
+                        results = stage.process(batch)
+                except BaseException as error:
+                    with self._lock:
+                        self.error = self.error or error
+                    results = []
+                if stage.sink is not None:
+                    for item in results:
+                        stage.sink.put(item)
+            if stop:
+                # wake up sibling workers waiting for the same queue
+                stage.source.put(_STOP)
+                with self._lock:
+                    stage.running -= 1
+                    last = stage.running == 0
+                if last and stage.sink is not None:
+                    stage.sink.put(_STOP)
+                return
+
+    def _enter(self, records: list[Record]) -> list[Ingested]:
+        with self._lock:
+            for record in records:
+                self._pending.add(record["id"])
+                self._highest = max(self._highest, record["id"])
+        return [Ingested(record=record) for record in records]
+
+    def _replay(self, stage: _Stage) -> None:
+        # the only thread entering ids, so they enter in increasing order and checkpoint never skips one
+        batch: list[Record] = []
+        for record in self.chronicle.iter_after(self._saved, stage.batch_size):
+            batch.append(record)
+            if len(batch) == stage.batch_size:
+                for item in self._enter(batch):
+                    stage.sink.put(item)
+                batch = []
+        for item in self._enter(batch):
+            stage.sink.put(item)
+
+    def _work_chronicle(self, stage: _Stage) -> None:
+        try:
+            self._replay(stage)
+        except BaseException as error:
+            with self._lock:
+                self.error = self.error or error
+        self._work(stage)
+
+    def _record(self, batch: list[tuple[str, dt.datetime]]) -> list[Ingested]:
+        contents = [content for content, _ in batch]
+        time_stamps = [time_stamp for _, time_stamp in batch]
+        ids = self.chronicle.insert_many(contents, time_stamps)
+        if ids == list(range(self._highest + 1, self._highest + 1 + len(ids))):
+            return self._enter([
+                {"id": id_, "time_stamp": time_stamp, "content": content}
+                for id_, content, time_stamp in zip(ids, contents, time_stamps)
+            ])
+        # other writer inserted records in between, read them back with ours in order of ids
+        records = self.chronicle.iter_after(self._highest, self.batch_sizes["chronicle"])
+        return self._enter(list(itertools.takewhile(lambda record: record["id"] <= max(ids), records)))
+
+    def _extract(self, items: list[Ingested]) -> list[Ingested]:
+        if self.extractor is None:
+            return items
+        for item, triples in zip(items, self.extractor.extract_many([item.record["content"] for item in items])):
+            item.triples = triples
+        return items
+
+    def _embed(self, items: list[Ingested]) -> list[Ingested]:
+        texts = [item.record["content"] for item in items]
+        if self.fact_storage is not None:
+            for item in items:
+                texts.extend(triple.text for triple in item.triples)
+        # compact float32 rows instead of python float lists from here on
+        embeddings = as_matrix(self.embedder.get_many(texts))
+        offset = len(items)
+        for item, embedding in zip(items, embeddings):
+            item.embedding = embedding
+            if self.fact_storage is not None:
+                item.fact_embeddings = embeddings[offset:offset + len(item.triples)]
+                offset += len(item.triples)
+        return items
+
+    def _store(self, items: list[Ingested]) -> list[Ingested]:
+        episodic_ids = self.storage.add_many(
+            embeddings=np.stack([item.embedding for item in items]),
+            documents=[item.record["content"] for item in items],
+            # source record, same label as consolidation writes, lets recall check time window by id
+            metadatas=[{"chronicle_ids": json.dumps([item.record["id"]])} for item in items],
+        )
+        for item, episodic_id in zip(items, episodic_ids):
+            item.episodic_id = episodic_id
+        embedded = [item for item in items if item.fact_embeddings is not None and len(item.fact_embeddings)]
+        if self.fact_storage is not None and embedded:
+            fact_embedding_ids = iter(self.fact_storage.add_many(
+                embeddings=np.concatenate([item.fact_embeddings for item in embedded]),
+                documents=[triple.text for item in embedded for triple in item.triples],
+            ))
+            for item in embedded:
+                item.fact_embedding_ids = [next(fact_embedding_ids) for _ in item.triples]
+        if self.graph is not None:
+            with self.graph.batch():
+                for item in items:
+                    embedding_ids = item.fact_embedding_ids or [None] * len(item.triples)
+                    item.fact_ids = self.graph.insert_facts(
+                        [triple.to_fact(embedding_id) for triple, embedding_id in zip(item.triples, embedding_ids)],
+                        timestamp=item.record["time_stamp"],
+                        chronicle_id=item.record["id"],
+                    )
+        self._done(items)
+        return items
+
+    def _done(self, items: list[Ingested]) -> None:
+        with self._lock:
+            for item in items:
+                self._pending.discard(item.record["id"])
+            self.processed += len(items)
+            watermark = min(self._pending) - 1 if self._pending else self._highest
+            if watermark <= self._saved:
+                return
+            self._saved = watermark
+            # saved under lock, checkpoint never moves backwards
+            self.checkpoint.save(watermark)
@@ -0,0 +1,345 @@
+"""
+Latency, batch size, payload size and errors of calls to external services.
+
+Entry points such as `Embedding.get_many`, `VectorStorage.query`, `GraphDB._execute_query` and `Chronicle.range`
+report `Event` to every registered tracer. Tracer is any callable taking event, so export to Prometheus or
+OpenTelemetry is a few lines. Without tracers, instrumented call costs one extra function call.
+
+collector = HistogramCollector()
+add_tracer(collector)
+...
+collector.snapshot()["vector.query"]["latency"]["p99"]
+"""
+import bisect
+import functools
+import inspect
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Optional, Sequence
+
+__all__ = (
+    "Event",
+    "Histogram",
+    "HistogramCollector",
+    "Span",
+    "Tracer",
+    "add_tracer",
+    "count",
+    "instrumented",
+    "remove_tracer",
+    "single",
+    "text_bytes",
+    "vector_bytes",
+)
+
+# seconds, 100 us doubled up to ~52 s
+LATENCY_BOUNDS = tuple(0.0001 * 2 ** power for power in range(20))
+BATCH_BOUNDS = tuple(2 ** power for power in range(17))
+PAYLOAD_BOUNDS = tuple(64 * 4 ** power for power in range(12))
+FLOAT_BYTES = 4
+
+
+@dataclass(slots=True)
+class Event:
+    operation: str  # name of instrumented call, e.g. "vector.query"
+    seconds: float  # wall time of call
+    batch_size: int = 1  # number of items in call, e.g. texts or queries
+    payload_bytes: int = 0  # approximate size of sent data
+    error: Optional[BaseException] = None  # raised exception, None on success
+
+
+Tracer = Callable[[Event], None]
+
+# copied on change, readers iterate without lock
+_tracers: tuple[Tracer, ...] = ()
+_tracers_lock = threading.Lock()
+
+
+def add_tracer(tracer: Tracer) -> None:
+    """
+    Start reporting events to tracer
+
+    :param tracer: called with every event, from thread of instrumented call
+    """
+    global _tracers
+    with _tracers_lock:
+        _tracers = (*_tracers, tracer)
+
+
+def remove_tracer(tracer: Tracer) -> None:
+    """
+    Stop reporting events to tracer
+
+    :param tracer: previously added tracer
+    """
+    global _tracers
+    with _tracers_lock:
+        _tracers = tuple(item for item in _tracers if item is not tracer)
+
+
+def emit(event: Event) -> None:
+    for tracer in _tracers:
+        tracer(event)
+
+
+def count(value: Any) -> int:
+    """Number of items in batch, text or single object counts as one"""
+    if value is None:
+        return 0
+    if isinstance(value, (str, bytes)) or not hasattr(value, "__len__"):
+        return 1
+    return len(value)
+
+
+def single(_: Any) -> int:
+    return 1
+
+
+def text_bytes(value: Any) -> int:
+    """UTF-8 size of text or sequence of texts"""
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    return sum(text_bytes(item) for item in value)
+
+
+def vector_bytes(value: Any) -> int:
+    """float32 size of vector or sequence of vectors"""
+    if value is None or len(value) == 0:
+        return 0
+    if hasattr(value[0], "__len__"):
+        return sum(len(vector) for vector in value) * FLOAT_BYTES
+    return len(value) * FLOAT_BYTES
+
+
+class Span:
+    """
+    Measure block of code which is not a single function.
+
+    with Span("ingestion.embed", batch_size=len(items)):
+        ...
+    """
+    __slots__ = ("operation", "batch_size", "payload_bytes", "_start")
+
+    def __init__(self, operation: str, batch_size: int = 1, payload_bytes: int = 0) -> None:
+        self.operation = operation
+        self.batch_size = batch_size
+        self.payload_bytes = payload_bytes
+        self._start = 0.0
+
+    def __enter__(self) -> "Span":
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if _tracers:
+            emit(Event(self.operation, time.perf_counter() - self._start, self.batch_size, self.payload_bytes, exc_val))
+
+
+def instrumented(
+        operation: str,
+        argument: Optional[str] = None,
+        batch: Callable[[Any], int] = count,
+        payload: Optional[Callable[[Any], int]] = None,
+) -> Callable[[Callable], Callable]:
+    """
+    Report every call of decorated function or coroutine function as event.
+
+    @instrumented("embedding.get_many", "texts", payload=text_bytes)
+    def get_many(self, texts): ...
+
+    :param operation: name of event
+    :param argument: name of parameter measured by `batch` and `payload`, batch of one without payload if not set
+    :param batch: number of items in argument
+    :param payload: size of argument in bytes, no payload if not set
+    :return: decorator
+    """
+
+    def decorator(function: Callable) -> Callable:
+        signature = inspect.signature(function)
+
+        def measure(args: tuple, kwargs: dict) -> tuple[int, int]:
+            if argument is None:
+                return 1, 0
+            value = signature.bind_partial(*args, **kwargs).arguments.get(argument)
+            return batch(value), payload(value) if payload is not None else 0
+
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                if not _tracers:
+                    return await function(*args, **kwargs)
+                start = time.perf_counter()
+                error = None
+                try:
+                    return await function(*args, **kwargs)
+                except BaseException as raised:
+                    error = raised
+                    raise
+                finally:
+                    emit(Event(operation, time.perf_counter() - start, *measure(args, kwargs), error))
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not _tracers:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                error = None
+                try:
+                    return function(*args, **kwargs)
+                except BaseException as raised:
+                    error = raised
+                    raise
+                finally:
+                    emit(Event(operation, time.perf_counter() - start, *measure(args, kwargs), error))
+        return wrapper
+
+    return decorator
+
+
+class Histogram:
+    """Counts of observed values in buckets with fixed upper bounds, last bucket is unbounded"""
+    __slots__ = ("bounds", "counts", "count", "total", "max")
+
+    def __init__(self, bounds: Sequence[float]) -> None:
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate of quantile, interpolated linearly inside bucket
+
+        :param q: quantile between 0 and 1
+        :return: estimated value, 0 if nothing observed
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket in enumerate(self.counts):
+            if bucket and seen + bucket >= rank:
+                lower = self.bounds[index - 1] if index else 0.0
+                upper = self.bounds[index] if index < len(self.bounds) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / bucket, self.max)
+            seen += bucket
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "bounds": list(self.bounds),
+            "counts": list(self.counts),
+        }
+
+
+@dataclass(slots=True)
+class _Operation:
+    latency: Histogram
+    batch_size: Histogram
+    payload_bytes: Histogram
+    errors: dict[str, int]
+
+
+class HistogramCollector:
+    """
+    In-process tracer aggregating events per operation into histograms of latency, batch size and payload size.
+
+    Errors are counted per exception type. `snapshot` is plain data for any exporter, `prometheus` renders
+    text exposition format.
+    """
+
+    def __init__(
+            self,
+            latency_bounds: Sequence[float] = LATENCY_BOUNDS,
+            batch_bounds: Sequence[float] = BATCH_BOUNDS,
+            payload_bounds: Sequence[float] = PAYLOAD_BOUNDS,
+    ) -> None:
+        """
+        Set up empty collector, register it with `add_tracer`
+
+        :param latency_bounds: upper bounds of latency buckets in seconds
+        :param batch_bounds: upper bounds of batch size buckets
+        :param payload_bounds: upper bounds of payload buckets in bytes
+        """
+        self.latency_bounds = latency_bounds
+        self.batch_bounds = batch_bounds
+        self.payload_bounds = payload_bounds
+        self._operations: dict[str, _Operation] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event: Event) -> None:
+        with self._lock:
+            operation = self._operations.get(event.operation)
+            if operation is None:
+                operation = self._operations[event.operation] = _Operation(
+                    Histogram(self.latency_bounds), Histogram(self.batch_bounds), Histogram(self.payload_bounds), {},
+                )
+            operation.latency.observe(event.seconds)
+            operation.batch_size.observe(event.batch_size)
+            operation.payload_bytes.observe(event.payload_bytes)
+            if event.error is not None:
+                name = type(event.error).__name__
+                operation.errors[name] = operation.errors.get(name, 0) + 1
+
+    def reset(self) -> None:
+        with self._lock:
+            self._operations.clear()
+
+    def snapshot(self) -> dict[str, dict]:
+        """
+        Copy of collected data
+
+        :return: operation name to its latency, batch_size and payload_bytes histograms and error counts
+        """
+        with self._lock:
+            return {
+                name: {
+                    "latency": operation.latency.to_dict(),
+                    "batch_size": operation.batch_size.to_dict(),
+                    "payload_bytes": operation.payload_bytes.to_dict(),
+                    "errors": dict(operation.errors),
+                }
+                for name, operation in self._operations.items()
+            }
+
+    def prometheus(self, prefix: str = "muninn") -> str:
+        """
+        Render collected data in Prometheus text exposition format
+
+        :param prefix: prefix of metric names
+        :return: text for /metrics endpoint
+        """
+        lines = []
+        metrics = (("latency", "latency_seconds"), ("batch_size", "batch_size"), ("payload_bytes", "payload_bytes"))
+        snapshot = self.snapshot()
+        for key, metric in metrics:
+            lines.append(f"# TYPE {prefix}_{metric} histogram")
+            for name, operation in snapshot.items():
+                histogram = operation[key]
+                cumulative = 0
+                for bound, bucket in zip([*histogram["bounds"], "+Inf"], histogram["counts"]):
+                    cumulative += bucket
+                    lines.append(f'{prefix}_{metric}_bucket{{operation="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}_{metric}_sum{{operation="{name}"}} {histogram["sum"]}')
+                lines.append(f'{prefix}_{metric}_count{{operation="{name}"}} {histogram["count"]}')
+        lines.append(f"# TYPE {prefix}_errors_total counter")
+        for name, operation in snapshot.items():
+            for error, total in operation["errors"].items():
+                lines.append(f'{prefix}_errors_total{{operation="{name}",error="{error}"}} {total}')
+        return "\n".join(lines) + "\n"
@@ -1,6 +1,31 @@
-from . import (
-    embedding,
-    reference,
-    facts,
-)
-from .embedding import Embedding
+from typing import TYPE_CHECKING
+
+from ..utils import lazy_attributes
+
+if TYPE_CHECKING:
+    from . import (
+        embedding,
+        cache,
+        reference,
+        facts,
+        transformer,
+    )
+    from .embedding import Embedding, AsyncEmbedding
+    from .cache import CachedEmbedding, EmbeddingCache
+    from .facts import FactExtractor, Triple
+    from .transformer import LocalEmbedding
+
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    "embedding": "embedding",
+    "cache": "cache",
+    "reference": "reference",
+    "facts": "facts",
+    "transformer": "transformer",
+    "Embedding": "embedding",
+    "AsyncEmbedding": "embedding",
+    "CachedEmbedding": "cache",
+    "EmbeddingCache": "cache",
+    "FactExtractor": "facts",
+    "Triple": "facts",
+    "LocalEmbedding": "transformer",
+})
@@ -0,0 +1,236 @@
+import hashlib
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Sequence, Protocol, Iterable
+
+__all__ = (
+    "CacheStats",
+    "CachedEmbedding",
+    "EmbeddingCache",
+    "cache_key",
+)
+
+DEFAULT_MAX_ITEMS = 10_000
+
+
+class Embedder(Protocol):
+    model: str
+
+    def get(self, text: str) -> list[float]:
+        ...
+
+    def get_many(self, texts: Sequence[str]) -> list[list[float]]:
+        ...
+
+
+def cache_key(model: str, text: str) -> str:
+    """
+    Content address of embedding, same text embedded by other model is different embedding.
+
+    :param model: name of embedding model
+    :param text: embedded text
+    :return: hex digest key
+    """
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+def as_float32(embedding: Sequence[float]) -> list[float]:
+    """
+    Embedding rounded to float32, the same values as stored on disk, so every cache tier returns equal vectors.
+
+    :param embedding: vector of any float precision
+    :return: list of python floats holding float32 values
+    """
+    return array("f", embedding).tolist()
+
+
+@dataclass(slots=True)
+class CacheStats:
+    hits: int = 0  # found in memory
+    disk_hits: int = 0  # found on disk only, promoted to memory
+    misses: int = 0  # not cached at all
+    evictions: int = 0  # dropped from memory to keep its size bounded
+
+    @property
+    def lookups(self) -> int:
+        return self.hits + self.disk_hits + self.misses
+
+    @property
+    def hit_rate(self) -> float:
+        return (self.hits + self.disk_hits) / self.lookups if self.lookups else 0.0
+
+
+class EmbeddingCache:
+    """
+    Two tier embedding store. Bounded LRU in memory backed by optional SQLite file surviving restarts.
+
+    Vectors are stored as float32 in both tiers, packed blobs on disk. Every lookup of unique key counts once
+    in stats, duplicates in one batch are not extra misses or hits.
+    """
+    max_items: int
+    stats: CacheStats
+
+    def __init__(self, max_items: int = DEFAULT_MAX_ITEMS, path: Optional[str] = None) -> None:
+        """
+        Set up cache tiers.
+
+        :param max_items: max number of embeddings held in memory
+        :param path: sqlite file of persistent tier, memory only if not set
+        """
+        self.max_items = max_items
+        self.stats = CacheStats()
+        self._memory: OrderedDict[str, list[float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk: Optional[sqlite3.Connection] = None
+        if path:
+            self._disk = sqlite3.connect(path, check_same_thread=False)
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS embedding_cache (key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+            )
+            self._disk.commit()
+
+    def __len__(self) -> int:
+        return len(self._memory)
+
+    def close(self) -> None:
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
+
+    def _remember(self, key: str, embedding: list[float]) -> None:
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+            self.stats.evictions += 1
+
+    def get_many(self, keys: Sequence[str]) -> list[Optional[list[float]]]:
+        """
+        Look up cached embeddings.
+
+        :param keys: cache keys
+        :return: copy of embedding or None for each key, caller may change it without touching cache
+        """
+        with self._lock:
+            found: dict[str, Optional[list[float]]] = {}
+            missing: list[str] = []
+            for key in dict.fromkeys(keys):
+                embedding = self._memory.get(key)
+                if embedding is not None:
+                    self._memory.move_to_end(key)
+                    self.stats.hits += 1
+                else:
+                    missing.append(key)
+                found[key] = embedding
+            if missing:
+                from_disk = self._load(missing)
+                for key in missing:
+                    embedding = from_disk.get(key)
+                    if embedding is None:
+                        self.stats.misses += 1
+                        continue
+                    self.stats.disk_hits += 1
+                    self._remember(key, embedding)
+                    found[key] = embedding
+            return [None if found[key] is None else list(found[key]) for key in keys]
+
+    def get(self, key: str) -> Optional[list[float]]:
+        return self.get_many([key])[0]
+
+    def put_many(self, items: Iterable[tuple[str, list[float]]]) -> None:
+        """
+        Store embeddings in both tiers, rounded to float32.
+
+        :param items: pairs of cache key and embedding
+        """
+        items = [(key, array("f", embedding)) for key, embedding in items]
+        with self._lock:
+            for key, vector in items:
+                self._remember(key, vector.tolist())
+            if self._disk is not None:
+                self._disk.executemany(
+                    "INSERT OR REPLACE INTO embedding_cache (key, vector) VALUES (?, ?)",
+                    [(key, vector.tobytes()) for key, vector in items],
+                )
+                self._disk.commit()
+
+    def put(self, key: str, embedding: list[float]) -> None:
+        self.put_many([(key, embedding)])
+
+    def _load(self, keys: Sequence[str]) -> dict[str, list[float]]:
+        if self._disk is None:
+            return {}
+        loaded = {}
+        # stay below sqlite limit of host parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self._disk.execute(
+                f"SELECT key, vector FROM embedding_cache WHERE key IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            for key, blob in rows:
+                vector = array("f")
+                vector.frombytes(blob)
+                loaded[key] = vector.tolist()
+        return loaded
+
+
+class CachedEmbedding:
+    """
+    Embedding calculator which never asks model twice for the same text.
+
+    Wraps any embedder with `get` and `get_many`, e.g. `Embedding`.
+    """
+
+    def __init__(self, embedder: Embedder, cache: Optional[EmbeddingCache] = None) -> None:
+        """
+        Set up cached embedder.
+
+        :param embedder: calculates embeddings on cache miss
+        :param cache: shared cache, new in memory cache if not set
+        """
+        self.embedder = embedder
+        self.cache = cache if cache is not None else EmbeddingCache()
+
+    @property
+    def model(self) -> str:
+        return self.embedder.model
+
+    @property
+    def stats(self) -> CacheStats:
+        return self.cache.stats
+
+    def get(self, text: str) -> list[float]:
+        """
+        Calculate embedding vector or reuse the cached one
+
+        :param text: text to calculate embedding for
+        :return: embedding vector representing text topics
+        """
+        return self.get_many([text])[0]
+
+    def get_many(self, texts: Sequence[str], **kwargs) -> list[list[float]]:
+        """
+        Calculate embedding vectors of texts, only cache misses are sent to embedder.
+
+        Computed embeddings are returned rounded to float32, the same as later cache hits.
+
+        :param texts: texts to calculate embeddings for
+        :param kwargs: passed to embedder get_many
+        :return: embedding vectors in the same order as texts
+        """
+        keys = [cache_key(self.model, text) for text in texts]
+        embeddings = self.cache.get_many(keys)
+        missing = {key: text for key, text, embedding in zip(keys, texts, embeddings) if embedding is None}
+        if missing:
+            computed = {
+                key: as_float32(embedding)
+                for key, embedding in zip(missing, self.embedder.get_many(list(missing.values()), **kwargs))
+            }
+            self.cache.put_many(computed.items())
+            embeddings = [computed[key] if embedding is None else embedding for key, embedding in zip(keys, embeddings)]
+        return embeddings
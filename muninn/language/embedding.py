@@ -1,13 +1,28 @@
+import asyncio
 import os
-from typing import Optional
+import random
+import time
+from typing import Optional, Sequence, Callable, Awaitable
 
 import openai
-from dotenv import load_dotenv
 
-load_dotenv(override=True)
-openai.api_key = os.getenv("OPENAI_API_KEY")
+from ..instrumentation import instrumented, single, text_bytes
+from ..utils import load_environment
 
 DEFAULT_MODEL = "text-embedding-ada-002"
+DEFAULT_BATCH_SIZE = 256
+DEFAULT_CONCURRENCY = 8
+DEFAULT_MAX_RETRIES = 6
+
+Transport = Callable[[list[str], str], Awaitable[list[list[float]]]]
+
+
+class RateLimitError(Exception):
+    """Embedding service refused request because of rate limit (HTTP 429)"""
+
+    def __init__(self, message: str = "rate limited", retry_after: Optional[float] = None) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
 
 
 class Embedding:
@@ -25,12 +40,14 @@ class Embedding:
             org_key: Optional[str] = None,
     ) -> None:
         """Set up client and parse API keys"""
+        load_environment()
         self.model = model or DEFAULT_MODEL
         self.api_key = api_key or os.environ.get("OPENAI_API_KEY")
         self.org_key = org_key or os.environ.get("OPEN_API_ORG_KEY")
         if not self.api_key:
             print("OPEN_API_KEY is not set, please set your key with environment variable")
 
+    @instrumented("embedding.get", "text", single, text_bytes)
     def get(self, text: str) -> list[float]:
         """
         Calculate embedding vector with open api
@@ -45,3 +62,160 @@ class Embedding:
             organization=self.org_key,
         )
         return response["data"][-1]["embedding"]
+
+    @instrumented("embedding.get_many", "texts", payload=text_bytes)
+    def get_many(self, texts: Sequence[str], batch_size: int = DEFAULT_BATCH_SIZE) -> list[list[float]]:
+        """
+        Calculate embedding vectors for many texts with as few API requests as possible
+
+        :param texts: texts to calculate embeddings for
+        :param batch_size: max number of texts sent in one request
+        :return: embedding vectors in the same order as texts
+        """
+        embeddings: list[list[float]] = []
+        for start in range(0, len(texts), batch_size):
+            chunk = list(texts[start:start + batch_size])
+            response = openai.Embedding.create(
+                input=chunk,
+                model=self.model,
+                api_key=self.api_key,
+                organization=self.org_key,
+            )
+            # api does not promise to keep order of inputs, it tags each item with its index instead
+            data = sorted(response["data"], key=lambda item: item["index"])
+            embeddings.extend(item["embedding"] for item in data)
+        return embeddings
+
+
+class AsyncEmbedding:
+    """
+    Asyncio embedding calculator with the same interface as `Embedding`.
+
+    Keeps at most `concurrency` requests in flight, merges concurrent calls for the same text into one request
+    and backs off all requests together when service answers with rate limit error.
+    Requests go through `transport`, an async callable `(texts, model) -> embeddings`, OpenAI API by default.
+    """
+
+    def __init__(
+            self,
+            model: Optional[str] = None,
+            api_key: Optional[str] = None,
+            org_key: Optional[str] = None,
+            concurrency: int = DEFAULT_CONCURRENCY,
+            max_retries: int = DEFAULT_MAX_RETRIES,
+            min_backoff: float = 0.5,
+            max_backoff: float = 60.0,
+            transport: Optional[Transport] = None,
+    ) -> None:
+        """
+        Set up client and parse API keys
+
+        :param concurrency: max number of requests in flight
+        :param max_retries: give up after this many rate limited attempts of one request
+        :param min_backoff: first backoff delay in seconds
+        :param max_backoff: backoff delay limit in seconds
+        :param transport: sends texts to embedding service, OpenAI API if not set
+        """
+        load_environment()
+        self.model = model or DEFAULT_MODEL
+        self.api_key = api_key or os.environ.get("OPENAI_API_KEY")
+        self.org_key = org_key or os.environ.get("OPEN_API_ORG_KEY")
+        if not self.api_key and transport is None:
+            print("OPEN_API_KEY is not set, please set your key with environment variable")
+        self.max_retries = max_retries
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.transport = transport or self._openai_transport
+        self._slots = asyncio.Semaphore(concurrency)
+        self._pending: dict[str, asyncio.Future] = {}
+        self._backoff = 0.0
+        self._resume_at = 0.0
+
+    async def _openai_transport(self, texts: list[str], model: str) -> list[list[float]]:
+        try:
+            response = await openai.Embedding.acreate(
+                input=texts,
+                model=model,
+                api_key=self.api_key,
+                organization=self.org_key,
+            )
+        except openai.error.RateLimitError as error:
+            retry_after = (error.headers or {}).get("retry-after")
+            raise RateLimitError(str(error), float(retry_after) if retry_after else None) from error
+        data = sorted(response["data"], key=lambda item: item["index"])
+        return [item["embedding"] for item in data]
+
+    async def _request(self, texts: list[str]) -> list[list[float]]:
+        for attempt in range(self.max_retries + 1):
+            async with self._slots:
+                # cool down shared by all requests, no point in hammering rate limited service
+                delay = self._resume_at - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                try:
+                    embeddings = await self.transport(texts, self.model)
+                except RateLimitError as error:
+                    if attempt == self.max_retries:
+                        raise
+                    self._backoff = min(self.max_backoff, max(self.min_backoff, self._backoff * 2))
+                    wait = error.retry_after or self._backoff * random.uniform(0.5, 1.0)
+                    self._resume_at = max(self._resume_at, time.monotonic() + wait)
+                    continue
+                # recover throughput gradually after service stops refusing us
+                self._backoff /= 2
+                return embeddings
+        raise AssertionError("unreachable")
+
+    async def get(self, text: str) -> list[float]:
+        """
+        Calculate embedding vector with open api
+
+        :param text: text to calculate embedding for
+        :return: embedding vector representing text topics
+        """
+        return (await self.get_many([text]))[0]
+
+    @instrumented("async_embedding.get_many", "texts", payload=text_bytes)
+    async def get_many(self, texts: Sequence[str], batch_size: int = DEFAULT_BATCH_SIZE) -> list[list[float]]:
+        """
+        Calculate embedding vectors for many texts, batches are sent concurrently
+
+        :param texts: texts to calculate embeddings for
+        :param batch_size: max number of texts sent in one request
+        :return: embedding vectors in the same order as texts
+        """
+        loop = asyncio.get_running_loop()
+        futures: list[asyncio.Future] = []
+        owned: dict[str, asyncio.Future] = {}
+        for text in texts:
+            future = self._pending.get(text)
+            if future is None:
+                # nobody asks for this text yet, this call sends it
+                future = owned[text] = self._pending[text] = loop.create_future()
+            futures.append(future)
+        own_texts = list(owned)
+        try:
+            await asyncio.gather(*(
+                self._resolve(own_texts[start:start + batch_size], owned)
+                for start in range(0, len(own_texts), batch_size)
+            ))
+        finally:
+            for text, future in owned.items():
+                if not future.done():
+                    future.cancel()
+                del self._pending[text]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    async def _resolve(self, texts: list[str], futures: dict[str, asyncio.Future]) -> None:
+        try:
+            embeddings = await self._request(texts)
+        except Exception as error:
+            for text in texts:
+                futures[text].set_exception(error)
+            return
+        for text, embedding in zip(texts, embeddings):
+            futures[text].set_result(embedding)
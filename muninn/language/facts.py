@@ -1,10 +1,19 @@
+import hashlib
 import os
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Sequence, Callable, TYPE_CHECKING
 
 import openai
-from dotenv import load_dotenv
 
-load_dotenv(override=True)
-openai.api_key = os.getenv("OPENAI_API_KEY")
+from ..instrumentation import instrumented, single, text_bytes
+from ..utils import load_environment
+
+if TYPE_CHECKING:
+    from ..database.graph import Fact
+
 TURBO_35 = "gpt-3.5-turbo"
 CURIE = "text-curie-001"
 DEFAULT = TURBO_35
@@ -27,21 +36,225 @@ FACT_EXTRACTOR_PROMPT = (
     "\n\nInput: {text}\n"
     "Output:\n"
 )
-print(FACT_EXTRACTOR_PROMPT)
-target_text = "Valji> My abilities are: Shield Bash: I can use your shield to strike your enemy and stun them for a " \
-              "short period of time.Precise Strike: I have the ability to aim your attacks more accurately, " \
-              "giving you a better chance of hitting your target.Surprising strength: I can double my damage " \
-              "to enemies who have never fought me before. Endurance: I have increased stamina and I can " \
-              "endure physical challenges for longer periods of time."
-
-task = FACT_EXTRACTOR_PROMPT.format(text=target_text)
-
-response = openai.ChatCompletion.create(
-    model=DEFAULT,
-    prompt=task,
-    temperature=0,
-    max_tokens=180,
-    top_p=1,
-    frequency_penalty=0,
-    presence_penalty=0
+
+# instructions and examples of single input prompt, inputs are appended numbered
+FACT_BATCH_PROMPT = (
+    FACT_EXTRACTOR_PROMPT.split("\n\nInput: {text}")[0]
+    + "\n\nThere are {count} inputs. Answer each of them on separate line starting with 'Output N:', where N is "
+      "number of its input. Leave the line after 'Output N:' empty if input has no facts.\n\n"
+    + "{inputs}\n"
 )
+DEFAULT_TOKEN_BUDGET = 1500
+DEFAULT_OUTPUT_TOKENS = 180
+DEFAULT_CACHE_SIZE = 10_000
+_ROW = re.compile(r"\|([^|\n]+)\|([^|\n]+)\|([^|\n]+)\|")
+_OUTPUT = re.compile(r"^\s*-?\s*Output\s*(\d+)\s*:", re.MULTILINE)
+
+
+@dataclass(slots=True, frozen=True)
+class Triple:
+    subject: str
+    predicate: str
+    object: str
+
+    @property
+    def text(self) -> str:
+        return f"{self.subject} {self.predicate} {self.object}"
+
+    def to_fact(self, embedding_id: Optional[str] = None) -> "Fact":
+        """
+        Fact node of graph with subject and object entities
+
+        :param embedding_id: id of fact vector in vector storage
+        """
+        from ..database.graph import Fact
+
+        return Fact(
+            text=self.text,
+            embedding_id=embedding_id,
+            entities=[(self.subject, "subject"), (self.object, "object")],
+            predicates=[self.predicate],
+        )
+
+
+def parse_facts(output: str) -> list[Triple]:
+    """
+    Parse model answer in format |Subject1|Predicate1|Object1|-|Subject2|Predicate2|Object2|-
+
+    :param output: raw answer of model
+    :return: triples in order of answer, incomplete rows are skipped
+    """
+    triples = []
+    for row in _ROW.finditer(output):
+        subject, predicate, object_ = (cell.strip() for cell in row.groups())
+        if subject and predicate and object_:
+            triples.append(Triple(subject, predicate, object_))
+    return triples
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count of english text, about four characters per token"""
+    return len(text) // 4 + 1
+
+
+@instrumented("facts.chat_completion", "prompt", single, text_bytes)
+def chat_completion(
+        prompt: str,
+        model: str = DEFAULT,
+        max_tokens: int = DEFAULT_OUTPUT_TOKENS,
+        api_key: Optional[str] = None,
+) -> str:
+    """
+    Ask chat model single question
+
+    :param prompt: user message
+    :param model: chat model name
+    :param max_tokens: answer length limit
+    :param api_key: OpenAI key, OPENAI_API_KEY environment variable if not set
+    :return: answer text
+    """
+    load_environment()
+    response = openai.ChatCompletion.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        api_key=api_key or os.environ.get("OPENAI_API_KEY"),
+        temperature=0,
+        max_tokens=max_tokens,
+        top_p=1,
+        frequency_penalty=0,
+        presence_penalty=0
+    )
+    return response["choices"][0]["message"]["content"]
+
+
+def extract_facts(text: str, model: str = DEFAULT, api_key: Optional[str] = None) -> str:
+    """
+    Ask language model for table of facts in text
+
+    :param text: text to analyze
+    :param model: chat model name
+    :param api_key: OpenAI key, OPENAI_API_KEY environment variable if not set
+    :return: raw answer in format |Object|Predicate|Subject|-
+    """
+    return chat_completion(FACT_EXTRACTOR_PROMPT.format(text=text), model=model, api_key=api_key)
+
+
+class FactExtractor:
+    """
+    Fact extraction with as few model calls as possible.
+
+    Short inputs are packed into one prompt until token budget is reached and answers are split back per input.
+    Results are cached by content hash, the same text is never extracted twice.
+    """
+
+    def __init__(
+            self,
+            model: str = DEFAULT,
+            api_key: Optional[str] = None,
+            token_budget: int = DEFAULT_TOKEN_BUDGET,
+            output_tokens: int = DEFAULT_OUTPUT_TOKENS,
+            cache_size: int = DEFAULT_CACHE_SIZE,
+            complete: Optional[Callable[[str, int], str]] = None,
+            count_tokens: Callable[[str], int] = estimate_tokens,
+    ) -> None:
+        """
+        Set up extractor.
+
+        :param model: chat model name
+        :param api_key: OpenAI key, OPENAI_API_KEY environment variable if not set
+        :param token_budget: max estimated tokens of inputs packed into one prompt
+        :param output_tokens: answer tokens reserved per packed input
+        :param cache_size: max number of texts with cached facts
+        :param complete: asks model `(prompt, max_tokens) -> answer`, OpenAI chat completion if not set
+        :param count_tokens: estimates number of tokens of text
+        """
+        self.model = model
+        self.api_key = api_key
+        self.token_budget = token_budget
+        self.output_tokens = output_tokens
+        self.cache_size = cache_size
+        self.complete = complete or self._chat_completion
+        self.count_tokens = count_tokens
+        self.requests = 0
+        self._cache: OrderedDict[str, list[Triple]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _chat_completion(self, prompt: str, max_tokens: int) -> str:
+        return chat_completion(prompt, model=self.model, max_tokens=max_tokens, api_key=self.api_key)
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model}\0{text}".encode("utf-8")).hexdigest()
+
+    def _cached(self, key: str) -> Optional[list[Triple]]:
+        with self._lock:
+            triples = self._cache.get(key)
+            if triples is not None:
+                self._cache.move_to_end(key)
+            return triples
+
+    def _remember(self, key: str, triples: list[Triple]) -> None:
+        with self._lock:
+            self._cache[key] = triples
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _pack(self, texts: Sequence[str]) -> list[list[str]]:
+        batches: list[list[str]] = []
+        used = 0
+        for text in texts:
+            tokens = self.count_tokens(text)
+            if batches and used + tokens <= self.token_budget:
+                batches[-1].append(text)
+                used += tokens
+            else:
+                batches.append([text])
+                used = tokens
+        return batches
+
+    def _ask(self, texts: list[str]) -> dict[str, list[Triple]]:
+        self.requests += 1
+        if len(texts) == 1:
+            answer = self.complete(FACT_EXTRACTOR_PROMPT.format(text=texts[0]), self.output_tokens)
+            return {texts[0]: parse_facts(answer)}
+        inputs = "\n".join(f"Input {number}: {text}" for number, text in enumerate(texts, start=1))
+        prompt = FACT_BATCH_PROMPT.format(count=len(texts), inputs=inputs)
+        answer = self.complete(prompt, self.output_tokens * len(texts))
+        parts = _OUTPUT.split(answer)
+        # parts: [preamble, number, output, number, output, ...]
+        answers = {int(number): output for number, output in zip(parts[1::2], parts[2::2])}
+        results = {}
+        for number, text in enumerate(texts, start=1):
+            if number in answers:
+                results[text] = parse_facts(answers[number])
+            else:
+                # model merged or skipped answers, ask for this one alone
+                results.update(self._ask([text]))
+        return results
+
+    def extract(self, text: str) -> list[Triple]:
+        """
+        Extract facts of single text
+
+        :param text: text to analyze
+        :return: fact triples
+        """
+        return self.extract_many([text])[0]
+
+    @instrumented("facts.extract_many", "texts", payload=text_bytes)
+    def extract_many(self, texts: Sequence[str]) -> list[list[Triple]]:
+        """
+        Extract facts of many texts, packed into as few model calls as token budget allows
+
+        :param texts: texts to analyze
+        :return: fact triples of each text in input order
+        """
+        keys = [self._key(text) for text in texts]
+        found = {key: self._cached(key) for key in keys}
+        missing = list({text: None for key, text in zip(keys, texts) if found[key] is None})
+        for batch in self._pack(missing):
+            for text, triples in self._ask(batch).items():
+                key = self._key(text)
+                found[key] = triples
+                self._remember(key, triples)
+        return [list(found[key]) for key in keys]
@@ -1,5 +1,11 @@
 # place functions here until they fit into any other group or new group emerges
-import spacy
+import functools
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Iterable, Iterator, Optional, Sequence
+
+if TYPE_CHECKING:
+    from spacy.language import Language
+    from spacy.tokens import Doc
 
 long_text = "I am Valji Snoreshort and I am 25 years old. I am level 3 gnome warrior with short beard. My Equipment: " \
             "I use short sword with shield on melee combat. For a range combat I use short bow and arrows. As a " \
@@ -15,20 +21,132 @@ co_reference_help_text = "Valji is 25 years old and he is level 3 gnome warrior.
 # noinspection SpellCheckingInspection
 core_ref_model = "en_coreference_web_trf"
 
-nlp = spacy.load("en_core_web_md")
-nlp_coref = spacy.load(core_ref_model)
-# replace span to keep head(highest rank core of span) of span
-nlp_coref.replace_listeners("transformer", "coref", ["model.tok2vec"])
-nlp_coref.replace_listeners("transformer", "span_resolver", ["model.tok2vec"])
+base_model = "en_core_web_md"
+# span groups written by span_resolver, numbered from 1
+CLUSTER_PREFIX = "coref_clusters_"
+DEFAULT_BATCH_SIZE = 32
+
+
+@functools.cache
+def load() -> "Language":
+    """
+    Load pipeline with coreference resolution, models are loaded only once per process.
+
+    :return: spacy pipeline with coref and span_resolver components
+    """
+    import spacy
+
+    nlp = spacy.load(base_model)
+    nlp_coref = spacy.load(core_ref_model)
+    # replace span to keep head(highest rank core of span) of span
+    nlp_coref.replace_listeners("transformer", "coref", ["model.tok2vec"])
+    nlp_coref.replace_listeners("transformer", "span_resolver", ["model.tok2vec"])
+
+    nlp.add_pipe("coref", source=nlp_coref)
+    nlp.add_pipe("span_resolver", source=nlp_coref)
+    return nlp
+
+
+@dataclass(slots=True)
+class Mention:
+    start: int  # char offset of mention start in text
+    end: int  # char offset after mention end
+    text: str
+
+
+@dataclass(slots=True)
+class ResolvedText:
+    source: str  # original text
+    clusters: list[list[Mention]]  # mentions of the same thing, first mention is antecedent
+    resolved: str  # source with each mention replaced by its antecedent
+
+
+def resolve_doc(doc: "Doc") -> ResolvedText:
+    """
+    Convert analyzed document to compact resolution, document itself can be dropped afterwards.
+
+    :param doc: document processed by coref pipeline
+    :return: clusters and text with references replaced by antecedents
+    """
+    clusters = []
+    for key in sorted(
+            (key for key in doc.spans if key.startswith(CLUSTER_PREFIX)),
+            key=lambda key: int(key[len(CLUSTER_PREFIX):]),
+    ):
+        mentions = [Mention(span.start_char, span.end_char, span.text) for span in doc.spans[key]]
+        if mentions:
+            clusters.append(sorted(mentions, key=lambda mention: mention.start))
+    replacements = {}
+    for mentions in clusters:
+        antecedent = mentions[0]
+        for mention in mentions[1:]:
+            replacements.setdefault(mention.start, (mention.end, antecedent.text))
+    parts = []
+    position = 0
+    for start in sorted(replacements):
+        end, text = replacements[start]
+        if start < position:
+            # overlaps already replaced mention
+            continue
+        parts.append(doc.text[position:start])
+        parts.append(text)
+        position = end
+    parts.append(doc.text[position:])
+    return ResolvedText(source=doc.text, clusters=clusters, resolved="".join(parts))
+
+
+class CorefResolver:
+    """
+    Coreference resolution service, pipeline is loaded once and documents are processed in batches.
+
+    resolver = CorefResolver(batch_size=64, n_process=-1)
+    for resolved in resolver.stream(texts):
+        ...
+    """
+
+    def __init__(
+            self,
+            batch_size: int = DEFAULT_BATCH_SIZE,
+            n_process: int = -1,
+            nlp: Optional["Language"] = None,
+    ) -> None:
+        """
+        Set up resolver, pipeline is loaded on first use or with `load`.
+
+        :param batch_size: documents processed together by each process
+        :param n_process: worker processes for large inputs, -1 uses all cores
+        :param nlp: own coref pipeline, shared `load()` pipeline if not set
+        """
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self._nlp = nlp
+
+    def load(self) -> "Language":
+        """Load pipeline now instead of on first resolution"""
+        if self._nlp is None:
+            self._nlp = load()
+        return self._nlp
+
+    def stream(self, texts: Iterable[str]) -> Iterator[ResolvedText]:
+        """
+        Resolve texts lazily in input order, suitable for inputs not fitting into memory.
+
+        :param texts: texts to resolve
+        :return: generator of resolved texts
+        """
+        for doc in self.load().pipe(texts, batch_size=self.batch_size, n_process=self.n_process):
+            yield resolve_doc(doc)
 
-nlp.add_pipe("coref", source=nlp_coref)
-nlp.add_pipe("span_resolver", source=nlp_coref)
-print("loaded nlps")
+    def resolve_many(self, texts: Sequence[str]) -> list[ResolvedText]:
+        """
+        Resolve texts in batches, worker processes are started only if there is more than one batch.
 
-doc = nlp(co_reference_help_text)
-print("doc analyzed")
-print(doc.text)
-print(doc.spans)
+        :param texts: texts to resolve
+        :return: resolved texts in input order
+        """
+        n_process = self.n_process if len(texts) > self.batch_size else 1
+        docs = self.load().pipe(texts, batch_size=self.batch_size, n_process=n_process)
+        return [resolve_doc(doc) for doc in docs]
 
-print(doc.spans["coref_head_clusters_1"][1].root)
-print(doc.spans["coref_head_clusters_1"][1].root.sent)
+    def resolve(self, text: str) -> ResolvedText:
+        return resolve_doc(self.load()(text))
@@ -0,0 +1,282 @@
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable, Optional, Sequence
+
+import numpy as np
+
+from ..instrumentation import Span, instrumented, text_bytes
+
+if TYPE_CHECKING:
+    import torch
+
+__all__ = (
+    "DynamicBatcher",
+    "LocalEmbedding",
+    "TransformerEncoder",
+)
+
+DEFAULT_LOCAL_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+DEFAULT_MAX_LENGTH = 256
+DEFAULT_MAX_BATCH_SIZE = 32
+# seconds the first waiting text may wait for more texts to join its batch
+DEFAULT_MAX_LATENCY = 0.01
+
+
+class TransformerEncoder:
+    """
+    Sentence embedding model of transformers library on CPU, mean pooled and normalized.
+
+    Model is loaded on first use, so constructing encoder is cheap and torch is imported only when needed.
+    """
+
+    def __init__(
+            self,
+            model: str = DEFAULT_LOCAL_MODEL,
+            device: str = "cpu",
+            threads: Optional[int] = None,
+            max_length: int = DEFAULT_MAX_LENGTH,
+            normalize: bool = True,
+    ) -> None:
+        """
+        Set up encoder
+
+        :param model: name or local path of sentence embedding model, local path works offline
+        :param device: torch device
+        :param threads: torch intra-op threads, torch default if not set
+        :param max_length: longer texts are truncated to this many tokens
+        :param normalize: scale vectors to unit length, then l2 distance ranks like cosine
+        """
+        self.model = model
+        self.device = device
+        self.threads = threads
+        self.max_length = max_length
+        self.normalize = normalize
+        self._tokenizer = None
+        self._model = None
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        """Load tokenizer and model once"""
+        with self._lock:
+            if self._model is not None:
+                return
+            import torch
+            from transformers import AutoModel, AutoTokenizer
+
+            if self.threads:
+                torch.set_num_threads(self.threads)
+            self._tokenizer = AutoTokenizer.from_pretrained(self.model)
+            model = AutoModel.from_pretrained(self.model).to(self.device)
+            model.eval()
+            self._model = model
+
+    @staticmethod
+    def _mean_pool(hidden: "torch.Tensor", mask: "torch.Tensor") -> "torch.Tensor":
+        mask = mask.unsqueeze(-1).to(hidden.dtype)
+        return (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+
+    def __call__(self, texts: Sequence[str]) -> np.ndarray:
+        """
+        Embed batch of texts, padded to the longest text of batch
+
+        :param texts: texts of similar length keep padding low
+        :return: float32 matrix, row per text
+        """
+        self.load()
+        import torch
+
+        batch = self._tokenizer(
+            list(texts), padding="longest", truncation=True, max_length=self.max_length, return_tensors="pt",
+        ).to(self.device)
+        with torch.inference_mode():
+            hidden = self._model(**batch).last_hidden_state
+            vectors = self._mean_pool(hidden, batch["attention_mask"])
+            if self.normalize:
+                vectors = torch.nn.functional.normalize(vectors, p=2, dim=1)
+        return vectors.to(torch.float32).cpu().numpy()
+
+
+@dataclass(slots=True)
+class _Request:
+    text: str
+    future: Future
+    arrived: float  # monotonic time of submit
+
+
+class DynamicBatcher:
+    """
+    Gathers texts of concurrent callers into batches for one encoder.
+
+    Worker thread waits until `max_batch_size` texts are queued or the oldest text waited `max_latency` seconds.
+    Gathered texts are sorted by length and cut into buckets, so short texts are not padded to the longest one.
+    """
+
+    def __init__(
+            self,
+            encode: Callable[[Sequence[str]], np.ndarray],
+            max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+            max_latency: float = DEFAULT_MAX_LATENCY,
+            length: Callable[[str], int] = len,
+    ) -> None:
+        """
+        Start worker thread
+
+        :param encode: embeds batch of texts into float32 matrix
+        :param max_batch_size: max number of texts encoded at once
+        :param max_latency: max seconds text waits for others to join its batch
+        :param length: cost of text used for bucketing, characters by default
+        """
+        self.encode = encode
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.length = length
+        self.batches = 0
+        self._queue: list[_Request] = []
+        self._state = threading.Condition()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, texts: Sequence[str]) -> list[Future]:
+        """
+        Enqueue texts, return immediately
+
+        :param texts: texts to embed
+        :return: future float32 vector of each text
+        """
+        now = time.monotonic()
+        requests = [_Request(text, Future(), now) for text in texts]
+        with self._state:
+            if self._closed:
+                raise RuntimeError("batcher is closed")
+            self._queue.extend(requests)
+            self._state.notify()
+        return [request.future for request in requests]
+
+    def close(self) -> None:
+        """Encode queued texts and stop worker"""
+        with self._state:
+            self._closed = True
+            self._state.notify()
+        self._worker.join()
+
+    def _take(self) -> Optional[list[_Request]]:
+        with self._state:
+            while True:
+                if self._queue:
+                    full = len(self._queue) >= self.max_batch_size
+                    wait = self._queue[0].arrived + self.max_latency - time.monotonic()
+                    if full or wait <= 0 or self._closed:
+                        # everything waiting goes, buckets split it by length
+                        taken, self._queue = self._queue, []
+                        return taken
+                    self._state.wait(wait)
+                elif self._closed:
+                    return None
+                else:
+                    self._state.wait()
+
+    def _run(self) -> None:
+        # worker must outlive any failure, callers of failed texts get the error and the rest keeps waiting
+        while (requests := self._take()) is not None:
+            try:
+                requests.sort(key=lambda request: self.length(request.text))
+            except Exception as error:
+                self._fail(requests, error)
+                continue
+            for start in range(0, len(requests), self.max_batch_size):
+                self._encode(requests[start:start + self.max_batch_size])
+
+    @staticmethod
+    def _fail(requests: list[_Request], error: Exception) -> None:
+        for request in requests:
+            if not request.future.done():
+                request.future.set_exception(error)
+
+    def _encode(self, bucket: list[_Request]) -> None:
+        # identical texts of concurrent callers are encoded once
+        texts = list(dict.fromkeys(request.text for request in bucket))
+        try:
+            with Span("local_embedding.batch", len(texts), text_bytes(texts)):
+                encoded = self.encode(texts)
+            if len(encoded) != len(texts):
+                raise ValueError(f"encoder returned {len(encoded)} vectors for {len(texts)} texts")
+            vectors = dict(zip(texts, encoded))
+            results = [vectors[request.text] for request in bucket]
+        except Exception as error:
+            self._fail(bucket, error)
+            return
+        self.batches += 1
+        for request, vector in zip(bucket, results):
+            if not request.future.done():
+                request.future.set_result(vector)
+
+
+class LocalEmbedding:
+    """
+    Local embedding calculator with the same interface as `Embedding`, no network and no per token cost.
+
+    Concurrent `get` calls of many threads are batched together by `DynamicBatcher`.
+
+    embedder = LocalEmbedding(threads=4)
+    memory = Episodic(embedder, storage)
+    """
+
+    def __init__(
+            self,
+            model: Optional[str] = None,
+            threads: Optional[int] = None,
+            max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+            max_latency: float = DEFAULT_MAX_LATENCY,
+            encoder: Optional[Callable[[Sequence[str]], np.ndarray]] = None,
+    ) -> None:
+        """
+        Set up batcher, model is loaded with first text
+
+        :param model: name or local path of sentence embedding model
+        :param threads: torch intra-op threads
+        :param max_batch_size: max number of texts encoded at once
+        :param max_latency: max seconds text waits for others to join its batch
+        :param encoder: embeds batch of texts into float32 matrix, `TransformerEncoder` of model if not set
+        """
+        self.model = model or DEFAULT_LOCAL_MODEL
+        self.encoder = encoder or TransformerEncoder(self.model, threads=threads)
+        self.batcher = DynamicBatcher(self.encoder, max_batch_size, max_latency)
+
+    def close(self) -> None:
+        self.batcher.close()
+
+    def encode(self, texts: Sequence[str]) -> np.ndarray:
+        """
+        Calculate embeddings as compact float32 matrix
+
+        :param texts: texts to calculate embeddings for
+        :return: row per text
+        """
+        futures = self.batcher.submit(texts)
+        if not futures:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack([future.result() for future in futures])
+
+    @instrumented("local_embedding.get", "text", payload=text_bytes)
+    def get(self, text: str) -> list[float]:
+        """
+        Calculate embedding vector locally
+
+        :param text: text to calculate embedding for
+        :return: embedding vector representing text topics
+        """
+        return self.batcher.submit([text])[0].result().tolist()
+
+    @instrumented("local_embedding.get_many", "texts", payload=text_bytes)
+    def get_many(self, texts: Sequence[str], batch_size: Optional[int] = None) -> list[list[float]]:
+        """
+        Calculate embedding vectors for many texts, batches are formed by batcher
+
+        :param texts: texts to calculate embeddings for
+        :param batch_size: ignored, batcher decides, kept for interface of `Embedding`
+        :return: embedding vectors in the same order as texts
+        """
+        return self.encode(texts).tolist()
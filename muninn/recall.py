@@ -0,0 +1,396 @@
+import datetime as dt
+import json
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable, Hashable, Optional, Sequence, TypeVar
+
+from . import database, language
+from .instrumentation import Span
+from .weave.fact import Chronicle, Record
+
+__all__ = (
+    "Candidate",
+    "HybridRecall",
+    "Recalled",
+    "reciprocal_rank_fusion",
+    "weighted_reciprocal_rank",
+)
+
+_K = TypeVar("_K", bound=Hashable)
+
+DEFAULT_BUDGET = 0.25
+DEFAULT_HOPS = 2
+DEFAULT_RECALL = 17
+DEFAULT_FACTS = 8
+DEFAULT_NEIGHBORS = 100
+DEFAULT_WORKERS = 4
+# rank constant of reciprocal rank fusion, damps the weight of top ranks
+RRF_K = 60
+
+
+@dataclass(slots=True)
+class Candidate:
+    text: str  # remembered text, source text of record or text of fact
+    kind: str  # "episode" or "fact"
+    vector_rank: Optional[int] = None  # rank among vector hits of query, 0 is the nearest
+    distance: Optional[float] = None  # vector distance to query
+    graph_rank: Optional[int] = None  # rank among graph neighbors of query, closest first
+    hops: Optional[int] = None  # length of path from the nearest matching fact
+    lexical_rank: Optional[int] = None  # rank among Chronicle full-text matches of query, 0 is the best
+    chronicle_ids: set[int] = field(default_factory=set)  # source records in Chronicle, if known
+    score: float = 0.0  # fused score, higher is better
+
+
+Scoring = Callable[[Candidate], float]
+
+
+def weighted_reciprocal_rank(
+        vector: float = 1.0,
+        graph: float = 0.5,
+        lexical: float = 1.0,
+        k: int = RRF_K,
+) -> Scoring:
+    """
+    Reciprocal rank fusion, candidate found by more stores and ranked higher scores more.
+
+    :param vector: weight of vector rank
+    :param graph: weight of graph rank
+    :param lexical: weight of full-text rank
+    :param k: rank constant
+    :return: scoring function of candidate
+    """
+
+    def score(candidate: Candidate) -> float:
+        total = 0.0
+        if candidate.vector_rank is not None:
+            total += vector / (k + candidate.vector_rank)
+        if candidate.graph_rank is not None:
+            total += graph / (k + candidate.graph_rank)
+        if candidate.lexical_rank is not None:
+            total += lexical / (k + candidate.lexical_rank)
+        return total
+
+    return score
+
+
+def reciprocal_rank_fusion(
+        rankings: Sequence[Sequence[_K]],
+        weights: Optional[Sequence[float]] = None,
+        k: int = RRF_K,
+) -> list[tuple[_K, float]]:
+    """
+    Fuse rankings of different stores which scores are not comparable, e.g. BM25 and vector distance.
+
+    ids = chronicle.search("Who has SW-1234?")
+    contents = {record["id"]: record["content"] for record in chronicle.get_many(ids)}
+    fused = reciprocal_rank_fusion([storage.query(embedding), [contents[id_] for id_ in ids if id_ in contents]])
+
+    :param rankings: keys ordered by each store, the best first
+    :param weights: weight of each ranking, all equal if not set
+    :param k: rank constant
+    :return: every key with its fused score, the best first
+    """
+    if weights is not None and len(weights) != len(rankings):
+        raise ValueError("rankings and weights must have the same length")
+    scores: dict[_K, float] = {}
+    for index, ranking in enumerate(rankings):
+        weight = weights[index] if weights is not None else 1.0
+        seen = set()
+        for rank, key in enumerate(ranking):
+            # only the best rank of duplicate key counts
+            if key not in seen:
+                seen.add(key)
+                scores[key] = scores.get(key, 0.0) + weight / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+@dataclass(slots=True)
+class Recalled:
+    query: str  # context recall was asked for
+    candidates: list[Candidate]  # fused candidates, the best first
+    timed_out: list[str] = field(default_factory=list)  # stores which missed latency budget and were left out
+    failed: dict[str, Exception] = field(default_factory=dict)  # stores which raised and were left out, by name
+    seconds: float = 0.0  # wall time of recall
+
+    @property
+    def texts(self) -> list[str]:
+        return [candidate.text for candidate in self.candidates]
+
+
+class HybridRecall:
+    """
+    Recall of vector hits expanded through fact graph and restricted to Chronicle time window.
+
+    Queries are embedded once, then vector storage and fact vectors followed by graph traversal run concurrently.
+    With `lexical`, Chronicle full-text index is searched too, it starts before embedding and finds exact names and
+    rare words vectors miss. Their ranked results are fused by scoring function. Time window keeps only hits whose
+    Chronicle ids, from `chronicle_ids` label of stored texts or from graph records, are inside it. Each store checks
+    its own hits by one id lookup instead of scanning the window, within its share of budget. Stores which do not
+    answer within latency budget are left out of fusion and reported in `Recalled.timed_out`, so recall degrades to
+    what is available instead of blocking the turn. Stores which raise are left out the same way, their errors are
+    reported in `Recalled.failed`. Work of late stores still waiting for thread is cancelled, graph
+    traversal gets the rest of budget as query timeout.
+
+    recall = HybridRecall(embedder, storage, graph, fact_storage, chronicle)
+    recall.recall("Who owns the sword?", window=(yesterday, now)).texts
+    """
+
+    def __init__(
+            self,
+            embedder: language.Embedding,
+            storage: database.VectorStorage,
+            graph: Optional[database.GraphDB] = None,
+            fact_storage: Optional[database.VectorStorage] = None,
+            chronicle: Optional[Chronicle] = None,
+            scoring: Optional[Scoring] = None,
+            budget: float = DEFAULT_BUDGET,
+            hops: int = DEFAULT_HOPS,
+            n_facts: int = DEFAULT_FACTS,
+            n_neighbors: int = DEFAULT_NEIGHBORS,
+            max_workers: int = DEFAULT_WORKERS,
+            lexical: bool = False,
+    ) -> None:
+        """
+        Set up recall, threads are shared by all calls
+
+        :param embedder: categorize text to vector space
+        :param storage: vector database of remembered texts
+        :param graph: knowledge graph of facts, no graph expansion if not set
+        :param fact_storage: vector database of facts referenced by graph, required for graph expansion
+        :param chronicle: permanent storage of raw texts, required for time window and texts of graph records
+        :param scoring: fuses candidate into score, weighted reciprocal rank if not set
+        :param budget: seconds recall may take, slower stores are left out
+        :param hops: max path length from matching fact to its neighbors
+        :param n_facts: number of nearest facts per query the graph traversal starts from
+        :param n_neighbors: max number of graph neighbors per call
+        :param max_workers: threads querying stores
+        :param lexical: search Chronicle full-text index as well, requires chronicle
+        """
+        if lexical and chronicle is None:
+            raise ValueError("lexical search requires chronicle")
+        self.embedder = embedder
+        self.storage = storage
+        self.graph = graph
+        self.fact_storage = fact_storage
+        self.chronicle = chronicle
+        self.scoring = scoring or weighted_reciprocal_rank()
+        self.budget = budget
+        self.hops = hops
+        self.n_facts = n_facts
+        self.n_neighbors = n_neighbors
+        self.lexical = lexical
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="recall")
+
+    def __enter__(self) -> "HybridRecall":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def recall(
+            self,
+            text: str,
+            n_results: int = DEFAULT_RECALL,
+            window: Optional[tuple[dt.datetime, dt.datetime]] = None,
+    ) -> Recalled:
+        """
+        Find remembered texts and facts related to context.
+
+        :param text: context to search by
+        :param n_results: max number of returned candidates
+        :param window: only texts written within (lower, upper) time range, requires chronicle
+        :return: fused candidates
+        """
+        return self.recall_many([text], n_results, window)[0]
+
+    def recall_many(
+            self,
+            texts: Sequence[str],
+            n_results: int = DEFAULT_RECALL,
+            window: Optional[tuple[dt.datetime, dt.datetime]] = None,
+    ) -> list[Recalled]:
+        """
+        Find remembered texts and facts related to each context, every store is asked once for all contexts.
+
+        :param texts: contexts to search by
+        :param n_results: max number of returned candidates per context
+        :param window: only texts written within (lower, upper) time range, requires chronicle
+        :return: fused candidates of each context
+        """
+        if not texts:
+            return []
+        started = time.monotonic()
+        deadline = started + self.budget
+        if window is not None and self.chronicle is None:
+            raise ValueError("time window requires chronicle")
+        futures: dict[str, Future] = {}
+        if self.lexical:
+            futures["lexical"] = self._executor.submit(self._search, list(texts), n_results, window)
+        with Span("recall.embed", len(texts)):
+            queries = self.embedder.get_many(list(texts))
+        futures["vector"] = self._executor.submit(self._vector, queries, n_results, window)
+        if self.graph is not None and self.fact_storage is not None:
+            futures["graph"] = self._executor.submit(self._expand, queries, deadline, window)
+        wait(futures.values(), timeout=max(0.0, deadline - time.monotonic()))
+        timed_out = [name for name, future in futures.items() if not future.done()]
+        for name in timed_out:
+            # queued work does not hold thread of next call, running one is left to finish
+            futures[name].cancel()
+        failed: dict[str, Exception] = {}
+        vector_hits = self._result(futures, "vector", timed_out, failed) or [[] for _ in texts]
+        graph_hits = self._result(futures, "graph", timed_out, failed) or [[] for _ in texts]
+        lexical_hits = self._result(futures, "lexical", timed_out, failed) or [[] for _ in texts]
+        results = []
+        for text, episodes, neighbors, matches in zip(texts, vector_hits, graph_hits, lexical_hits):
+            candidates = self._fuse(episodes, neighbors, matches)
+            results.append(Recalled(text, candidates[:n_results], list(timed_out), dict(failed)))
+        seconds = time.monotonic() - started
+        for result in results:
+            result.seconds = seconds
+        return results
+
+    @staticmethod
+    def _result(futures: dict[str, Future], name: str, timed_out: list[str], failed: dict[str, Exception]):
+        future = futures.get(name)
+        if future is None or name in timed_out:
+            return None
+        error = future.exception()
+        if error is not None:
+            # error of one store, e.g. dropped graph connection, does not fail recall of the others
+            failed[name] = error
+            return None
+        return future.result()
+
+    def _within(self, ids: set[int], window: tuple[dt.datetime, dt.datetime]) -> set[int]:
+        with Span("recall.chronicle", len(ids)):
+            return self.chronicle.within(sorted(ids), *window)
+
+    def _search(
+            self,
+            texts: list[str],
+            n_results: int,
+            window: Optional[tuple[dt.datetime, dt.datetime]],
+    ) -> list[list[Record]]:
+        with Span("recall.lexical", len(texts)):
+            ranked = [self.chronicle.search(text, n_results) for text in texts]
+            records = self._record_texts(id_ for ids in ranked for id_ in ids)
+        if window is not None:
+            # matched records carry their time stamps
+            lower, upper = window
+            records = {id_: record for id_, record in records.items() if lower <= record["time_stamp"] <= upper}
+        return [[records[id_] for id_ in ids if id_ in records] for ids in ranked]
+
+    def _vector(
+            self,
+            queries: list,
+            n_results: int,
+            window: Optional[tuple[dt.datetime, dt.datetime]],
+    ) -> list[list[tuple[str, float, list[int]]]]:
+        with Span("recall.vector", len(queries)):
+            matched = self.storage.query_many(queries, n_results=n_results)
+        hits = [
+            list(zip(result.ids or [], result.documents or [], result.distances or [])) for result in matched
+        ]
+        chronicle_ids: dict[str, list[int]] = {}
+        doc_ids = list({doc_id for per_query in hits for doc_id, _, _ in per_query})
+        if window is not None and doc_ids:
+            # source records are kept in metadata, queries return documents and distances only
+            stored = self.storage.get_many(doc_ids, include=["metadatas"])
+            for doc_id, metadata in zip(stored.ids, stored.metadatas):
+                label = (metadata or {}).get("chronicle_ids")
+                if label is not None:
+                    chronicle_ids[doc_id] = json.loads(label)
+            in_window = self._within({id_ for ids in chronicle_ids.values() for id_ in ids}, window)
+            # text without known source record is not proven to be inside window
+            hits = [
+                [hit for hit in per_query if in_window.intersection(chronicle_ids.get(hit[0], ()))]
+                for per_query in hits
+            ]
+        return [
+            [(document, distance, chronicle_ids.get(doc_id, [])) for doc_id, document, distance in per_query]
+            for per_query in hits
+        ]
+
+    def _expand(
+            self,
+            queries: list,
+            deadline: float,
+            window: Optional[tuple[dt.datetime, dt.datetime]],
+    ) -> list[list[dict]]:
+        with Span("recall.graph", len(queries)):
+            seeds = self.fact_storage.query_many(queries, n_results=self.n_facts)
+            seed_ids = [result.ids or [] for result in seeds]
+            rows = self.graph.neighbors(
+                sorted({id_ for ids in seed_ids for id_ in ids}),
+                hops=self.hops,
+                limit=self.n_neighbors,
+                timeout=deadline - time.monotonic(),
+            )
+            records = self._record_texts(row["chronicle_id"] for row in rows if row["label"] == "Record")
+        by_seed: dict[str, list[dict]] = {}
+        for row in rows:
+            if row["label"] == "Record":
+                record = records.get(row["chronicle_id"])
+                if record is None:
+                    continue
+                row = {**row, "text": record["content"], "chronicle_ids": [row["chronicle_id"]]}
+            by_seed.setdefault(row["embedding_id"], []).append(row)
+        if window is not None:
+            ids = {id_ for rows_of_seed in by_seed.values() for row in rows_of_seed for id_ in row["chronicle_ids"]}
+            in_window = self._within({id_ for id_ in ids if id_ is not None}, window)
+            by_seed = {
+                seed: [row for row in rows_of_seed if in_window.intersection(row["chronicle_ids"])]
+                for seed, rows_of_seed in by_seed.items()
+            }
+        expanded = []
+        for ids in seed_ids:
+            # neighbors of nearer seed fact first, then by path length
+            rows_of_query = [
+                (seed_rank, row) for seed_rank, id_ in enumerate(ids) for row in by_seed.get(id_, [])
+            ]
+            rows_of_query.sort(key=lambda item: (item[1]["hops"], item[0]))
+            expanded.append([row for _, row in rows_of_query])
+        return expanded
+
+    def _record_texts(self, chronicle_ids) -> dict[int, Record]:
+        ids = [id_ for id_ in set(chronicle_ids) if id_ is not None]
+        if self.chronicle is None or not ids:
+            return {}
+        return {record["id"]: record for record in self.chronicle.get_many(ids)}
+
+    def _fuse(
+            self,
+            episodes: list[tuple[str, float, list[int]]],
+            neighbors: list[dict],
+            matches: list[Record],
+    ) -> list[Candidate]:
+        candidates: dict[str, Candidate] = {}
+        for rank, (text, distance, chronicle_ids) in enumerate(episodes):
+            candidates[text] = Candidate(
+                text, "episode", vector_rank=rank, distance=distance, chronicle_ids=set(chronicle_ids)
+            )
+        for rank, row in enumerate(neighbors):
+            candidate = candidates.get(row["text"])
+            if candidate is None:
+                kind = "fact" if row["label"] == "Fact" else "episode"
+                candidate = candidates[row["text"]] = Candidate(row["text"], kind)
+            if candidate.graph_rank is None:
+                candidate.graph_rank = rank
+                candidate.hops = row["hops"]
+            candidate.chronicle_ids.update(id_ for id_ in row.get("chronicle_ids") or [] if id_ is not None)
+        for rank, record in enumerate(matches):
+            candidate = candidates.get(record["content"])
+            if candidate is None:
+                candidate = candidates[record["content"]] = Candidate(record["content"], "episode")
+            if candidate.lexical_rank is None:
+                candidate.lexical_rank = rank
+            candidate.chronicle_ids.add(record["id"])
+        selected = list(candidates.values())
+        for candidate in selected:
+            candidate.score = self.scoring(candidate)
+        selected.sort(key=lambda candidate: candidate.score, reverse=True)
+        return selected
@@ -0,0 +1,403 @@
+"""
+Snapshot of memory in columnar binary files, restored by bulk loads without any embedding call.
+
+Snapshot is a directory with manifest.json and files of columns. Fixed width columns are raw little-endian
+arrays, all embeddings are one contiguous float32 block of shape (count, dim), memory mapped by
+`Snapshot.embeddings`. Text columns are UTF-8 blob with int64 end offsets and uint8 null mask.
+
+    vectors/ids, vectors/documents, vectors/metadatas (JSON), vectors/embeddings
+    chronicle/id, chronicle/time_stamp (microseconds since epoch, UTC), chronicle/content
+    graph/node_id, graph/node_label, graph/node_properties (JSON)
+    graph/edge_source, graph/edge_type, graph/edge_target, graph/edge_properties (JSON)
+
+export_snapshot("./snapshot", storage, chronicle, graph)
+import_snapshot("./snapshot", other_storage, other_chronicle, other_graph)
+"""
+import datetime as dt
+import json
+import os
+import shutil
+from typing import Any, BinaryIO, Iterator, Optional, Sequence
+
+import numpy as np
+
+from . import database
+from .database.vectors import as_matrix
+from .instrumentation import Span
+from .weave.fact import Chronicle, Record
+
+__all__ = (
+    "Snapshot",
+    "export_snapshot",
+    "import_snapshot",
+)
+
+FORMAT = "muninn-snapshot"
+VERSION = 1
+MANIFEST = "manifest.json"
+DEFAULT_BATCH_SIZE = 10_000
+EPOCH = dt.datetime(1970, 1, 1)
+MICROSECOND = dt.timedelta(microseconds=1)
+
+
+def _encode(value: Any) -> Any:
+    # neo4j temporal values convert to python ones
+    if hasattr(value, "to_native"):
+        value = value.to_native()
+    if isinstance(value, dt.datetime):
+        return {"$datetime": value.isoformat()}
+    if isinstance(value, dt.date):
+        return {"$date": value.isoformat()}
+    raise TypeError(f"value of type {type(value).__name__} is not serializable")
+
+
+def _decode(value: dict) -> Any:
+    if len(value) == 1:
+        if "$datetime" in value:
+            return dt.datetime.fromisoformat(value["$datetime"])
+        if "$date" in value:
+            return dt.date.fromisoformat(value["$date"])
+    return value
+
+
+def dumps(value: Any) -> Optional[str]:
+    return None if value is None else json.dumps(value, default=_encode, ensure_ascii=False)
+
+
+def loads(text: Optional[str]) -> Any:
+    return None if text is None else json.loads(text, object_hook=_decode)
+
+
+def micros(time_stamp: dt.datetime) -> int:
+    """Microseconds since epoch, naive time stamps of Chronicle are UTC"""
+    if time_stamp.tzinfo is not None:
+        time_stamp = time_stamp.astimezone(dt.timezone.utc).replace(tzinfo=None)
+    return (time_stamp - EPOCH) // MICROSECOND
+
+
+class _Writer:
+    """Appends batches to column files, shapes and sizes go to manifest"""
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.columns: dict[str, dict] = {}
+        self._files: dict[str, BinaryIO] = {}
+
+    def _write(self, name: str, data: bytes) -> None:
+        file = self._files.get(name)
+        if file is None:
+            path = os.path.join(self.directory, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            file = self._files[name] = open(path, "wb")
+        file.write(data)
+
+    def fixed(self, name: str, values: Any, dtype: str) -> None:
+        array = np.ascontiguousarray(values, dtype=np.dtype(dtype).newbyteorder("<"))
+        column = self.columns.setdefault(name, {"kind": "fixed", "dtype": dtype, "shape": [0, *array.shape[1:]]})
+        if list(array.shape[1:]) != column["shape"][1:]:
+            raise ValueError(f"column {name} changed shape from {column['shape'][1:]} to {list(array.shape[1:])}")
+        self._write(f"{name}.bin", array.tobytes())
+        column["shape"][0] += len(array)
+
+    def text(self, name: str, values: Sequence[Optional[str]]) -> None:
+        column = self.columns.setdefault(name, {"kind": "text", "count": 0, "bytes": 0})
+        encoded = [None if value is None else value.encode("utf-8") for value in values]
+        lengths = np.fromiter((len(data) if data is not None else 0 for data in encoded), np.int64, len(encoded))
+        self._write(f"{name}.bin", b"".join(data for data in encoded if data))
+        self._write(f"{name}.ends.bin", (column["bytes"] + np.cumsum(lengths)).astype("<i8").tobytes())
+        self._write(f"{name}.nulls.bin", np.fromiter((data is None for data in encoded), np.uint8).tobytes())
+        column["count"] += len(encoded)
+        column["bytes"] += int(lengths.sum())
+
+    def close(self) -> None:
+        for file in self._files.values():
+            file.close()
+        self._files.clear()
+
+
+class Snapshot:
+    """
+    Read-only view of snapshot directory, columns are memory mapped and read in batches.
+
+    snapshot = Snapshot("./snapshot")
+    snapshot.embeddings[42]  # float32 vector without reading the rest of file
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Open snapshot
+
+        :param path: snapshot directory
+        """
+        self.path = path
+        with open(os.path.join(path, MANIFEST), encoding="utf-8") as file:
+            self.manifest = json.load(file)
+        if self.manifest.get("format") != FORMAT or self.manifest.get("version") != VERSION:
+            raise ValueError(f"{path} is not {FORMAT} version {VERSION}")
+        self.columns: dict[str, dict] = self.manifest["columns"]
+
+    def _map(self, name: str, dtype: str, shape: tuple) -> np.ndarray:
+        if not shape[0]:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name), dtype=np.dtype(dtype).newbyteorder("<"), mode="r", shape=shape)
+
+    def count(self, name: str) -> int:
+        """Number of rows of column, 0 if snapshot does not have it"""
+        column = self.columns.get(name)
+        if column is None:
+            return 0
+        return column["shape"][0] if column["kind"] == "fixed" else column["count"]
+
+    def fixed(self, name: str) -> np.ndarray:
+        """Memory mapped fixed width column"""
+        column = self.columns[name]
+        return self._map(f"{name}.bin", column["dtype"], tuple(column["shape"]))
+
+    def text(self, name: str, start: int = 0, stop: Optional[int] = None) -> list[Optional[str]]:
+        """
+        Decode rows of text column
+
+        :param name: column name
+        :param start: first row
+        :param stop: row after the last one, end of column if not set
+        :return: texts, None for null rows
+        """
+        column = self.columns[name]
+        stop = column["count"] if stop is None else min(stop, column["count"])
+        if start >= stop:
+            return []
+        ends = self._map(f"{name}.ends.bin", "int64", (column["count"],))
+        nulls = self._map(f"{name}.nulls.bin", "uint8", (column["count"],))
+        blob = self._map(f"{name}.bin", "uint8", (column["bytes"],))
+        begin = int(ends[start - 1]) if start else 0
+        end = int(ends[stop - 1])
+        data = blob[begin:end].tobytes()
+        bounds = (ends[start:stop] - begin).tolist()
+        texts = []
+        previous = 0
+        for bound, null in zip(bounds, nulls[start:stop].tolist()):
+            texts.append(None if null else data[previous:bound].decode("utf-8"))
+            previous = bound
+        return texts
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        """All embeddings as one memory mapped float32 matrix"""
+        return self.fixed("vectors/embeddings")
+
+    def iter_vectors(
+            self,
+            batch_size: int = DEFAULT_BATCH_SIZE,
+    ) -> Iterator[tuple[list[str], np.ndarray, list[Optional[str]], list[Optional[dict]]]]:
+        """
+        Batches of stored vectors
+
+        :param batch_size: rows per batch
+        :return: generator of ids, float32 embeddings, documents and metadatas
+        """
+        count = self.count("vectors/ids")
+        embeddings = self.embeddings if count else None
+        for start in range(0, count, batch_size):
+            stop = start + batch_size
+            yield (
+                self.text("vectors/ids", start, stop),
+                embeddings[start:stop],
+                self.text("vectors/documents", start, stop),
+                [loads(metadata) for metadata in self.text("vectors/metadatas", start, stop)],
+            )
+
+    def iter_records(self, batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator[list[Record]]:
+        """
+        Batches of Chronicle rows
+
+        :param batch_size: rows per batch
+        :return: generator of records
+        """
+        count = self.count("chronicle/id")
+        if not count:
+            return
+        ids = self.fixed("chronicle/id")
+        time_stamps = self.fixed("chronicle/time_stamp")
+        for start in range(0, count, batch_size):
+            stop = start + batch_size
+            yield [
+                {"id": id_, "time_stamp": EPOCH + dt.timedelta(microseconds=time_stamp), "content": content}
+                for id_, time_stamp, content in zip(
+                    ids[start:stop].tolist(), time_stamps[start:stop].tolist(),
+                    self.text("chronicle/content", start, stop),
+                )
+            ]
+
+    def iter_nodes(self, batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator[list[dict]]:
+        """
+        Batches of graph nodes
+
+        :param batch_size: rows per batch
+        :return: generator of rows with id, label and properties
+        """
+        count = self.count("graph/node_id")
+        if not count:
+            return
+        ids = self.fixed("graph/node_id")
+        for start in range(0, count, batch_size):
+            stop = start + batch_size
+            yield [
+                {"id": id_, "label": label, "properties": loads(properties)}
+                for id_, label, properties in zip(
+                    ids[start:stop].tolist(), self.text("graph/node_label", start, stop),
+                    self.text("graph/node_properties", start, stop),
+                )
+            ]
+
+    def iter_edges(self, batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator[list[dict]]:
+        """
+        Batches of graph relationships
+
+        :param batch_size: rows per batch
+        :return: generator of rows with source, type, target and properties
+        """
+        count = self.count("graph/edge_source")
+        if not count:
+            return
+        sources = self.fixed("graph/edge_source")
+        targets = self.fixed("graph/edge_target")
+        for start in range(0, count, batch_size):
+            stop = start + batch_size
+            yield [
+                {"source": source, "type": type_, "target": target, "properties": loads(properties)}
+                for source, type_, target, properties in zip(
+                    sources[start:stop].tolist(), self.text("graph/edge_type", start, stop),
+                    targets[start:stop].tolist(), self.text("graph/edge_properties", start, stop),
+                )
+            ]
+
+
+def export_snapshot(
+        path: str,
+        storage: Optional[database.VectorStorage] = None,
+        chronicle: Optional[Chronicle] = None,
+        graph: Optional[database.GraphDB] = None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+) -> dict:
+    """
+    Write snapshot of given stores. Directory appears only when snapshot is complete.
+
+    Stores should not be written meanwhile, pages of concurrent writes may be missed or repeated.
+
+    :param path: new snapshot directory
+    :param storage: vector database of texts, left out if not set
+    :param chronicle: permanent storage of raw texts, left out if not set
+    :param graph: knowledge graph, left out if not set
+    :param batch_size: rows read from store at once
+    :return: manifest of snapshot
+    """
+    if os.path.exists(path):
+        raise FileExistsError(f"snapshot {path} already exists")
+    partial = f"{path}.partial"
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+    writer = _Writer(partial)
+    try:
+        if storage is not None:
+            for page in storage.iter_all(batch_size):
+                with Span("snapshot.export_vectors", len(page.ids)):
+                    writer.text("vectors/ids", page.ids)
+                    writer.fixed("vectors/embeddings", as_matrix(page.embeddings), "float32")
+                    empty = [None] * len(page.ids)
+                    writer.text("vectors/documents", page.documents or empty)
+                    writer.text("vectors/metadatas", [dumps(metadata) for metadata in page.metadatas or empty])
+        if chronicle is not None:
+            batch: list[Record] = []
+            for record in chronicle.iter_after(0, batch_size):
+                batch.append(record)
+                if len(batch) == batch_size:
+                    _write_records(writer, batch)
+                    batch = []
+            _write_records(writer, batch)
+        if graph is not None:
+            for page in graph.iter_nodes(batch_size):
+                with Span("snapshot.export_nodes", len(page)):
+                    writer.fixed("graph/node_id", [row["id"] for row in page], "int64")
+                    writer.text("graph/node_label", [row["label"] for row in page])
+                    writer.text("graph/node_properties", [dumps(row["properties"]) for row in page])
+            for page in graph.iter_edges(batch_size):
+                with Span("snapshot.export_edges", len(page)):
+                    writer.fixed("graph/edge_source", [row["source"] for row in page], "int64")
+                    writer.text("graph/edge_type", [row["type"] for row in page])
+                    writer.fixed("graph/edge_target", [row["target"] for row in page], "int64")
+                    writer.text("graph/edge_properties", [dumps(row["properties"]) for row in page])
+    finally:
+        writer.close()
+    manifest = {
+        "format": FORMAT,
+        "version": VERSION,
+        "created": dt.datetime.utcnow().isoformat(),
+        "columns": writer.columns,
+    }
+    with open(os.path.join(partial, MANIFEST), "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(partial, path)
+    return manifest
+
+
+def _write_records(writer: _Writer, records: list[Record]) -> None:
+    if not records:
+        return
+    with Span("snapshot.export_records", len(records)):
+        writer.fixed("chronicle/id", [record["id"] for record in records], "int64")
+        writer.fixed("chronicle/time_stamp", [micros(record["time_stamp"]) for record in records], "int64")
+        writer.text("chronicle/content", [record["content"] for record in records])
+
+
+def import_snapshot(
+        path: str,
+        storage: Optional[database.VectorStorage] = None,
+        chronicle: Optional[Chronicle] = None,
+        graph: Optional[database.GraphDB] = None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+) -> dict[str, int]:
+    """
+    Bulk load snapshot into given stores, vectors are loaded as they are without embedding calls.
+
+    Vector ids and Chronicle ids are kept, graph nodes get new ids and relationships are remapped to them.
+
+    :param path: snapshot directory
+    :param storage: vector database, vectors are skipped if not set
+    :param chronicle: empty Chronicle, records are skipped if not set
+    :param graph: knowledge graph, nodes and relationships are skipped if not set
+    :param batch_size: rows written to store at once
+    :return: number of loaded vectors, records, nodes and edges
+    """
+    snapshot = Snapshot(path)
+    loaded = {"vectors": 0, "records": 0, "nodes": 0, "edges": 0}
+    if storage is not None:
+        for ids, embeddings, documents, metadatas in snapshot.iter_vectors(batch_size):
+            with Span("snapshot.import_vectors", len(ids)):
+                storage.upsert_many(
+                    ids, embeddings, documents,
+                    None if all(metadata is None for metadata in metadatas) else metadatas,
+                )
+            loaded["vectors"] += len(ids)
+    if chronicle is not None:
+        for records in snapshot.iter_records(batch_size):
+            chronicle.insert_records(records)
+            loaded["records"] += len(records)
+    if graph is not None:
+        node_ids: dict[int, int] = {}
+        for page in snapshot.iter_nodes(batch_size):
+            by_label: dict[Optional[str], list[dict]] = {}
+            for row in page:
+                by_label.setdefault(row["label"], []).append(row)
+            for label, rows in by_label.items():
+                created = graph.create_nodes(label, [row["properties"] or {} for row in rows])
+                node_ids.update((row["id"], node_id) for row, node_id in zip(rows, created))
+            loaded["nodes"] += len(page)
+        for page in snapshot.iter_edges(batch_size):
+            by_type: dict[str, list[tuple[int, int, dict]]] = {}
+            for row in page:
+                source, target = node_ids.get(row["source"]), node_ids.get(row["target"])
+                if source is not None and target is not None:
+                    by_type.setdefault(row["type"], []).append((source, target, row["properties"] or {}))
+            for type_, edges in by_type.items():
+                loaded["edges"] += graph.create_edges(type_, edges)
+    return loaded
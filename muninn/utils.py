@@ -0,0 +1,39 @@
+import functools
+import importlib
+import sys
+from typing import Any, Callable
+
+from dotenv import load_dotenv
+
+
+@functools.cache
+def load_environment() -> None:
+    """Load .env file into environment once, on first use of anything that needs API keys"""
+    load_dotenv(override=True)
+
+
+def lazy_attributes(package: str, attributes: dict[str, str]) -> tuple[Callable[[str], Any], Callable[[], list[str]]]:
+    """
+    Module `__getattr__` and `__dir__` importing submodules on first access (PEP 562).
+
+    Keeps `import package` cheap, heavy dependencies are imported only by code really using them.
+
+    :param package: name of package, `__name__`
+    :param attributes: exported name to submodule defining it, submodules map to themselves
+    :return: `__getattr__` and `__dir__` of package
+    """
+
+    def __getattr__(name: str) -> Any:
+        submodule = attributes.get(name)
+        if submodule is None:
+            raise AttributeError(f"module {package!r} has no attribute {name!r}")
+        module = importlib.import_module(f".{submodule}", package)
+        value = module if submodule == name else getattr(module, name)
+        # next access does not reach __getattr__
+        setattr(sys.modules[package], name, value)
+        return value
+
+    def __dir__() -> list[str]:
+        return sorted(attributes)
+
+    return __getattr__, __dir__
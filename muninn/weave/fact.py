@@ -1,7 +1,43 @@
+import re
 import typing
 import datetime as dt
-from sqlalchemy import (Engine, Connection, MetaData, Table, Column, BigInteger, TIMESTAMP, TEXT,
-                        create_engine, bindparam)
+from sqlalchemy import (Engine, Connection, MetaData, Table, Column, BigInteger, Integer, TIMESTAMP, TEXT,
+                        create_engine, bindparam, and_, or_, make_url, select, text)
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from ..instrumentation import instrumented, single, text_bytes
+
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_RECYCLE = 3600
+DEFAULT_SEARCH_RESULTS = 17
+_WORD = re.compile(r"\w+")
+# external content table, rows are kept in sync with chronicle by triggers, so every insert path indexes its rows
+_SQLITE_SEARCH_INDEX = (
+    "CREATE VIRTUAL TABLE chronicle_search USING fts5("
+    "content, content='chronicle', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS chronicle_search_insert AFTER INSERT ON chronicle BEGIN "
+    "INSERT INTO chronicle_search(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS chronicle_search_delete AFTER DELETE ON chronicle BEGIN "
+    "INSERT INTO chronicle_search(chronicle_search, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS chronicle_search_update AFTER UPDATE ON chronicle BEGIN "
+    "INSERT INTO chronicle_search(chronicle_search, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO chronicle_search(rowid, content) VALUES (new.id, new.content); END",
+    "INSERT INTO chronicle_search(chronicle_search) VALUES ('rebuild')",
+)
+_SQLITE_SEARCH = text(
+    "SELECT rowid AS id FROM chronicle_search WHERE chronicle_search MATCH :query ORDER BY rank, rowid LIMIT :k"
+)
+# 'simple' configuration neither stems nor drops stop words, names and item ids stay as they are
+_POSTGRES_SEARCH_INDEX = (
+    "CREATE INDEX IF NOT EXISTS chronicle_content_search ON chronicle USING GIN (to_tsvector('simple', content))",
+)
+_POSTGRES_SEARCH = text(
+    "SELECT id FROM chronicle, to_tsquery('simple', :query) AS query "
+    "WHERE to_tsvector('simple', content) @@ query "
+    "ORDER BY ts_rank_cd(to_tsvector('simple', content), query) DESC, id LIMIT :k"
+)
 
 
 class Record(typing.TypedDict):
@@ -10,25 +46,92 @@ class Record(typing.TypedDict):
     content: str
 
 
-class Chronicle:
-    """Permanent memory of raw knowledge"""
-    _engine: Engine
-    created: bool
+def engine_options(
+        url: str,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        max_overflow: int = DEFAULT_MAX_OVERFLOW,
+        pool_pre_ping: bool = True,
+        pool_recycle: int = DEFAULT_POOL_RECYCLE,
+        **options,
+) -> dict[str, typing.Any]:
+    """
+    Keyword arguments of engine with connection pool tuned for many concurrent workers
+    :param url: database url
+    :param pool_size: connections kept open
+    :param max_overflow: connections opened above pool_size under load
+    :param pool_pre_ping: test connection before use, survives database restarts
+    :param pool_recycle: reopen connections older than this many seconds, -1 never
+    :param options: passed to engine as they are
+    :return: keyword arguments of create_engine
+    """
+    options.update(pool_pre_ping=pool_pre_ping, pool_recycle=pool_recycle)
+    parsed = make_url(url)
+    if not (parsed.get_backend_name() == "sqlite" and parsed.database in (None, "", ":memory:")):
+        # in memory sqlite lives in single connection, there is no pool to size
+        options.update(pool_size=pool_size, max_overflow=max_overflow)
+    return options
+
+
+def search_terms(query: str) -> list[str]:
+    """
+    Words of full-text query, punctuation and operators of query language are dropped
+    :param query: free text, e.g. question of user
+    :return: lower case words without duplicates, in order of appearance
+    """
+    return list(dict.fromkeys(word.lower() for word in _WORD.findall(query)))
+
+
+def create_search_index(con: Connection) -> None:
+    """
+    Create full-text index of chronicle content if missing, FTS5 on SQLite and GIN over tsvector on PostgreSQL
+    :param con: connection in transaction, table chronicle exists already
+    """
+    if con.dialect.name == "sqlite":
+        if con.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'chronicle_search'")).first() is None:
+            # rebuild indexes rows of chronicle created before the index
+            for statement in _SQLITE_SEARCH_INDEX:
+                con.execute(text(statement))
+    elif con.dialect.name == "postgresql":
+        for statement in _POSTGRES_SEARCH_INDEX:
+            con.execute(text(statement))
+
+
+def search_statement(dialect: str, query: str, k: int) -> typing.Optional[tuple[typing.Any, dict]]:
+    """
+    Full-text query matching any word of query, best ranked first
+    :param dialect: name of database dialect
+    :param query: free text
+    :param k: max number of matched records
+    :return: statement and its parameters, None if query has no words or dialect has no full-text index
+    """
+    terms = search_terms(query)
+    if not terms:
+        return None
+    if dialect == "sqlite":
+        # quoted terms are strings, never FTS5 operators or column filters
+        return _SQLITE_SEARCH, {"query": " OR ".join(f'"{term}"' for term in terms), "k": k}
+    if dialect == "postgresql":
+        return _POSTGRES_SEARCH, {"query": " | ".join(f"'{term}'" for term in terms), "k": k}
+    # chronicle of other databases still stores and scans records, search just finds nothing
+    return None
+
+
+class ChronicleBase:
+    """Table of knowledge records and statements shared by sync and async chronicle"""
     table: Table
     meta_data: MetaData
 
-    def __init__(self, url: str) -> None:
-        self.created = False
+    def __init__(self) -> None:
         self.meta_data = MetaData()
         self.table = Table(
             "chronicle",
             self.meta_data,
-            Column("id", BigInteger, primary_key=True, autoincrement=True),
+            # sqlite auto increments only INTEGER PRIMARY KEY
+            Column("id", BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True),
             Column("time_stamp", TIMESTAMP, nullable=False, index=True, comment="time fo creation"),
             Column("content", TEXT, nullable=False),
             comment="each row is one record of knowledge produced or gained",
         )
-        self._engine = create_engine(url, pool_size=1, max_overflow=2)
         self._range_scan = self.table.select(
         ).where(
             self.table.c.time_stamp.between(bindparam("lower"), bindparam("upper"))
@@ -39,14 +142,90 @@ class Chronicle:
         self._get_many = self.table.select().where(self.table.c.id.in_(bindparam("keys", expanding=True))).order_by(
             self.table.c.time_stamp.asc()
         )
+        self._within = select(self.table.c.id).where(
+            self.table.c.id.in_(bindparam("keys", expanding=True)),
+            self.table.c.time_stamp.between(bindparam("lower"), bindparam("upper")),
+        )
+        self._range_page = self.table.select(
+        ).where(
+            self.table.c.time_stamp.between(bindparam("lower"), bindparam("upper")),
+            or_(
+                self.table.c.time_stamp > bindparam("after_time_stamp"),
+                and_(
+                    self.table.c.time_stamp == bindparam("after_time_stamp"),
+                    self.table.c.id > bindparam("after_id"),
+                ),
+            ),
+        ).order_by(
+            self.table.c.time_stamp.asc(), self.table.c.id.asc()
+        ).limit(bindparam("chunk_size"))
+        self._get_many_page = self.table.select().where(
+            self.table.c.id.in_(bindparam("keys", expanding=True))
+        ).order_by(
+            self.table.c.time_stamp.asc(), self.table.c.id.asc()
+        )
+        self._id_page = self.table.select().where(
+            self.table.c.id > bindparam("after_id")
+        ).order_by(
+            self.table.c.id.asc()
+        ).limit(bindparam("chunk_size"))
+        self._insert_many = self.table.insert().returning(self.table.c.id, sort_by_parameter_order=True)
+        self._insert_records = self.table.insert()
+        # explicit ids do not move postgres sequence, next generated id would collide
+        self._sync_sequence = text(
+            "SELECT setval(pg_get_serial_sequence('chronicle', 'id'), (SELECT max(id) FROM chronicle))"
+        )
+
+    @staticmethod
+    def _record(row) -> Record:
+        return {"id": row.id, "time_stamp": row.time_stamp, "content": row.content}
+
+    @staticmethod
+    def _insert_many_parameters(
+            contents: typing.Sequence[str],
+            time_stamps: typing.Optional[typing.Sequence[dt.datetime]],
+    ) -> list[dict]:
+        if time_stamps is None:
+            time_stamps = [dt.datetime.utcnow()] * len(contents)
+        elif len(time_stamps) != len(contents):
+            raise ValueError("contents and time_stamps must have the same length")
+        return [{"time_stamp": time_stamp, "content": content} for time_stamp, content in zip(time_stamps, contents)]
+
+    @staticmethod
+    def _range_page_parameters(lower, upper, chunk_size, after_time_stamp, after_id) -> dict:
+        return {
+            "lower": lower,
+            "upper": upper,
+            "after_time_stamp": after_time_stamp,
+            "after_id": after_id,
+            "chunk_size": chunk_size,
+        }
+
+
+class Chronicle(ChronicleBase):
+    """Permanent memory of raw knowledge"""
+    _engine: Engine
+
+    def __init__(self, url: str, **pool_options) -> None:
+        """
+        Connect to database and create table if missing
+        :param url: database url
+        :param pool_options: connection pool tuning, see `engine_options`
+        """
+        super().__init__()
+        self._engine = create_engine(url, **engine_options(url, **pool_options))
+        self.meta_data.create_all(self._engine, checkfirst=True)
+        with self._engine.begin() as con:
+            create_search_index(con)
 
     @property
     def engine(self) -> Engine:
-        if not self.created:
-            self.meta_data.create_all(self.engine, checkfirst=True)
-            self.created = True
         return self._engine
 
+    def close(self) -> None:
+        self._engine.dispose()
+
+    @instrumented("chronicle.insert", "content", single, text_bytes)
     def insert(
             self,
             content: str,
@@ -61,9 +240,10 @@ class Chronicle:
         time_stamp_: dt.datetime = time_stamp or dt.datetime.utcnow()
         with self.engine.begin() as con:
             cur = con.execute(self.table.insert(), {"time_stamp": time_stamp_, "content": content})
-            id_ = cur.inserted_primary_key
+            id_ = cur.inserted_primary_key[0]
         return {"id": id_, "time_stamp": time_stamp_, "content": content}
 
+    @instrumented("chronicle.get_one")
     def get_one(self, id_: int) -> typing.Optional[Record]:
         """Select one rows by id, if does not exist return None"""
         con: Connection
@@ -71,17 +251,366 @@ class Chronicle:
         with self.engine.begin() as con:
             cur = con.execute(self._get_one, {"key": id_})
             for row in cur:
-                record = {"id": row.id, "time_stamp": row.time_stamp, "content": row.content}
+                record = self._record(row)
         return record
 
+    @instrumented("chronicle.get_many", "ids")
     def get_many(self, ids: list[int]) -> list[Record]:
         """Select many rows by id. len(returned) <= len(ids)"""
         with self.engine.begin() as con:
             cur = con.execute(self._get_many, {"keys": ids})
-            return [{"id": row.id, "time_stamp": row.time_stamp, "content": row.content} for row in cur]
+            return [self._record(row) for row in cur]
+
+    @instrumented("chronicle.within", "ids")
+    def within(self, ids: list[int], lower: dt.datetime, upper: dt.datetime) -> set[int]:
+        """
+        Ids of given records written within time range, primary key lookup instead of time scan of whole range
+        :param ids: record ids
+        :param lower: inclusive lower bound of time stamp
+        :param upper: inclusive upper bound of time stamp
+        :return: ids of records inside range
+        """
+        if not ids:
+            return set()
+        with self.engine.connect() as con:
+            return {row.id for row in con.execute(self._within, {"keys": ids, "lower": lower, "upper": upper})}
 
+    @instrumented("chronicle.range")
     def range(self, lower: dt.datetime, upper: dt.datetime) -> list[Record]:
         """Time scan of knowledge"""
         with self.engine.begin() as con:
             cur = con.execute(self._range_scan, {"lower": lower, "upper": upper})
-            return [{"id": row.id, "time_stamp": row.time_stamp, "content": row.content} for row in cur]
+            return [self._record(row) for row in cur]
+
+    @instrumented("chronicle.search", "query", single, text_bytes)
+    def search(self, query: str, k: int = DEFAULT_SEARCH_RESULTS) -> list[int]:
+        """
+        Full-text search of content, finds exact names, item ids and rare words without embedding call.
+
+        Records matching more and rarer words of query rank higher, BM25 on SQLite and ts_rank_cd on PostgreSQL.
+        Other databases have no full-text index, nothing is found there.
+        :param query: free text, any of its words may match
+        :param k: max number of returned ids
+        :return: ids of matched records, the best first
+        """
+        statement = search_statement(self.engine.dialect.name, query, k)
+        if statement is None:
+            return []
+        with self.engine.connect() as con:
+            return [row.id for row in con.execute(*statement)]
+
+    @instrumented("chronicle.insert_many", "contents", payload=text_bytes)
+    def insert_many(
+            self,
+            contents: typing.Sequence[str],
+            time_stamps: typing.Optional[typing.Sequence[dt.datetime]] = None,
+    ) -> list[int]:
+        """
+        Create many rows with single executemany in one transaction
+        :param contents: knowledge to insert
+        :param time_stamps: creation stamp of each content, now if not set
+        :return: ids of inserted rows in the same order as contents
+        """
+        if not contents:
+            return []
+        with self.engine.begin() as con:
+            cur = con.execute(self._insert_many, self._insert_many_parameters(contents, time_stamps))
+            return [row.id for row in cur]
+
+    @instrumented("chronicle.insert_records", "records")
+    def insert_records(self, records: typing.Sequence[Record]) -> None:
+        """
+        Insert rows with their ids, e.g. to restore snapshot, in one transaction
+        :param records: complete rows, ids must not exist yet
+        """
+        if not records:
+            return
+        with self.engine.begin() as con:
+            con.execute(self._insert_records, [dict(record) for record in records])
+            if con.dialect.name == "postgresql":
+                con.execute(self._sync_sequence)
+
+    def iter_range(
+            self,
+            lower: dt.datetime,
+            upper: dt.datetime,
+            chunk_size: int = DEFAULT_CHUNK_SIZE,
+            after: typing.Optional[tuple[dt.datetime, int]] = None,
+    ) -> typing.Iterator[Record]:
+        """
+        Stream time scan of knowledge ordered by (time_stamp, id).
+
+        Pages of chunk_size rows are read by keyset pagination, each in its own short transaction with server side
+        cursor, so memory stays flat and no transaction is held open while caller processes rows.
+        :param lower: inclusive lower bound of time_stamp
+        :param upper: inclusive upper bound of time_stamp
+        :param chunk_size: rows fetched per page
+        :param after: resume scan after this (time_stamp, id) key
+        :return: records generator
+        """
+        after_time_stamp, after_id = after or (lower, -1)
+        while True:
+            with self.engine.connect() as con:
+                cur = con.execution_options(stream_results=True, yield_per=chunk_size).execute(
+                    self._range_page,
+                    self._range_page_parameters(lower, upper, chunk_size, after_time_stamp, after_id),
+                )
+                page = [self._record(row) for row in cur]
+            yield from page
+            if len(page) < chunk_size:
+                return
+            after_time_stamp, after_id = page[-1]["time_stamp"], page[-1]["id"]
+
+    def iter_many(self, ids: typing.Iterable[int], chunk_size: int = DEFAULT_CHUNK_SIZE) -> typing.Iterator[Record]:
+        """
+        Stream rows selected by id, ids are looked up in chunks of chunk_size.
+
+        Records of each chunk are ordered by (time_stamp, id), missing ids are skipped.
+        :param ids: keys of rows, may be lazy iterable
+        :param chunk_size: ids looked up per query
+        :return: records generator
+        """
+        keys: list[int] = []
+        for id_ in ids:
+            keys.append(id_)
+            if len(keys) == chunk_size:
+                yield from self._get_chunk(keys)
+                keys = []
+        if keys:
+            yield from self._get_chunk(keys)
+
+    def iter_after(self, id_: int, chunk_size: int = DEFAULT_CHUNK_SIZE) -> typing.Iterator[Record]:
+        """
+        Stream rows with id greater than id_ ordered by id, e.g. to replay records not processed yet
+        :param id_: exclusive lower bound of id
+        :param chunk_size: rows fetched per page
+        :return: records generator
+        """
+        while True:
+            with self.engine.connect() as con:
+                cur = con.execution_options(stream_results=True, yield_per=chunk_size).execute(
+                    self._id_page, {"after_id": id_, "chunk_size": chunk_size}
+                )
+                page = [self._record(row) for row in cur]
+            yield from page
+            if len(page) < chunk_size:
+                return
+            id_ = page[-1]["id"]
+
+    def _get_chunk(self, keys: list[int]) -> list[Record]:
+        with self.engine.connect() as con:
+            cur = con.execution_options(stream_results=True, yield_per=len(keys)).execute(
+                self._get_many_page, {"keys": keys}
+            )
+            return [self._record(row) for row in cur]
+
+
+class AsyncChronicle(ChronicleBase):
+    """
+    Permanent memory of raw knowledge for asyncio, same API as `Chronicle` with awaitable methods.
+
+    Create it with `await AsyncChronicle.open(url)` to have table ready, e.g. "sqlite+aiosqlite:///memory.db".
+    """
+    _engine: AsyncEngine
+
+    def __init__(self, url: str, **pool_options) -> None:
+        """
+        Set up async engine, table is created by `create_tables`
+        :param url: database url with async driver
+        :param pool_options: connection pool tuning, see `engine_options`
+        """
+        super().__init__()
+        self._engine = create_async_engine(url, **engine_options(url, **pool_options))
+
+    @classmethod
+    async def open(cls, url: str, **pool_options) -> "AsyncChronicle":
+        """Connect to database and create table if missing"""
+        chronicle = cls(url, **pool_options)
+        await chronicle.create_tables()
+        return chronicle
+
+    async def create_tables(self) -> None:
+        async with self._engine.begin() as con:
+            await con.run_sync(self.meta_data.create_all, checkfirst=True)
+            await con.run_sync(create_search_index)
+
+    @property
+    def engine(self) -> AsyncEngine:
+        return self._engine
+
+    async def close(self) -> None:
+        await self._engine.dispose()
+
+    @instrumented("async_chronicle.insert", "content", single, text_bytes)
+    async def insert(
+            self,
+            content: str,
+            time_stamp: typing.Optional[dt.datetime] = None,
+    ) -> Record:
+        """
+        Create new row
+        :param content: knowledge to insert
+        :param time_stamp: creation stamp
+        :return: inserted row
+        """
+        time_stamp_: dt.datetime = time_stamp or dt.datetime.utcnow()
+        async with self._engine.begin() as con:
+            cur = await con.execute(self.table.insert(), {"time_stamp": time_stamp_, "content": content})
+            id_ = cur.inserted_primary_key[0]
+        return {"id": id_, "time_stamp": time_stamp_, "content": content}
+
+    @instrumented("async_chronicle.insert_many", "contents", payload=text_bytes)
+    async def insert_many(
+            self,
+            contents: typing.Sequence[str],
+            time_stamps: typing.Optional[typing.Sequence[dt.datetime]] = None,
+    ) -> list[int]:
+        """
+        Create many rows with single executemany in one transaction
+        :param contents: knowledge to insert
+        :param time_stamps: creation stamp of each content, now if not set
+        :return: ids of inserted rows in the same order as contents
+        """
+        if not contents:
+            return []
+        async with self._engine.begin() as con:
+            cur = await con.execute(self._insert_many, self._insert_many_parameters(contents, time_stamps))
+            return [row.id for row in cur]
+
+    @instrumented("async_chronicle.insert_records", "records")
+    async def insert_records(self, records: typing.Sequence[Record]) -> None:
+        """
+        Insert rows with their ids, see `Chronicle.insert_records`
+        :param records: complete rows, ids must not exist yet
+        """
+        if not records:
+            return
+        async with self._engine.begin() as con:
+            await con.execute(self._insert_records, [dict(record) for record in records])
+            if con.dialect.name == "postgresql":
+                await con.execute(self._sync_sequence)
+
+    @instrumented("async_chronicle.get_one")
+    async def get_one(self, id_: int) -> typing.Optional[Record]:
+        """Select one rows by id, if does not exist return None"""
+        async with self._engine.connect() as con:
+            cur = await con.execute(self._get_one, {"key": id_})
+            row = cur.first()
+        return None if row is None else self._record(row)
+
+    @instrumented("async_chronicle.get_many", "ids")
+    async def get_many(self, ids: list[int]) -> list[Record]:
+        """Select many rows by id. len(returned) <= len(ids)"""
+        async with self._engine.connect() as con:
+            cur = await con.execute(self._get_many, {"keys": ids})
+            return [self._record(row) for row in cur]
+
+    @instrumented("async_chronicle.within", "ids")
+    async def within(self, ids: list[int], lower: dt.datetime, upper: dt.datetime) -> set[int]:
+        """
+        Ids of given records written within time range, see `Chronicle.within`
+        :param ids: record ids
+        :param lower: inclusive lower bound of time stamp
+        :param upper: inclusive upper bound of time stamp
+        :return: ids of records inside range
+        """
+        if not ids:
+            return set()
+        async with self._engine.connect() as con:
+            cur = await con.execute(self._within, {"keys": ids, "lower": lower, "upper": upper})
+            return {row.id for row in cur}
+
+    @instrumented("async_chronicle.search", "query", single, text_bytes)
+    async def search(self, query: str, k: int = DEFAULT_SEARCH_RESULTS) -> list[int]:
+        """
+        Full-text search of content, see `Chronicle.search`
+        :param query: free text, any of its words may match
+        :param k: max number of returned ids
+        :return: ids of matched records, the best first
+        """
+        statement = search_statement(self._engine.dialect.name, query, k)
+        if statement is None:
+            return []
+        async with self._engine.connect() as con:
+            cur = await con.execute(*statement)
+            return [row.id for row in cur]
+
+    @instrumented("async_chronicle.range")
+    async def range(self, lower: dt.datetime, upper: dt.datetime) -> list[Record]:
+        """Time scan of knowledge"""
+        async with self._engine.connect() as con:
+            cur = await con.execute(self._range_scan, {"lower": lower, "upper": upper})
+            return [self._record(row) for row in cur]
+
+    async def iter_range(
+            self,
+            lower: dt.datetime,
+            upper: dt.datetime,
+            chunk_size: int = DEFAULT_CHUNK_SIZE,
+            after: typing.Optional[tuple[dt.datetime, int]] = None,
+    ) -> typing.AsyncIterator[Record]:
+        """
+        Stream time scan of knowledge ordered by (time_stamp, id), see `Chronicle.iter_range`
+        :param lower: inclusive lower bound of time_stamp
+        :param upper: inclusive upper bound of time_stamp
+        :param chunk_size: rows fetched per page
+        :param after: resume scan after this (time_stamp, id) key
+        :return: records async generator
+        """
+        after_time_stamp, after_id = after or (lower, -1)
+        while True:
+            async with self._engine.connect() as con:
+                cur = await con.stream(
+                    self._range_page,
+                    self._range_page_parameters(lower, upper, chunk_size, after_time_stamp, after_id),
+                )
+                page = [self._record(row) async for row in cur]
+            for record in page:
+                yield record
+            if len(page) < chunk_size:
+                return
+            after_time_stamp, after_id = page[-1]["time_stamp"], page[-1]["id"]
+
+    async def iter_many(
+            self,
+            ids: typing.Iterable[int],
+            chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ) -> typing.AsyncIterator[Record]:
+        """
+        Stream rows selected by id, ids are looked up in chunks of chunk_size, see `Chronicle.iter_many`
+        :param ids: keys of rows, may be lazy iterable
+        :param chunk_size: ids looked up per query
+        :return: records async generator
+        """
+        keys: list[int] = []
+        for id_ in ids:
+            keys.append(id_)
+            if len(keys) == chunk_size:
+                for record in await self._get_chunk(keys):
+                    yield record
+                keys = []
+        if keys:
+            for record in await self._get_chunk(keys):
+                yield record
+
+    async def iter_after(self, id_: int, chunk_size: int = DEFAULT_CHUNK_SIZE) -> typing.AsyncIterator[Record]:
+        """
+        Stream rows with id greater than id_ ordered by id, see `Chronicle.iter_after`
+        :param id_: exclusive lower bound of id
+        :param chunk_size: rows fetched per page
+        :return: records async generator
+        """
+        while True:
+            async with self._engine.connect() as con:
+                cur = await con.stream(self._id_page, {"after_id": id_, "chunk_size": chunk_size})
+                page = [self._record(row) async for row in cur]
+            for record in page:
+                yield record
+            if len(page) < chunk_size:
+                return
+            id_ = page[-1]["id"]
+
+    async def _get_chunk(self, keys: list[int]) -> list[Record]:
+        async with self._engine.connect() as con:
+            cur = await con.stream(self._get_many_page, {"keys": keys})
+            return [self._record(row) async for row in cur]
@@ -0,0 +1,34 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append('../')
+
+
+class BenchmarksTest(unittest.TestCase):
+
+    def test_report(self):
+        from benchmarks.__main__ import main
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "results.json")
+            arguments = [
+                "--sizes", "200", "--backends", "local", "--texts", "20", "--records", "50", "--queries", "5",
+                "--window", "10", "--output", output,
+            ]
+            self.assertEqual(main(arguments), 0)
+            with open(output, encoding="utf-8") as file:
+                report = json.load(file)
+            names = {result["name"] for result in report["results"]}
+            self.assertLessEqual({"episodic_add", "vector_query", "graph_insert_facts", "chronicle_range"}, names)
+            precision = [result for result in report["results"] if result["name"] == "vector_precision"]
+            self.assertEqual(precision[0]["metrics"]["recall_at_10"], 1.0)
+            bytes_per_vector = [result["metrics"]["bytes_per_vector"] for result in precision]
+            self.assertLess(bytes_per_vector[-1], bytes_per_vector[0] / 3)
+            # the same run is its own baseline
+            self.assertEqual(main(arguments + ["--baseline", output, "--tolerance", "1"]), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import datetime as dt
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append('../')
+
+START = dt.datetime(2023, 5, 1)
+CONTENTS = [f"message {i}" for i in range(10)]
+TIME_STAMPS = [START + dt.timedelta(minutes=i // 2) for i in range(10)]
+
+
+class ChronicleTest(unittest.TestCase):
+
+    def setUp(self):
+        from muninn.weave.fact import Chronicle
+        self.directory = tempfile.TemporaryDirectory()
+        self.chronicle = Chronicle(f"sqlite:///{os.path.join(self.directory.name, 'chronicle.db')}", pool_size=2)
+
+    def tearDown(self):
+        self.chronicle.close()
+        self.directory.cleanup()
+
+    def test_insert(self):
+        record = self.chronicle.insert("hello", START)
+        self.assertEqual(self.chronicle.get_one(record["id"]), record)
+
+    def test_insert_many(self):
+        ids = self.chronicle.insert_many(CONTENTS, TIME_STAMPS)
+        self.assertEqual(len(ids), len(CONTENTS))
+        self.assertEqual([record["content"] for record in self.chronicle.get_many(ids)], CONTENTS)
+
+    def test_iter_range(self):
+        ids = self.chronicle.insert_many(CONTENTS, TIME_STAMPS)
+        upper = START + dt.timedelta(hours=1)
+        records = list(self.chronicle.iter_range(START, upper, chunk_size=3))
+        self.assertEqual([record["id"] for record in records], ids)
+        resumed = list(self.chronicle.iter_range(START, upper, chunk_size=3, after=(TIME_STAMPS[4], ids[4])))
+        self.assertEqual([record["id"] for record in resumed], ids[5:])
+
+    def test_insert_many_order(self):
+        time_stamps = list(reversed(TIME_STAMPS))
+        ids = self.chronicle.insert_many(CONTENTS, time_stamps)
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual([self.chronicle.get_one(id_)["content"] for id_ in ids], CONTENTS)
+        self.assertEqual([self.chronicle.get_one(id_)["time_stamp"] for id_ in ids], time_stamps)
+
+    def test_iter_range_ties(self):
+        # every page boundary splits rows of the same time stamp
+        ids = self.chronicle.insert_many(CONTENTS, [START] * len(CONTENTS))
+        for chunk_size in (1, 2, 3, len(CONTENTS)):
+            records = list(self.chronicle.iter_range(START, START, chunk_size=chunk_size))
+            self.assertEqual([record["id"] for record in records], ids)
+        resumed = list(self.chronicle.iter_range(START, START, chunk_size=2, after=(START, ids[2])))
+        self.assertEqual([record["id"] for record in resumed], ids[3:])
+
+    def test_within(self):
+        ids = self.chronicle.insert_many(CONTENTS, TIME_STAMPS)
+        upper = START + dt.timedelta(minutes=1)
+        self.assertEqual(self.chronicle.within([ids[0], ids[3], ids[4], -1], START, upper), {ids[0], ids[3]})
+        self.assertEqual(self.chronicle.within([], START, upper), set())
+
+    def test_iter_many(self):
+        ids = self.chronicle.insert_many(CONTENTS, TIME_STAMPS)
+        records = list(self.chronicle.iter_many(iter(ids + [-1]), chunk_size=4))
+        self.assertEqual([record["id"] for record in records], ids)
+
+    def test_search(self):
+        contents = ["Valji found sword SW-1234.", "Počasí bylo pěkné.", "Valji sold the sword."]
+        ids = self.chronicle.insert_many(contents)
+        self.assertEqual(self.chronicle.search("Who has SW-1234?"), [ids[0]])
+        self.assertEqual(set(self.chronicle.search("sword", k=5)), {ids[0], ids[2]})
+        self.assertEqual(self.chronicle.search("pocasi"), [ids[1]])
+        self.assertEqual(self.chronicle.search('?! NEAR("sword" content:'), self.chronicle.search("near sword content"))
+        self.assertEqual(self.chronicle.search("?!"), [])
+
+    def test_search_other_dialect(self):
+        from muninn.weave.fact import search_statement
+        self.assertIsNotNone(search_statement("postgresql", "Who has SW-1234?", 5))
+        self.assertIsNone(search_statement("mysql", "Who has SW-1234?", 5))
+
+    def test_search_existing_records(self):
+        from sqlalchemy import text
+        from muninn.weave.fact import Chronicle
+        ids = self.chronicle.insert_many(CONTENTS, TIME_STAMPS)
+        with self.chronicle.engine.begin() as con:
+            for name in ("insert", "delete", "update"):
+                con.execute(text(f"DROP TRIGGER chronicle_search_{name}"))
+            con.execute(text("DROP TABLE chronicle_search"))
+        chronicle = Chronicle(str(self.chronicle.engine.url))
+        try:
+            self.assertEqual(chronicle.search("message 3", k=1), [ids[3]])
+            record = chronicle.insert("new message 11")
+            self.assertEqual(chronicle.search("11"), [record["id"]])
+        finally:
+            chronicle.close()
+
+
+class AsyncChronicleTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        from muninn.weave.fact import AsyncChronicle
+        self.directory = tempfile.TemporaryDirectory()
+        self.chronicle = await AsyncChronicle.open(
+            f"sqlite+aiosqlite:///{os.path.join(self.directory.name, 'chronicle.db')}"
+        )
+
+    async def asyncTearDown(self):
+        await self.chronicle.close()
+        self.directory.cleanup()
+
+    async def test_insert(self):
+        record = await self.chronicle.insert("hello", START)
+        self.assertEqual(await self.chronicle.get_one(record["id"]), record)
+
+    async def test_iter_range(self):
+        ids = await self.chronicle.insert_many(CONTENTS, TIME_STAMPS)
+        records = [record async for record in self.chronicle.iter_range(START, START + dt.timedelta(hours=1), 3)]
+        self.assertEqual([record["id"] for record in records], ids)
+        self.assertEqual(len(await self.chronicle.range(START, START + dt.timedelta(minutes=1))), 4)
+
+    async def test_within(self):
+        ids = await self.chronicle.insert_many(CONTENTS, TIME_STAMPS)
+        self.assertEqual(await self.chronicle.within(ids[3:6], START, START + dt.timedelta(minutes=1)), {ids[3]})
+
+    async def test_search(self):
+        ids = await self.chronicle.insert_many(CONTENTS, TIME_STAMPS)
+        self.assertEqual(await self.chronicle.search("message 7", k=1), [ids[7]])
+
+
+if __name__ == '__main__':
+    unittest.main()
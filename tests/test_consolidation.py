@@ -0,0 +1,141 @@
+import datetime as dt
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append('../')
+
+START = dt.datetime(2023, 5, 1)
+DAY = 24 * 3600.0
+# Chronicle keeps naive UTC time stamps
+NOW = START.replace(tzinfo=dt.timezone.utc).timestamp()
+VECTORS = {
+    "Valji found a sword.": [1.0, 0.0, 0.0],
+    "Valji found a sword!": [0.999, 0.01, 0.0],
+    "The weather was nice.": [0.0, 1.0, 0.0],
+    "Muninn flew away.": [0.0, 0.0, 1.0],
+    # each is near-duplicate of the previous one, the first and the last are too far apart
+    "Valji found an old sword.": [1.0, 0.12, 0.0],
+    "Valji found an old rusty sword.": [1.0, 0.24, 0.0],
+}
+
+
+class ConsolidatorTest(unittest.TestCase):
+
+    def setUp(self):
+        from muninn.consolidation import ConsolidationState
+        from muninn.database.local import LocalClient
+        from muninn.database.similarity import VectorStorage
+        from muninn.weave.fact import Chronicle
+        self.directory = tempfile.TemporaryDirectory()
+        self.chronicle = Chronicle(f"sqlite:///{os.path.join(self.directory.name, 'chronicle.db')}")
+        self.storage = VectorStorage(client=LocalClient())
+        self.archive = VectorStorage(client=LocalClient())
+        self.state = ConsolidationState(os.path.join(self.directory.name, "consolidation.sqlite"))
+
+    def tearDown(self):
+        self.state.close()
+        self.chronicle.close()
+        self.directory.cleanup()
+
+    def remember(self, texts, day=0):
+        ids = self.chronicle.insert_many(texts, [START + dt.timedelta(days=day)] * len(texts))
+        self.storage.add_many([VECTORS[text] for text in texts], texts)
+        return ids
+
+    def create_consolidator(self, **options):
+        from muninn.consolidation import Consolidator, Decay
+        options.setdefault("decay", Decay(half_life=DAY, min_strength=0.25))
+        return Consolidator(self.storage, self.chronicle, self.state, self.archive, **options)
+
+    def test_merge_keeps_provenance(self):
+        from muninn.database.similarity import document_id
+        ids = self.remember(["Valji found a sword.", "Valji found a sword!", "The weather was nice."])
+        report = self.create_consolidator().run(now=NOW)
+        self.assertEqual((report.records, report.merged), (3, 1))
+        kept = document_id("Valji found a sword.")
+        self.assertEqual(self.storage.collection.count(), 2)
+        self.assertEqual(self.state.provenance(kept), ids[:2])
+        metadata = self.storage.get_many([kept], include=["metadatas"]).metadatas[0]
+        self.assertEqual(json.loads(metadata["chronicle_ids"]), ids[:2])
+
+    def test_chain_not_merged(self):
+        from muninn.database.similarity import document_id
+        ids = self.remember(["Valji found a sword.", "Valji found an old sword.", "Valji found an old rusty sword."])
+        report = self.create_consolidator().run(now=NOW)
+        self.assertEqual(report.merged, 1)
+        self.assertEqual(self.state.provenance(document_id("Valji found a sword.")), ids[:2])
+        self.assertEqual(self.state.provenance(document_id("Valji found an old rusty sword.")), ids[2:])
+
+    def test_unknown_neighbor(self):
+        from muninn.database.similarity import document_id
+        # stored before consolidation, no record and no label of earlier pass
+        self.storage.add_many([VECTORS["Valji found a sword!"]], ["Valji found a sword!"])
+        ids = self.remember(["Valji found a sword."])
+        self.assertEqual(self.create_consolidator().run(now=NOW).merged, 0)
+        self.assertEqual(self.storage.collection.count(), 2)
+        self.assertEqual(self.state.provenance(document_id("Valji found a sword.")), ids)
+
+    def test_labeled_neighbor(self):
+        from muninn.database.similarity import document_id
+        # consolidated by earlier pass whose state was lost, label still holds provenance
+        self.storage.add_many(
+            [VECTORS["Valji found a sword!"]], ["Valji found a sword!"], [{"chronicle_ids": json.dumps([7, 8])}]
+        )
+        ids = self.remember(["Valji found a sword."])
+        self.assertEqual(self.create_consolidator().run(now=NOW).merged, 1)
+        self.assertEqual(self.storage.collection.count(), 1)
+        self.assertEqual(self.state.provenance(document_id("Valji found a sword.")), [*ids, 7, 8])
+
+    def test_incremental(self):
+        from muninn.database.similarity import document_id
+        consolidator = self.create_consolidator()
+        first = self.remember(["Valji found a sword.", "The weather was nice."])
+        consolidator.run(now=NOW)
+        self.assertEqual(consolidator.run(now=NOW).records, 0)
+        later = self.remember(["Valji found a sword!"], day=1)
+        report = consolidator.run(now=NOW)
+        self.assertEqual((report.records, report.merged), (1, 1))
+        self.assertEqual(self.state.provenance(document_id("Valji found a sword.")), [first[0], *later])
+
+    def test_waits_for_ingestion(self):
+        from muninn.ingestion import MemoryCheckpoint
+        ids = self.remember(["Valji found a sword.", "The weather was nice."])
+        consolidator = self.create_consolidator(until=MemoryCheckpoint(ids[0]))
+        self.assertEqual(consolidator.run(now=NOW).records, 1)
+        self.assertEqual(self.state.load(), ids[0])
+
+    def test_decay_archives_cold(self):
+        from muninn.consolidation import AccessLog, TrackedVectorStorage
+        from muninn.database.similarity import document_id
+        self.remember(["Valji found a sword.", "The weather was nice.", "Muninn flew away."])
+        access_log = AccessLog()
+        consolidator = self.create_consolidator(access_log=access_log)
+        consolidator.run(now=NOW)
+        # recalled memory decays slower
+        TrackedVectorStorage(self.storage, access_log).query(VECTORS["Muninn flew away."], n_results=1)
+        self.assertEqual(len(access_log), 1)
+        report = consolidator.run(now=NOW + 2.5 * DAY)
+        self.assertEqual(report.archived, 2)
+        self.assertEqual(self.storage.collection.count(), 1)
+        self.assertEqual(self.archive.collection.count(), 2)
+        self.assertTrue(self.storage.get_many([document_id("Muninn flew away.")]).ids)
+        self.assertEqual(consolidator.run(now=NOW + 2.5 * DAY).archived, 0)
+
+    def test_background(self):
+        import time
+        from muninn.consolidation import Decay
+        self.remember(["Valji found a sword.", "Valji found a sword!"])
+        # passes run at current time, memories of 2023 stay only with long half life
+        with self.create_consolidator(decay=Decay(half_life=100 * 365 * DAY)) as consolidator:
+            consolidator.start(interval=0.01)
+            deadline = time.monotonic() + 5
+            while self.storage.collection.count() > 1 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertEqual(self.storage.collection.count(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
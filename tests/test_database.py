@@ -11,15 +11,9 @@ class SimilarityDBTest(unittest.TestCase):
 
     @staticmethod
     def create_storage():
-        from muninn.database.similarity_db import Settings, VectorStorage
-        storage = VectorStorage(
-            Settings(
-                chroma_api_impl="rest",
-                chroma_server_host="localhost",
-                chroma_server_http_port="8000",
-            ),
-            "test_collection",
-        )
+        from muninn.database.similarity import Settings, VectorStorage
+        # in-process chroma, no server needed
+        storage = VectorStorage(Settings(anonymized_telemetry=False), "test_collection")
         return storage
 
     def test_connect(self):
@@ -34,11 +28,316 @@ class SimilarityDBTest(unittest.TestCase):
             ids.append(new_id)
         self.assertEquals(len(ids), 2)
 
+    def test_add_many(self):
+        storage = self.create_storage()
+        ids = storage.add_many(embeddings=EMBEDDINGS + EMBEDDINGS[:1], documents=DOCS + DOCS[:1])
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(ids[0], ids[2])
+
     def test_query(self):
         storage = self.create_storage()
         results = [storage.query(embedding=[1.5, 2.0, 4.0], n_results=2)]
         self.assertIsNotNone(results)
 
+    def test_query_many(self):
+        storage = self.create_storage()
+        storage.add_many(embeddings=EMBEDDINGS, documents=DOCS)
+        matched = storage.query_many(embeddings=EMBEDDINGS, n_results=1)
+        self.assertEqual([result.documents for result in matched], [DOCS[:1], DOCS[1:]])
+        self.assertEqual(matched[0].distances, [0.0])
+
+
+class LocalStorageTest(unittest.TestCase):
+
+    @staticmethod
+    def create_storage():
+        from muninn.database.local import LocalClient
+        from muninn.database.similarity import VectorStorage
+        return VectorStorage(client=LocalClient(), collection_name="test_collection")
+
+    def test_add_many(self):
+        storage = self.create_storage()
+        ids = storage.add_many(embeddings=EMBEDDINGS + EMBEDDINGS[:1], documents=DOCS + DOCS[:1])
+        self.assertEqual(len(set(ids)), 2)
+        self.assertEqual(ids[0], ids[2])
+
+    def test_query(self):
+        storage = self.create_storage()
+        storage.add_many(embeddings=EMBEDDINGS, documents=DOCS)
+        self.assertEqual(storage.query(embedding=[1.5, 2.0, 4.0], n_results=2), DOCS)
+        self.assertEqual(storage.query(embedding=[6.0, 8.0, 9.0], n_results=1), DOCS[1:])
+
+    def test_deterministic_id(self):
+        from muninn.database.similarity import document_id
+        storage = self.create_storage()
+        doc_id = storage.add(embedding=EMBEDDINGS[0], document=DOCS[0])
+        self.assertEqual(doc_id, document_id(DOCS[0]))
+        self.assertEqual(storage.add(embedding=EMBEDDINGS[1], document=f" {DOCS[0]}\n"), doc_id)
+        self.assertEqual(storage.collection.count(), 1)
+
+    def test_concurrent_add(self):
+        import threading
+        import time
+        storage = self.create_storage()
+        get = storage.collection.get
+
+        def slow_get(*args, **kwargs):
+            # both writers miss the lookup
+            result = get(*args, **kwargs)
+            time.sleep(0.001)
+            return result
+
+        storage.collection.get = slow_get
+        errors = []
+
+        def add(embedding):
+            try:
+                storage.add_many([embedding] * 50 + EMBEDDINGS[1:], [DOCS[0]] * 50 + DOCS[1:])
+            except Exception as error:
+                errors.append(error)
+
+        for _ in range(20):
+            threads = [threading.Thread(target=add, args=(embedding,)) for embedding in EMBEDDINGS]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(storage.collection.count(), 2)
+
+    def test_embeddings_locked(self):
+        import threading
+        import numpy as np
+        from muninn.database.local import LocalCollection
+        collection = LocalCollection("test_collection")
+        collection.add(ids=["a", "b"], embeddings=EMBEDDINGS)
+        embeddings = collection.embeddings
+        collection.upsert(ids=["a"], embeddings=[EMBEDDINGS[1]])
+        # snapshot does not see later writes
+        self.assertEqual(embeddings.tolist(), np.asarray(EMBEDDINGS, dtype=np.float32).tolist())
+        with collection._lock:
+            reader = threading.Thread(target=lambda: (collection.embeddings, collection.nbytes))
+            reader.start()
+            reader.join(0.05)
+            self.assertTrue(reader.is_alive())
+        reader.join()
+
+    def test_annoy_index(self):
+        import tempfile
+        from muninn.database.local import LocalCollection
+        with tempfile.TemporaryDirectory() as directory:
+            collection = LocalCollection("test_collection", path=directory, annoy_threshold=2)
+            collection.add(ids=["a", "b", "c"], embeddings=[[0.0, 0.0], [1.0, 1.0], [5.0, 5.0]])
+            result = collection.query(query_embeddings=[0.9, 0.9], n_results=2)
+            self.assertEqual(result["ids"], [["b", "a"]])
+            collection.add(ids=["d"], embeddings=[[0.9, 0.9]])
+            result = collection.query(query_embeddings=[0.9, 0.9], n_results=1)
+            self.assertEqual(result["ids"], [["d"]])
+
+    def test_precision(self):
+        import tempfile
+        from muninn.database.local import LocalCollection
+        with tempfile.TemporaryDirectory() as directory:
+            for precision in ("float16", "int8"):
+                collection = LocalCollection(precision, path=directory, precision=precision)
+                collection.add(ids=["a", "b"], embeddings=EMBEDDINGS, documents=DOCS)
+                self.assertEqual(collection.query(query_embeddings=[6.0, 8.0, 9.0], n_results=1)["ids"], [["b"]])
+                collection.persist()
+                loaded = LocalCollection(precision, path=directory, precision=precision)
+                self.assertEqual(loaded.embeddings.dtype.name, "float32")
+                self.assertTrue(abs(loaded.embeddings - collection.embeddings).max() == 0)
+                self.assertLess(loaded.nbytes, 24)
+
+
+class QuantizationTest(unittest.TestCase):
+
+    def test_int8(self):
+        import numpy as np
+        from muninn.database.vectors import QuantizedVectors
+        vectors = np.random.default_rng(0).standard_normal((100, 64)).astype(np.float32)
+        vectors[0] = 0
+        quantized = QuantizedVectors.encode(vectors, "int8")
+        self.assertEqual(quantized.precision, "int8")
+        self.assertEqual(quantized.nbytes, 100 * 64 + 100 * 4)
+        error = np.abs(quantized.decode() - vectors).max(axis=1)
+        self.assertTrue((error <= quantized.scales / 2 + 1e-6).all())
+        self.assertFalse(quantized[0].decode().any())
+
+    def test_recall_at_k(self):
+        from muninn.database.vectors import recall_at_k
+        self.assertEqual(recall_at_k([["a", "b"], ["c", "d"]], [["b", "a"], ["c", "e"]]), 0.75)
+
+
+class RecallCacheTest(unittest.TestCase):
+
+    @staticmethod
+    def create_storage(**options):
+        import numpy as np
+        from muninn.database.cache import CachedVectorStorage, RecallCache
+        from muninn.database.local import LocalClient
+        from muninn.database.similarity import VectorStorage
+        vectors = np.random.default_rng(0).standard_normal((50, 16)).astype(np.float32)
+        storage = CachedVectorStorage(VectorStorage(client=LocalClient()), RecallCache(**options))
+        storage.add_many(vectors, [f"doc {i}" for i in range(len(vectors))])
+        return storage, vectors
+
+    def test_similar_query_hit(self):
+        storage, vectors = self.create_storage(threshold=0.99)
+        first = storage.query(vectors[3], n_results=5)
+        second = storage.query(vectors[3] * 1.01 + 0.001, n_results=3)
+        other = storage.query(-vectors[3], n_results=3)
+        self.assertEqual(first[0], "doc 3")
+        self.assertEqual(second, first[:3])
+        self.assertNotEqual(other[0], "doc 3")
+        self.assertEqual((storage.cache.stats.hits, storage.cache.stats.misses), (1, 2))
+        self.assertAlmostEqual(storage.cache.stats.hit_rate, 1 / 3)
+
+    def test_invalidation(self):
+        storage, vectors = self.create_storage()
+        storage.query(vectors[3], n_results=5)
+        storage.add(vectors[3] * 100, "far away")
+        self.assertEqual(len(storage.cache), 1)
+        storage.add(vectors[3] * 1.001, "near")
+        self.assertEqual(len(storage.cache), 0)
+        self.assertEqual(storage.cache.stats.invalidations, 1)
+        self.assertIn("near", storage.query(vectors[3], n_results=5)[:2])
+
+    def test_upsert(self):
+        storage, vectors = self.create_storage()
+        doc_ids = storage.collection.get(include=[])["ids"]
+        storage.query(vectors[3], n_results=5)
+        storage.query(-vectors[3], n_results=5)
+        # far from both queries, but replaces a document one of them holds
+        held = storage.nearest(-vectors[3], n_results=5).ids[0]
+        storage.upsert_many([held], [vectors[3] * 100], ["replaced"])
+        self.assertEqual(len(storage.cache), 1)
+        self.assertNotIn("replaced", storage.query(-vectors[3], n_results=5))
+        storage.upsert_many(["new"], [vectors[3] * 1.001], ["near"])
+        self.assertIn("near", storage.query(vectors[3], n_results=5)[:2])
+        exported = [id_ for page in storage.iter_all(batch_size=16) for id_ in page.ids]
+        self.assertEqual(sorted(exported), sorted(doc_ids + ["new"]))
+
+    def test_lru_and_ttl(self):
+        import time
+        storage, vectors = self.create_storage(max_entries=2, ttl=0.05)
+        storage.query_many(vectors[:3], n_results=2)
+        self.assertEqual(len(storage.cache), 2)
+        self.assertEqual(storage.cache.stats.evictions, 1)
+        time.sleep(0.1)
+        storage.query_many(vectors[1:3], n_results=2)
+        self.assertEqual(storage.cache.stats.hits, 0)
+        self.assertEqual(storage.cache.stats.expirations, 2)
+
+    def test_where_not_shared(self):
+        storage, vectors = self.create_storage()
+        storage.query_many(vectors[:1], n_results=2)
+        self.assertEqual(storage.query_many(vectors[:1], n_results=2, where={"author": "Valji"})[0].ids, [])
+        self.assertEqual(storage.cache.stats.hits, 0)
+
+
+class ShardedStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        import numpy as np
+        from muninn.database.local import LocalClient
+        from muninn.database.sharding import ShardedVectorStorage
+        self.vectors = np.random.default_rng(0).standard_normal((60, 16)).astype(np.float32)
+        self.storage = ShardedVectorStorage([LocalClient(), LocalClient()], shards=4)
+        self.tenants = [f"agent-{i}" for i in range(6)]
+        for index, tenant in enumerate(self.tenants):
+            rows = slice(index * 10, index * 10 + 10)
+            self.storage.add_many(tenant, self.vectors[rows], [f"{tenant} doc {i}" for i in range(10)])
+
+    def tearDown(self):
+        self.storage.close()
+
+    def test_tenant_isolation(self):
+        from muninn.database.sharding import tenant_document_id
+        self.assertEqual(self.storage.shard_of("agent-1"), self.storage.shard_of("agent-1"))
+        # the same text of other tenant is not a duplicate
+        self.storage.add_many("agent-0", self.vectors[10:11], ["agent-1 doc 0"])
+        result = self.storage.nearest("agent-1", self.vectors[10], n_results=20)
+        self.assertEqual(len(result.ids), 10)
+        self.assertEqual(result.documents[0], "agent-1 doc 0")
+        self.assertNotIn(tenant_document_id("agent-0", "agent-1 doc 0"), result.ids)
+        self.assertEqual(self.storage.get_many("agent-0", result.ids[:1]).ids, [])
+
+    def test_cross_shard_merge(self):
+        import numpy as np
+        from muninn.database.local import LocalClient
+        from muninn.database.similarity import VectorStorage
+        single = VectorStorage(client=LocalClient())
+        single.add_many(self.vectors, [f"{tenant} doc {i}" for tenant in self.tenants for i in range(10)])
+        queries = self.vectors[[3, 27, 55]] + 0.1
+        merged = self.storage.query_many(queries, n_results=7)
+        expected = single.query_many(queries, n_results=7)
+        self.assertEqual([result.documents for result in merged], [result.documents for result in expected])
+        for result, reference in zip(merged, expected):
+            np.testing.assert_allclose(result.distances, reference.distances, rtol=1e-5)
+        subset = self.storage.query_many(queries[:1], n_results=30, tenants=["agent-0", "agent-5"])[0]
+        self.assertEqual({document.split()[0] for document in subset.documents}, {"agent-0", "agent-5"})
+        self.assertEqual(len(subset.ids), 20)
+
+    def test_stats_and_move(self):
+        stats = self.storage.stats()
+        self.assertEqual(sum(shard.size for shard in stats), 60)
+        self.assertEqual(sum(shard.tenants for shard in stats), 6)
+        self.storage.query_many(self.vectors[:2], n_results=3)
+        self.assertTrue(all(shard.queries == 1 for shard in self.storage.stats()))
+        source = self.storage.shard_of("agent-2")
+        target = (source + 1) % len(self.storage.shards)
+        self.assertEqual(self.storage.move("agent-2", target), 10)
+        self.assertEqual(self.storage.placement, {"agent-2": target})
+        self.assertEqual(len(self.storage.nearest("agent-2", self.vectors[20], n_results=20).ids), 10)
+        self.assertEqual(self.storage.stats()[source].size, stats[source].size - 10)
+
+    def test_move_pins_first(self):
+        source = self.storage.shard_of("agent-2")
+        target = self.storage.shards[(source + 1) % len(self.storage.shards)]
+        upsert_many = target.storage.upsert_many
+        placed = []
+
+        def copy(*args):
+            # writes of tenant during move already go to target
+            placed.append(self.storage.shard_of("agent-2"))
+            upsert_many(*args)
+
+        target.storage.upsert_many = copy
+        self.storage.move("agent-2", target.index, batch_size=4)
+        self.assertEqual(placed, [target.index] * 3)
+
+    def test_shared_client(self):
+        import threading
+        import time
+        from muninn.database.similarity import Settings, VectorStorage
+        from muninn.database.sharding import ShardedVectorStorage
+        client = VectorStorage(Settings(anonymized_telemetry=False), "unsharded").client
+        storage = ShardedVectorStorage([client], shards=3, collection_name="shared")
+        self.addCleanup(storage.close)
+        for index, tenant in enumerate(self.tenants):
+            rows = slice(index * 10, index * 10 + 10)
+            storage.add_many(tenant, self.vectors[rows].tolist(), [f"{tenant} doc {i}" for i in range(10)])
+        lock = threading.Lock()
+        running = []
+        overlaps = []
+        for shard in storage.shards:
+            def query_many(*args, query=shard.storage.query_many):
+                with lock:
+                    running.append(1)
+                    overlaps.append(len(running))
+                time.sleep(0.02)
+                try:
+                    return query(*args)
+                finally:
+                    with lock:
+                        running.pop()
+
+            shard.storage.query_many = query_many
+        merged = storage.query_many(self.vectors[[3, 27]].tolist(), n_results=5)
+        self.assertEqual([result.documents[0] for result in merged], ["agent-0 doc 3", "agent-2 doc 7"])
+        # three shards of one client are asked one after another
+        self.assertEqual(overlaps, [1, 1, 1])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,134 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.append('../')
+
+
+class FakeEmbedder:
+    model = "fake"
+
+    def __init__(self):
+        self.calls = 0
+        self.release = threading.Event()
+        self.release.set()
+
+    def get_many(self, texts):
+        self.release.wait()
+        self.calls += 1
+        return [[float(len(text)), float(sum(map(ord, text)) % 97), 1.0] for text in texts]
+
+    def get(self, text):
+        return self.get_many([text])[0]
+
+
+class EpisodicTest(unittest.TestCase):
+
+    def test_recall_many(self):
+        from muninn.database.local import LocalClient
+        from muninn.database.similarity import VectorStorage
+        from muninn.episodic import Episodic
+        embedder = FakeEmbedder()
+        memory = Episodic(embedder, VectorStorage(client=LocalClient()))
+        memory.add_many(["sword", "shield", "a long story"])
+        calls = embedder.calls
+        recalled = memory.recall_many(["sword", "a long story"], n_results=2)
+        self.assertEqual(embedder.calls, calls + 1)
+        self.assertEqual([texts[0] for texts in recalled], ["sword", "a long story"])
+        self.assertTrue(all(len(texts) == 2 for texts in recalled))
+        self.assertEqual(memory.recall_many([]), [])
+
+    def test_query_many_where(self):
+        from muninn.database.local import LocalClient
+        from muninn.database.similarity import VectorStorage
+        storage = VectorStorage(client=LocalClient())
+        storage.collection.add(
+            ids=["a", "b"], embeddings=[[0.0, 1.0], [0.0, 1.1]], documents=["A", "B"],
+            metadatas=[{"author": "Valji"}, {"author": "Muninn"}],
+        )
+        matched = storage.query_many([[0.0, 1.0], [0.0, 1.1]], n_results=2, where={"author": "Muninn"})
+        self.assertEqual([result.ids for result in matched], [["b"], ["b"]])
+        self.assertAlmostEqual(matched[0].distances[0], 0.01, places=5)
+
+
+class WriteBehindEpisodicTest(unittest.TestCase):
+
+    def setUp(self):
+        from muninn.database.local import LocalClient
+        from muninn.database.similarity import VectorStorage
+        self.embedder = FakeEmbedder()
+        self.storage = VectorStorage(client=LocalClient())
+
+    def create_memory(self, **options):
+        from muninn.episodic import WriteBehindEpisodic
+        return WriteBehindEpisodic(self.embedder, self.storage, **options)
+
+    def test_batched_flush(self):
+        with self.create_memory(flush_size=10, flush_interval=60) as memory:
+            futures = [memory.submit(f"message {number}") for number in range(25)]
+            memory.flush()
+            self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(self.storage.collection.count(), 25)
+        self.assertEqual(self.embedder.calls, 3)
+        self.assertEqual(futures[0].result().source, "message 0")
+
+    def test_flush_interval(self):
+        with self.create_memory(flush_size=100, flush_interval=0.01) as memory:
+            future = memory.submit("hello")
+            self.assertEqual(future.result(timeout=5).source, "hello")
+
+    def test_recall_pending(self):
+        with self.create_memory(flush_size=100, flush_interval=60) as memory:
+            memory.add("stored")
+            memory.submit("pending")
+            self.assertEqual(memory.recall("pending", n_results=1), ["pending"])
+            self.assertEqual(sorted(memory.recall("pending", n_results=5)), ["pending", "stored"])
+            self.assertEqual(self.storage.collection.count(), 1)
+        self.assertEqual(self.storage.collection.count(), 2)
+
+    def test_add_keeps_contract(self):
+        with self.create_memory(flush_size=100, flush_interval=60) as memory:
+            analyzed = memory.add("now")
+            self.assertEqual((analyzed.source, self.storage.collection.count()), ("now", 1))
+            self.assertEqual([item.source for item in memory.add_many(["a", "b"])], ["a", "b"])
+            self.assertEqual(self.storage.collection.count(), 3)
+
+    def test_recall_pending_in_storage_space(self):
+        from muninn.database.local import LocalClient
+        from muninn.database.similarity import VectorStorage
+        from muninn.episodic import WriteBehindEpisodic
+        vectors = {"query": [1.0, 0.0], "stored": [10.0, 10.0], "pending": [3.0, 0.0]}
+
+        class VectorEmbedder:
+            model = "vectors"
+
+            def get_many(self, texts):
+                return [vectors[text] for text in texts]
+
+        storage = VectorStorage(client=LocalClient(space="cosine"))
+        with WriteBehindEpisodic(VectorEmbedder(), storage, flush_size=100, flush_interval=60) as memory:
+            memory.add("stored")
+            memory.submit("pending")
+            # same direction as query, squared l2 distance 4 would rank it behind cosine distance 0.29
+            self.assertEqual(memory.recall("query", n_results=2), ["pending", "stored"])
+
+    def test_chronicle_before_flush(self):
+        from muninn.weave.fact import Chronicle
+        with tempfile.TemporaryDirectory() as directory:
+            chronicle = Chronicle(f"sqlite:///{os.path.join(directory, 'chronicle.db')}")
+            self.embedder.release.clear()
+            memory = self.create_memory(chronicle=chronicle, flush_size=1)
+            future = memory.submit("durable")
+            self.assertEqual(chronicle.get_one(1)["content"], "durable")
+            self.assertFalse(future.done())
+            self.embedder.release.set()
+            memory.close()
+            chronicle.close()
+        self.assertEqual(self.storage.collection.count(), 1)
+        self.assertEqual(self.storage.collection.get(include=["metadatas"])["metadatas"], [{"chronicle_ids": "[1]"}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+import datetime as dt
+import sys
+import unittest
+
+sys.path.append('../')
+
+
+class FakeResult(list):
+
+    def __init__(self, rows, log):
+        super().__init__(rows)
+        self.log = log
+        self.position = 0
+
+    def fetch(self, n):
+        self.log.append(("fetch", n))
+        rows = self[self.position:self.position + n]
+        self.position += len(rows)
+        return rows
+
+
+class FakeTransaction:
+
+    def __init__(self, log, rows=None):
+        self.log = log
+        self.rows = rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def run(self, query, parameters=None):
+        self.log.append(("run", query, parameters))
+        if self.rows is not None:
+            return FakeResult(self.rows, self.log)
+        facts = (parameters or {}).get("facts", [None])
+        fact_ids = [3 + index for index in range(len(facts))]
+        return FakeResult([{"node_id": 1, "element_id": "4:db:1", "fact_ids": fact_ids}], self.log)
+
+    def commit(self):
+        self.log.append("commit")
+
+    def rollback(self):
+        self.log.append("rollback")
+
+    def close(self):
+        self.log.append("close")
+
+
+class FakeSession:
+
+    def __init__(self, log, rows=None):
+        self.log = log
+        self.rows = rows
+
+    def __enter__(self):
+        self.log.append("session")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.log.append("end")
+
+    def begin_transaction(self):
+        self.log.append("begin")
+        return FakeTransaction(self.log, self.rows)
+
+    def execute_write(self, work, *args):
+        self.log.append("write")
+        return work(FakeTransaction(self.log), *args)
+
+    def execute_read(self, work, *args):
+        self.log.append(("read", getattr(work, "timeout", None)))
+        return work(FakeTransaction(self.log), *args)
+
+
+class FakeDriver:
+
+    def __init__(self):
+        self.log = []
+        self.rows = None
+
+    def session(self):
+        return FakeSession(self.log, self.rows)
+
+    def close(self):
+        pass
+
+
+class UnitOfWorkTest(unittest.TestCase):
+
+    def setUp(self):
+        from muninn.database.graph import GraphDB
+        # driver connects lazily, nothing is sent before it is replaced
+        self.graph = GraphDB("bolt://localhost:7687", "neo4j", "password")
+        self.graph._driver.close()
+        self.driver = FakeDriver()
+        self.graph._driver = self.driver
+
+    def steps(self):
+        return [step if isinstance(step, str) else step[0] for step in self.driver.log]
+
+    def test_commit(self):
+        from muninn.database.graph import Fact
+        with self.graph.batch():
+            self.assertEqual(self.graph.find_or_create_entity("Valji"), 1)
+            self.assertEqual(self.graph.insert_facts([Fact("Valji owns sword", entities=[("Valji", "subject")])]), [3])
+        self.assertEqual(self.steps(), ["session", "begin", "run", "run", "commit", "close", "end"])
+
+    def test_rollback(self):
+        with self.assertRaises(RuntimeError):
+            with self.graph.batch():
+                self.graph.find_or_create_entity("Valji")
+                raise RuntimeError("failed")
+        self.assertEqual(self.steps(), ["session", "begin", "run", "rollback", "close", "end"])
+        self.driver.log.clear()
+        # unit ended, next query runs in its own transaction again
+        self.graph.find_or_create_predicate("owns")
+        self.assertEqual(self.steps(), ["session", "write", "run", "end"])
+
+    def test_nested(self):
+        with self.assertRaises(RuntimeError):
+            with self.graph.batch() as outer:
+                with self.graph.batch() as inner:
+                    self.assertIs(inner, outer)
+                    self.graph.find_or_create_entity("Valji")
+                self.graph.find_or_create_entity("Muninn")
+                raise RuntimeError("failed")
+        # inner block neither commits nor closes, whole unit is rolled back once
+        self.assertEqual(self.steps(), ["session", "begin", "run", "run", "rollback", "close", "end"])
+
+    def test_repeated_fact(self):
+        from muninn.database.graph import Fact
+        facts = [
+            Fact("Valji owns sword", entities=[("Valji", "subject")]),
+            Fact("Muninn flew away"),
+            Fact("Valji owns sword", "fact-1", entities=[("sword", "object")]),
+        ]
+        self.assertEqual(self.graph.insert_facts(facts, timestamp=dt.datetime(2023, 5, 1)), [3, 4, 3])
+        parameters = next(step[2] for step in self.driver.log if step[0] == "run")
+        # sent once, record binds it once and NEXT chain has no loop
+        self.assertEqual([fact["text"] for fact in parameters["facts"]], ["Valji owns sword", "Muninn flew away"])
+        self.assertEqual(parameters["facts"][0]["embedding_id"], "fact-1")
+        self.assertEqual(
+            parameters["facts"][0]["entities"],
+            [{"text": "Valji", "role": "subject"}, {"text": "sword", "role": "object"}],
+        )
+
+    def test_node_cache(self):
+        self.assertEqual(self.graph.find_or_create_entity("Valji"), 1)
+        self.assertEqual(self.graph.find_or_create_entity("Valji"), 1)
+        self.assertEqual(self.steps(), ["session", "write", "run", "end"])
+
+    def test_node_cache_rollback(self):
+        with self.assertRaises(RuntimeError):
+            with self.graph.batch():
+                self.graph.find_or_create_entity("Valji")
+                # node learned inside unit is reused within it
+                self.graph.find_or_create_entity("Valji")
+                raise RuntimeError("failed")
+        self.assertEqual(len(self.graph.node_cache), 0)
+        self.driver.log.clear()
+        self.graph.find_or_create_entity("Valji")
+        self.assertEqual(self.steps(), ["session", "write", "run", "end"])
+
+    def test_node_cache_delete(self):
+        with self.graph.batch():
+            self.graph.find_or_create_entity("Valji")
+        self.assertEqual(len(self.graph.node_cache), 1)
+        self.assertEqual(self.graph.delete_by_text("Entity", ["Valji"]), 1)
+        self.assertEqual(len(self.graph.node_cache), 0)
+        self.driver.log.clear()
+        self.graph.find_or_create_entity("Valji")
+        self.assertEqual(self.steps(), ["session", "write", "run", "end"])
+
+    def test_iter_nodes_streams(self):
+        self.driver.rows = [{"id": id_, "label": "Fact", "properties": {}} for id_ in range(5)]
+        pages = list(self.graph.iter_nodes(chunk_size=2))
+        self.assertEqual([[row["id"] for row in page] for page in pages], [[0, 1], [2, 3], [4]])
+        # one query for whole export, pages come from its open result
+        runs = [step for step in self.driver.log if step[0] == "run"]
+        self.assertEqual(len(runs), 1)
+        self.assertNotIn("ORDER BY", runs[0][1])
+        self.assertEqual(self.steps(), ["session", "begin", "run", "fetch", "fetch", "fetch", "fetch", "close", "end"])
+
+    def test_timeout(self):
+        self.graph.neighbors(["fact"])
+        self.graph.neighbors(["fact"], timeout=0.2)
+        # spent budget still stops query, timeout 0 would let it run forever
+        self.graph.neighbors(["fact"], timeout=-0.1)
+        timeouts = [step[1] for step in self.driver.log if step[0] == "read"]
+        self.assertEqual(timeouts[:2], [None, 0.2])
+        self.assertGreater(timeouts[2], 0)
+        query, parameters = next(step[1:] for step in self.driver.log if step[0] == "run")
+        # every hop follows limited number of relationships of each node
+        self.assertEqual(query.count("LIMIT $fanout"), 2)
+        self.assertEqual(parameters["fanout"], 32)
+
+
+class MemoryGraphTest(unittest.TestCase):
+
+    def test_repeated_fact(self):
+        from benchmarks.standins import MemoryGraph
+        from muninn.database.graph import Fact
+        graph = MemoryGraph()
+        first, _, again = graph.insert_facts([Fact("A"), Fact("B"), Fact("A")], timestamp=dt.datetime(2023, 5, 1))
+        self.assertEqual(first, again)
+        self.assertEqual(sorted(relation for _, relation, _ in graph.edges), ["CONTAINS", "CONTAINS", "NEXT"])
+
+
+if __name__ == '__main__':
+    unittest.main()
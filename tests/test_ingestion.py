@@ -0,0 +1,153 @@
+import contextlib
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append('../')
+
+
+class FakeEmbedder:
+    model = "fake"
+
+    def get_many(self, texts):
+        return [[float(len(text)), float(sum(map(ord, text)) % 97), 1.0] for text in texts]
+
+
+class FailingEmbedder:
+    model = "failing"
+
+    def get_many(self, texts):
+        raise RuntimeError("embedding service is down")
+
+
+class FakeGraph:
+
+    def __init__(self):
+        self.facts = []
+        self.records = []
+
+    @contextlib.contextmanager
+    def batch(self):
+        yield self
+
+    def insert_facts(self, facts, timestamp=None, author=None, chronicle_id=None):
+        ids = list(range(len(self.facts), len(self.facts) + len(facts)))
+        self.facts.extend(facts)
+        self.records.append((timestamp, ids))
+        return ids
+
+
+class IngestionPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        from muninn.database.local import LocalClient
+        from muninn.database.similarity import VectorStorage
+        from muninn.ingestion import FileCheckpoint
+        from muninn.weave.fact import Chronicle
+        self.directory = tempfile.TemporaryDirectory()
+        self.chronicle = Chronicle(f"sqlite:///{os.path.join(self.directory.name, 'chronicle.db')}")
+        self.storage = VectorStorage(client=LocalClient())
+        self.checkpoint = FileCheckpoint(os.path.join(self.directory.name, "checkpoint"))
+
+    def tearDown(self):
+        self.chronicle.close()
+        self.directory.cleanup()
+
+    def create_pipeline(self, embedder=None, graph=None, extractor=None, fact_storage=None):
+        from muninn.ingestion import IngestionPipeline
+        return IngestionPipeline(
+            self.chronicle, embedder or FakeEmbedder(), self.storage, graph, extractor, self.checkpoint,
+            workers={"extract": 2, "embed": 2}, batch_sizes={"embed": 16, "store": 16},
+            fact_storage=fact_storage,
+        )
+
+    def test_ingest(self):
+        from muninn.language.facts import FactExtractor
+        graph = FakeGraph()
+        extractor = FactExtractor(complete=lambda prompt, max_tokens: "|Valji|owns|sword|-")
+        with self.create_pipeline(graph=graph, extractor=extractor) as pipeline:
+            for number in range(100):
+                pipeline.submit(f"message {number}")
+        self.assertEqual(pipeline.processed, 100)
+        self.assertEqual(self.checkpoint.load(), 100)
+        self.assertEqual(self.storage.collection.count(), 100)
+        self.assertEqual(len(graph.records), 100)
+        # source record lets recall check time window by id
+        stored = self.storage.collection.get(include=["documents", "metadatas"])
+        labels = dict(zip(stored["documents"], stored["metadatas"]))
+        self.assertEqual(labels["message 7"], {"chronicle_ids": "[8]"})
+
+    def test_fact_storage(self):
+        from muninn.database.local import LocalClient
+        from muninn.database.similarity import VectorStorage, document_id
+        from muninn.language.facts import FactExtractor
+        graph = FakeGraph()
+        fact_storage = VectorStorage(client=LocalClient(precision="int8"))
+        extractor = FactExtractor(complete=lambda prompt, max_tokens: "|Valji|owns|sword|-")
+        with self.create_pipeline(graph=graph, extractor=extractor, fact_storage=fact_storage) as pipeline:
+            pipeline.submit("Valji owns a sword.")
+            pipeline.submit("Valji has a sword.")
+        # the same fact of both records is stored once, graph references it by id
+        self.assertEqual(fact_storage.collection.count(), 1)
+        self.assertEqual({fact.embedding_id for fact in graph.facts}, {document_id("Valji owns sword")})
+
+    def test_resume_after_checkpoint(self):
+        with self.create_pipeline() as pipeline:
+            pipeline.submit("before crash")
+        # written to chronicle, but never ingested
+        self.chronicle.insert_many(["lost 1", "lost 2"])
+        with self.create_pipeline() as pipeline:
+            pass
+        self.assertEqual(pipeline.processed, 2)
+        self.assertEqual(self.checkpoint.load(), 3)
+        self.assertEqual(self.storage.collection.count(), 3)
+
+    def test_records_of_other_writer(self):
+        import time
+
+        chronicle = self.chronicle
+
+        class InterleavedChronicle:
+            # other writer inserts right before second batch of pipeline
+            calls = 0
+
+            def __getattr__(self, name):
+                return getattr(chronicle, name)
+
+            def insert_many(self, contents, time_stamps=None):
+                self.calls += 1
+                if self.calls == 2:
+                    chronicle.insert("written by other process")
+                return chronicle.insert_many(contents, time_stamps)
+
+        self.chronicle = InterleavedChronicle()
+        try:
+            with self.create_pipeline() as pipeline:
+                pipeline.submit("first")
+                deadline = time.monotonic() + 5
+                while pipeline.processed < 1 and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                pipeline.submit("second")
+        finally:
+            self.chronicle = chronicle
+        self.assertEqual(pipeline.processed, 3)
+        self.assertEqual(self.checkpoint.load(), 3)
+        self.assertEqual(self.storage.collection.count(), 3)
+
+    def test_single_store_writer(self):
+        from muninn.ingestion import IngestionPipeline
+        with self.assertRaises(ValueError):
+            IngestionPipeline(self.chronicle, FakeEmbedder(), self.storage, workers={"store": 2})
+
+    def test_error_keeps_checkpoint(self):
+        pipeline = self.create_pipeline(embedder=FailingEmbedder())
+        with self.assertRaises(RuntimeError):
+            with pipeline:
+                pipeline.submit("never stored")
+        self.assertEqual(self.checkpoint.load(), 0)
+        self.assertEqual(len(self.chronicle.get_many([1])), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import sys
+import unittest
+
+sys.path.append('../')
+
+EMBEDDINGS = [[1.2, 2.3, 4.5], [6.7, 8.2, 9.2]]
+DOCS = ["This is a document", "This is another document"]
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    def setUp(self):
+        from muninn.instrumentation import HistogramCollector, add_tracer
+        self.collector = HistogramCollector()
+        add_tracer(self.collector)
+
+    def tearDown(self):
+        from muninn.instrumentation import remove_tracer
+        remove_tracer(self.collector)
+
+    def test_vector_storage(self):
+        from muninn.database.local import LocalClient
+        from muninn.database.similarity import VectorStorage
+        storage = VectorStorage(client=LocalClient())
+        storage.add_many(embeddings=EMBEDDINGS, documents=DOCS)
+        storage.query(embedding=EMBEDDINGS[0], n_results=1)
+        snapshot = self.collector.snapshot()
+        self.assertEqual(snapshot["vector.add_many"]["batch_size"]["sum"], 2)
+        self.assertEqual(snapshot["vector.add_many"]["payload_bytes"]["sum"], 24)
+        self.assertEqual(snapshot["vector.query"]["latency"]["count"], 1)
+        self.assertIn('muninn_latency_seconds_count{operation="vector.query"} 1', self.collector.prometheus())
+
+    def test_errors(self):
+        from muninn.instrumentation import instrumented
+
+        @instrumented("test.fail", "texts")
+        def fail(texts):
+            raise ValueError(texts)
+
+        with self.assertRaises(ValueError):
+            fail(["a", "b", "c"])
+        operation = self.collector.snapshot()["test.fail"]
+        self.assertEqual(operation["errors"], {"ValueError": 1})
+        self.assertEqual(operation["batch_size"]["sum"], 3)
+
+    def test_disabled(self):
+        from muninn.instrumentation import instrumented, remove_tracer
+        remove_tracer(self.collector)
+
+        @instrumented("test.disabled")
+        def call():
+            return 1
+
+        self.assertEqual(call(), 1)
+        self.assertEqual(self.collector.snapshot(), {})
+
+    def test_async(self):
+        import asyncio
+        from muninn.instrumentation import instrumented
+
+        @instrumented("test.async", "texts")
+        async def call(texts):
+            return len(texts)
+
+        self.assertEqual(asyncio.run(call(["a", "b"])), 2)
+        self.assertEqual(self.collector.snapshot()["test.async"]["batch_size"]["sum"], 2)
+
+    def test_quantile(self):
+        from muninn.instrumentation import Histogram
+        histogram = Histogram([1, 2, 4, 8])
+        for value in (0.5, 1.5, 3, 3, 7):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [1, 1, 2, 1, 0])
+        self.assertAlmostEqual(histogram.quantile(0.5), 2.5)
+        self.assertLessEqual(histogram.quantile(0.99), 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,249 @@
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append('../')
+
+
+class FakeEmbedder:
+    model = "fake"
+
+    def __init__(self):
+        self.calls = 0
+
+    def get_many(self, texts):
+        self.calls += 1
+        return [[float(len(text)), 1.0] for text in texts]
+
+
+class EmbeddingCacheTest(unittest.TestCase):
+
+    def test_memory_hit(self):
+        from muninn.language.cache import CachedEmbedding, EmbeddingCache
+        embedder = CachedEmbedding(FakeEmbedder(), EmbeddingCache(max_items=8))
+        first = embedder.get_many(["a", "bb", "a"])
+        second = embedder.get("bb")
+        self.assertEqual(first[0], first[2])
+        self.assertEqual(second, [2.0, 1.0])
+        self.assertEqual(embedder.embedder.calls, 1)
+        self.assertEqual(embedder.stats.hits, 1)
+
+    def test_hit_is_copy(self):
+        from muninn.language.cache import EmbeddingCache
+        cache = EmbeddingCache(max_items=8)
+        cache.put("a", [1.0, 2.0])
+        first, second = cache.get_many(["a", "a"])
+        first.append(3.0)
+        second[0] = 0.0
+        self.assertEqual(cache.get("a"), [1.0, 2.0])
+
+    def test_eviction(self):
+        from muninn.language.cache import CachedEmbedding, EmbeddingCache
+        embedder = CachedEmbedding(FakeEmbedder(), EmbeddingCache(max_items=2))
+        embedder.get_many(["a", "bb", "ccc"])
+        self.assertEqual(len(embedder.cache), 2)
+        self.assertEqual(embedder.stats.evictions, 1)
+
+    def test_disk_survives_restart(self):
+        from muninn.language.cache import CachedEmbedding, EmbeddingCache
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache.sqlite")
+            cache = EmbeddingCache(path=path)
+            CachedEmbedding(FakeEmbedder(), cache).get("persistent")
+            cache.close()
+            cache = EmbeddingCache(path=path)
+            embedder = CachedEmbedding(FakeEmbedder(), cache)
+            self.assertEqual(embedder.get("persistent"), [10.0, 1.0])
+            self.assertEqual(embedder.embedder.calls, 0)
+            self.assertEqual(embedder.stats.disk_hits, 1)
+            cache.close()
+
+    def test_tiers_equal(self):
+        from muninn.language.cache import CachedEmbedding, EmbeddingCache
+
+        class PreciseEmbedder(FakeEmbedder):
+            def get_many(self, texts):
+                self.calls += 1
+                return [[0.1, 1 / 3] for _ in texts]
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache.sqlite")
+            cache = EmbeddingCache(path=path)
+            embedder = CachedEmbedding(PreciseEmbedder(), cache)
+            computed = embedder.get_many(["x", "x", "y"])
+            memory_hit = embedder.get("x")
+            cache.close()
+            cache = EmbeddingCache(path=path)
+            disk_hit = CachedEmbedding(PreciseEmbedder(), cache).get("x")
+            cache.close()
+        self.assertEqual(computed[0], memory_hit)
+        self.assertEqual(memory_hit, disk_hit)
+        self.assertEqual((embedder.stats.misses, embedder.stats.hits), (2, 1))
+
+
+class AsyncEmbeddingTest(unittest.IsolatedAsyncioTestCase):
+
+    @staticmethod
+    def create_transport(rate_limited: int = 0):
+        from muninn.language.embedding import RateLimitError
+        calls = []
+
+        async def transport(texts, model):
+            calls.append(list(texts))
+            await asyncio.sleep(0.01)
+            if len(calls) <= rate_limited:
+                raise RateLimitError()
+            return [[float(len(text))] for text in texts]
+
+        return transport, calls
+
+    async def test_coalesce(self):
+        from muninn.language.embedding import AsyncEmbedding
+        transport, calls = self.create_transport()
+        embedder = AsyncEmbedding(transport=transport)
+        results = await asyncio.gather(embedder.get("a"), embedder.get("a"), embedder.get_many(["a", "bb"]))
+        self.assertEqual(results, [[1.0], [1.0], [[1.0], [2.0]]])
+        self.assertEqual(sorted(calls), [["a"], ["bb"]])
+
+    async def test_rate_limit_retry(self):
+        from muninn.language.embedding import AsyncEmbedding
+        transport, calls = self.create_transport(rate_limited=2)
+        embedder = AsyncEmbedding(transport=transport, min_backoff=0.01)
+        self.assertEqual(await embedder.get("abc"), [3.0])
+        self.assertEqual(len(calls), 3)
+
+
+class FactExtractorTest(unittest.TestCase):
+    PACKED_ANSWER = "Output 1: |Rrrr|is|gnome|-|Rrrr|has|short beard|-\nOutput 2:\n"
+
+    def create_extractor(self):
+        from muninn.language.facts import FactExtractor
+        prompts = []
+
+        def complete(prompt, max_tokens):
+            prompts.append(prompt)
+            return self.PACKED_ANSWER if "Input 2:" in prompt else "|Valji|uses|shield|-"
+
+        return FactExtractor(complete=complete), prompts
+
+    def test_parse(self):
+        from muninn.language.facts import Triple, parse_facts
+        triples = parse_facts("|Rrrr|is|25 years old|-|Rrrr's backpack|contains|food|-|broken|")
+        self.assertEqual(triples, [Triple("Rrrr", "is", "25 years old"), Triple("Rrrr's backpack", "contains", "food")])
+
+    def test_packed_and_cached(self):
+        from muninn.language.facts import Triple
+        extractor, prompts = self.create_extractor()
+        facts = extractor.extract_many(["I am gnome with short beard.", "Nice day."])
+        self.assertEqual(facts, [[Triple("Rrrr", "is", "gnome"), Triple("Rrrr", "has", "short beard")], []])
+        self.assertEqual(extractor.extract("Nice day."), [])
+        self.assertEqual(len(prompts), 1)
+
+    def test_missing_answer_asked_alone(self):
+        from muninn.language.facts import Triple
+        extractor, prompts = self.create_extractor()
+        facts = extractor.extract_many(["one", "two", "I use shield."])
+        self.assertEqual(facts[2], [Triple("Valji", "uses", "shield")])
+        self.assertEqual(len(prompts), 2)
+
+
+class LocalEmbeddingTest(unittest.TestCase):
+
+    @staticmethod
+    def create_encoder(batches: list):
+        import numpy as np
+
+        def encode(texts):
+            batches.append(list(texts))
+            return np.array([[float(len(text)), 1.0] for text in texts], dtype=np.float32)
+
+        return encode
+
+    def test_concurrent_calls_batched(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from muninn.language.transformer import LocalEmbedding
+        batches = []
+        embedder = LocalEmbedding(max_batch_size=64, max_latency=0.05, encoder=self.create_encoder(batches))
+        texts = ["x" * length for length in range(1, 33)]
+        with ThreadPoolExecutor(8) as executor:
+            vectors = list(executor.map(embedder.get, texts))
+        embedder.close()
+        self.assertEqual(vectors, [[float(len(text)), 1.0] for text in texts])
+        self.assertLess(len(batches), len(texts))
+        self.assertEqual(embedder.batcher.batches, len(batches))
+
+    def test_length_buckets(self):
+        from muninn.language.transformer import LocalEmbedding
+        batches = []
+        embedder = LocalEmbedding(max_batch_size=2, max_latency=0.05, encoder=self.create_encoder(batches))
+        vectors = embedder.get_many(["aaaa", "a", "aaa", "aa", "a"])
+        embedder.close()
+        self.assertEqual([vector[0] for vector in vectors], [4.0, 1.0, 3.0, 2.0, 1.0])
+        # duplicates are encoded once, the rest is split into buckets of similar length
+        self.assertEqual(batches, [["a"], ["aa", "aaa"], ["aaaa"]])
+
+    def test_error_reaches_caller(self):
+        from muninn.language.transformer import LocalEmbedding
+
+        def encode(texts):
+            raise RuntimeError("model failed")
+
+        embedder = LocalEmbedding(encoder=encode)
+        with self.assertRaises(RuntimeError):
+            embedder.get("text")
+        embedder.close()
+        with self.assertRaises(RuntimeError):
+            embedder.get("closed")
+
+    def test_short_result_fails_batch(self):
+        import numpy as np
+        from muninn.language.transformer import LocalEmbedding
+        calls = []
+
+        def encode(texts):
+            calls.append(list(texts))
+            # the first batch loses its last vector
+            rows = texts[:-1] if len(calls) == 1 else texts
+            return np.array([[float(len(text)), 1.0] for text in rows], dtype=np.float32)
+
+        embedder = LocalEmbedding(encoder=encode)
+        try:
+            with self.assertRaises(ValueError):
+                embedder.get_many(["a", "bb"])
+            # worker survived, next call completes
+            self.assertEqual(embedder.get("ccc"), [3.0, 1.0])
+        finally:
+            embedder.close()
+
+    def test_length_error_fails_batch(self):
+        from muninn.language.transformer import DynamicBatcher
+
+        def length(text):
+            if text == "bad":
+                raise RuntimeError("no length")
+            return len(text)
+
+        batcher = DynamicBatcher(self.create_encoder([]), max_latency=0.01, length=length)
+        try:
+            with self.assertRaises(RuntimeError):
+                batcher.submit(["bad", "good"])[0].result(timeout=5)
+            self.assertEqual(list(batcher.submit(["next"])[0].result(timeout=5)), [4.0, 1.0])
+        finally:
+            batcher.close()
+
+    def test_episodic_drop_in(self):
+        from muninn.database.local import LocalClient
+        from muninn.episodic import Episodic
+        from muninn.language.transformer import LocalEmbedding
+        from muninn.database.similarity import VectorStorage
+        embedder = LocalEmbedding(encoder=self.create_encoder([]))
+        memory = Episodic(embedder, VectorStorage(client=LocalClient()))
+        memory.add_many(["a", "bbb", "bbbbbbbb"])
+        self.assertEqual(memory.recall("bbbb", n_results=1), ["bbb"])
+        embedder.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+import datetime as dt
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.append('../')
+
+START = dt.datetime(2023, 5, 1)
+RECORDS = ["Valji found a sword in the cave.", "The weather was nice.", "Valji sold the sword to Muninn."]
+FACTS = [[("Valji", "found", "sword")], [], [("Valji", "sold", "sword"), ("Muninn", "bought", "sword")]]
+
+
+class SlowGraph:
+
+    def __init__(self, graph, delay):
+        self.graph = graph
+        self.delay = delay
+        self.calls = []
+
+    def neighbors(self, *args, **kwargs):
+        self.calls.append(kwargs)
+        time.sleep(self.delay)
+        return self.graph.neighbors(*args, **kwargs)
+
+
+class SlowStorage:
+
+    def __init__(self, storage, delay):
+        self.storage = storage
+        self.delay = delay
+
+    def query_many(self, *args, **kwargs):
+        time.sleep(self.delay)
+        return self.storage.query_many(*args, **kwargs)
+
+
+class HybridRecallTest(unittest.TestCase):
+
+    def setUp(self):
+        from benchmarks.standins import HashEmbedder, MemoryGraph
+        from muninn.database.local import LocalClient
+        from muninn.database.similarity import VectorStorage
+        from muninn.language.facts import Triple
+        from muninn.weave.fact import Chronicle
+        self.directory = tempfile.TemporaryDirectory()
+        self.chronicle = Chronicle(f"sqlite:///{os.path.join(self.directory.name, 'chronicle.db')}")
+        self.embedder = HashEmbedder(dim=16)
+        self.storage = VectorStorage(client=LocalClient())
+        self.fact_storage = VectorStorage(client=LocalClient())
+        self.graph = MemoryGraph()
+        time_stamps = [START + dt.timedelta(days=day) for day in range(len(RECORDS))]
+        ids = self.chronicle.insert_many(RECORDS, time_stamps)
+        # source record label as ingestion writes it
+        self.storage.add_many(
+            self.embedder.get_many(RECORDS), RECORDS, [{"chronicle_ids": json.dumps([id_])} for id_ in ids]
+        )
+        for id_, time_stamp, facts in zip(ids, time_stamps, FACTS):
+            triples = [Triple(*fact) for fact in facts]
+            texts = [triple.text for triple in triples]
+            embedding_ids = self.fact_storage.add_many(self.embedder.get_many(texts), texts) if texts else []
+            self.graph.insert_facts(
+                [triple.to_fact(embedding_id) for triple, embedding_id in zip(triples, embedding_ids)],
+                timestamp=time_stamp, chronicle_id=id_,
+            )
+
+    def tearDown(self):
+        self.chronicle.close()
+        self.directory.cleanup()
+
+    def create_recall(self, graph=None, **options):
+        from muninn.recall import HybridRecall
+        return HybridRecall(
+            self.embedder, self.storage, graph or self.graph, self.fact_storage, self.chronicle, **options
+        )
+
+    def test_graph_expansion(self):
+        # traversal starts only from the nearest fact
+        with self.create_recall(budget=5, n_facts=1) as recall:
+            result = recall.recall("Valji found sword", n_results=10)
+        self.assertEqual(result.timed_out, [])
+        candidates = {candidate.text: candidate for candidate in result.candidates}
+        self.assertEqual(candidates["Valji sold sword"].kind, "fact")
+        self.assertEqual(candidates["Valji sold sword"].hops, 2)
+        # found through vector and graph, scores above texts found by vector only
+        self.assertEqual(candidates[RECORDS[0]].hops, 1)
+        self.assertGreater(candidates[RECORDS[0]].score, candidates[RECORDS[1]].score)
+
+    def test_window(self):
+        # window is checked by ids of hits, never by scanning it
+        self.chronicle.range = None
+        self.storage.add_many(self.embedder.get_many(["Valji sold the sword again."]), ["Valji sold the sword again."])
+        with self.create_recall(budget=5, lexical=True) as recall:
+            window = START + dt.timedelta(days=2), START + dt.timedelta(days=3)
+            result = recall.recall("Valji found sword", n_results=10, window=window)
+        self.assertEqual(result.timed_out, [])
+        # text without source record is not proven to be inside window
+        self.assertEqual(set(result.texts), {RECORDS[2], "Valji sold sword", "Muninn bought sword"})
+
+    def test_budget(self):
+        graph = SlowGraph(self.graph, 0.5)
+        with self.create_recall(graph=graph, budget=0.05) as recall:
+            result = recall.recall("Valji found sword", n_results=10)
+        self.assertEqual(result.timed_out, ["graph"])
+        self.assertEqual(set(result.texts), set(RECORDS))
+        self.assertLess(result.seconds, 0.4)
+        # database may stop traversal once budget is spent
+        self.assertLessEqual(graph.calls[0]["timeout"], 0.05)
+
+    def test_failed_store(self):
+        class BrokenGraph:
+            def neighbors(self, *args, **kwargs):
+                raise ConnectionError("graph unavailable")
+
+        with self.create_recall(graph=BrokenGraph(), budget=5) as recall:
+            result = recall.recall("Valji found sword", n_results=10)
+        self.assertEqual(list(result.failed), ["graph"])
+        self.assertIsInstance(result.failed["graph"], ConnectionError)
+        self.assertEqual(result.timed_out, [])
+        # vector hits are still fused
+        self.assertEqual(set(result.texts), set(RECORDS))
+
+    def test_cancel_late(self):
+        from muninn.recall import HybridRecall
+        graph = SlowGraph(self.graph, 0)
+        storage = SlowStorage(self.storage, 0.3)
+        with HybridRecall(self.embedder, storage, graph, self.fact_storage, budget=0.05, max_workers=1) as recall:
+            result = recall.recall("Valji found sword", n_results=10)
+            self.assertEqual(result.timed_out, ["vector", "graph"])
+            time.sleep(0.5)
+            # graph expansion was queued behind slow vector query and never ran
+            self.assertEqual(graph.calls, [])
+
+    def test_lexical(self):
+        record = self.chronicle.insert("Muninn keeps item SW-1234.", START)
+        with self.create_recall(budget=5) as recall:
+            self.assertNotIn(record["content"], recall.recall("Where is SW-1234?", n_results=10).texts)
+        with self.create_recall(budget=5, lexical=True) as recall:
+            result = recall.recall("Where is SW-1234?", n_results=10)
+        self.assertEqual(result.timed_out, [])
+        # found by keyword only, no vector of record is stored
+        candidates = {candidate.text: candidate for candidate in result.candidates}
+        self.assertEqual(candidates[record["content"]].lexical_rank, 0)
+        self.assertEqual(candidates[record["content"]].chronicle_ids, {record["id"]})
+        self.assertIsNone(candidates[RECORDS[1]].lexical_rank)
+
+    def test_reciprocal_rank_fusion(self):
+        from muninn.recall import reciprocal_rank_fusion
+        fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "d", "c"]], weights=[1.0, 3.0], k=1)
+        self.assertEqual([key for key, _ in fused], ["c", "d", "a", "b"])
+        self.assertAlmostEqual(dict(fused)["c"], 1 / 3 + 3 / 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
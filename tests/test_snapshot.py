@@ -0,0 +1,111 @@
+import datetime as dt
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append('../')
+
+START = dt.datetime(2023, 5, 1)
+RECORDS = ["Valji found a sword in the cave.", "Počasí bylo pěkné.", "Valji sold the sword to Muninn."]
+FACTS = [[("Valji", "found", "sword")], [], [("Valji", "sold", "sword")]]
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        from benchmarks.standins import HashEmbedder, MemoryGraph
+        from muninn.database.local import LocalClient
+        from muninn.database.similarity import VectorStorage
+        from muninn.language.facts import Triple
+        from muninn.weave.fact import Chronicle
+        self.directory = tempfile.TemporaryDirectory()
+        self.chronicle = Chronicle(self.url("source"))
+        self.embedder = HashEmbedder(dim=16)
+        self.storage = VectorStorage(client=LocalClient())
+        self.graph = MemoryGraph()
+        time_stamps = [START + dt.timedelta(days=day) for day in range(len(RECORDS))]
+        ids = self.chronicle.insert_many(RECORDS, time_stamps)
+        self.storage.add_many(self.embedder.get_many(RECORDS), RECORDS, [{"author": "Valji"}, None, None])
+        for id_, time_stamp, facts in zip(ids, time_stamps, FACTS):
+            triples = [Triple(*fact) for fact in facts]
+            self.graph.insert_facts(
+                [triple.to_fact(f"fact-{triple.text}") for triple in triples], timestamp=time_stamp, chronicle_id=id_,
+            )
+
+    def tearDown(self):
+        self.chronicle.close()
+        self.directory.cleanup()
+
+    def url(self, name):
+        return f"sqlite:///{os.path.join(self.directory.name, name + '.db')}"
+
+    def test_round_trip(self):
+        import numpy as np
+        from benchmarks.standins import MemoryGraph
+        from muninn.database.local import LocalClient
+        from muninn.database.similarity import VectorStorage, document_id
+        from muninn.snapshot import Snapshot, export_snapshot, import_snapshot
+        from muninn.weave.fact import Chronicle
+        path = os.path.join(self.directory.name, "snapshot")
+        export_snapshot(path, self.storage, self.chronicle, self.graph, batch_size=2)
+        self.assertFalse(os.path.exists(f"{path}.partial"))
+        snapshot = Snapshot(path)
+        self.assertIsInstance(snapshot.embeddings, np.memmap)
+        self.assertEqual(snapshot.embeddings.shape, (3, 16))
+
+        storage = VectorStorage(client=LocalClient())
+        chronicle = Chronicle(self.url("target"))
+        graph = MemoryGraph()
+        self.embedder.requests = 0
+        try:
+            loaded = import_snapshot(path, storage, chronicle, graph, batch_size=2)
+            expected = {"vectors": 3, "records": 3, "nodes": len(self.graph.nodes), "edges": len(self.graph.edges)}
+            self.assertEqual(loaded, expected)
+            self.assertEqual(self.embedder.requests, 0)
+            ids = [document_id(record) for record in RECORDS]
+            self.assertEqual(storage.get_many(ids), self.storage.get_many(ids))
+            self.assertEqual(list(chronicle.iter_after(0)), list(self.chronicle.iter_after(0)))
+            self.assertEqual(chronicle.insert("next"), chronicle.get_one(4))
+            query = self.embedder.get("Valji found sword")
+            self.assertEqual(storage.query(query, n_results=1), self.storage.query(query, n_results=1))
+            self.assertEqual(
+                [(row["label"], row["text"], row["hops"]) for row in graph.neighbors(["fact-Valji found sword"])],
+                [(row["label"], row["text"], row["hops"]) for row in self.graph.neighbors(["fact-Valji found sword"])],
+            )
+        finally:
+            chronicle.close()
+
+    def test_chroma_export(self):
+        import numpy as np
+        from muninn.database.similarity import Settings, VectorStorage
+        from muninn.snapshot import Snapshot, export_snapshot
+        # in-process chroma, its limit and offset pages have no stable order
+        storage = VectorStorage(Settings(anonymized_telemetry=False), "snapshot_collection")
+        embeddings = np.random.default_rng(0).standard_normal((500, 4)).astype(np.float32)
+        documents = [f"memory {index}" for index in range(len(embeddings))]
+        doc_ids = storage.add_many(embeddings, documents)
+        path = os.path.join(self.directory.name, "snapshot")
+        export_snapshot(path, storage, batch_size=7)
+        exported = [
+            (id_, document)
+            for ids, _, texts, _ in Snapshot(path).iter_vectors(batch_size=64)
+            for id_, document in zip(ids, texts)
+        ]
+        self.assertEqual(sorted(exported), sorted(zip(doc_ids, documents)))
+
+    def test_existing_snapshot_kept(self):
+        from muninn.snapshot import export_snapshot
+        path = os.path.join(self.directory.name, "snapshot")
+        export_snapshot(path, self.storage)
+        with self.assertRaises(FileExistsError):
+            export_snapshot(path, self.storage)
+
+    def test_property_values(self):
+        from muninn.snapshot import dumps, loads
+        properties = {"timestamp": START, "day": START.date(), "text": None, "nested": {"a": [1, 2]}}
+        self.assertEqual(loads(dumps(properties)), properties)
+
+
+if __name__ == '__main__':
+    unittest.main()
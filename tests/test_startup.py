@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# import of package itself, interpreter start excluded
+IMPORT_BUDGET = 0.25
+HEAVY_MODULES = ("spacy", "chromadb", "neo4j", "openai", "torch", "transformers", "numpy", "sqlalchemy")
+
+MEASURE = f"""
+import sys, time
+start = time.perf_counter()
+import muninn, muninn.language, muninn.database, muninn.episodic
+elapsed = time.perf_counter() - start
+print(elapsed)
+print(",".join(name for name in {HEAVY_MODULES!r} if name in sys.modules))
+"""
+
+
+class StartupTest(unittest.TestCase):
+
+    @staticmethod
+    def measure() -> tuple[float, list[str]]:
+        output = subprocess.run(
+            [sys.executable, "-c", MEASURE], cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.splitlines()
+        return float(output[0]), [name for name in output[1].split(",") if name]
+
+    def test_import_budget(self):
+        elapsed = min(self.measure()[0] for _ in range(3))
+        self.assertLess(elapsed, IMPORT_BUDGET)
+
+    def test_no_heavy_imports(self):
+        self.assertEqual(self.measure()[1], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
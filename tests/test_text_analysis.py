@@ -0,0 +1,35 @@
+import sys
+import unittest
+
+sys.path.append('../')
+
+TEXT = "Valji is 25 years old and he is level 3 gnome warrior. He has a short sword."
+
+
+class CorefTest(unittest.TestCase):
+
+    @staticmethod
+    def create_doc():
+        import spacy
+        doc = spacy.blank("en")(TEXT)
+        doc.spans["coref_clusters_1"] = [doc[0:1], doc[6:7], doc[13:14]]
+        return doc
+
+    def test_resolve_doc(self):
+        from muninn.language.reference import resolve_doc
+        resolved = resolve_doc(self.create_doc())
+        self.assertEqual(resolved.source, TEXT)
+        self.assertEqual([mention.text for mention in resolved.clusters[0]], ["Valji", "he", "He"])
+        self.assertEqual(resolved.resolved, "Valji is 25 years old and Valji is level 3 gnome warrior. Valji has a short sword.")
+
+    def test_resolve_many_keeps_order(self):
+        import spacy
+        from muninn.language.reference import CorefResolver
+        resolver = CorefResolver(batch_size=2, n_process=1, nlp=spacy.blank("en"))
+        texts = ["first", "second", "third"]
+        self.assertEqual([resolved.source for resolved in resolver.resolve_many(texts)], texts)
+        self.assertEqual([resolved.resolved for resolved in resolver.stream(iter(texts))], texts)
+
+
+if __name__ == '__main__':
+    unittest.main()